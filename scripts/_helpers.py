@@ -2,6 +2,7 @@
 # SPDX-FileCopyrightText: : 2017-2020 The PyPSA-Eur Authors
 #
 # SPDX-License-Identifier: GPL-3.0-or-later
+import logging
 import os
 from pathlib import Path
 
@@ -9,6 +10,8 @@ import geopandas as gpd
 import numpy as np
 import pandas as pd
 
+logger = logging.getLogger(__name__)
+
 
 def sets_path_to_root(root_directory_name):
     """
@@ -642,3 +645,99 @@ def read_geojson(fn):
     else:
         # else return an empty GeoDataFrame
         return gpd.GeoDataFrame(geometry=[])
+
+
+def _to_parquet_types(df):
+    """
+    Convert the object columns with mixed types, e.g. strings and numbers, into strings,
+    as the columns of parquet files shall have a single type
+    """
+    df = df.copy()
+    geometry_name = df.geometry.name if isinstance(df, gpd.GeoDataFrame) else None
+    converted = []
+    for col in df.columns:
+        if col == geometry_name or df[col].dtype != object:
+            continue
+        values = df[col].dropna()
+        if not values.map(type).eq(str).all():
+            df[col] = df[col].where(df[col].isna(), df[col].astype(str))
+            converted.append(col)
+    if converted:
+        logger.info(f"Columns with mixed types saved as strings: {converted}")
+    return df
+
+
+def save_geodata(df, fn, export_geojson=False):
+    """
+    Save a (Geo)DataFrame in the format specified by the extension of the file:
+    GeoParquet (".parquet") or GeoJSON (".geojson")
+
+    Parameters
+    ----------
+    df : (Geo)DataFrame
+        Dataframe to save
+    fn : str
+        Path of the output file
+    export_geojson : bool
+        When true and fn is not a GeoJSON file, a GeoJSON copy of the data is
+        also saved next to fn, e.g. for inspection in GIS tools
+    """
+    root, ext = os.path.splitext(fn)
+
+    if ext == ".geojson":
+        save_to_geojson(df, fn)
+        return
+    elif ext != ".parquet":
+        raise ValueError(f"Unsupported file format {ext} for file {fn}")
+
+    if os.path.exists(fn):
+        os.unlink(fn)  # remove file if it exists
+
+    # save file if the (Geo)DataFrame is non-empty
+    if df.empty:
+        # create empty file to avoid issues with snakemake
+        with open(fn, "w") as fp:
+            pass
+    else:
+        # save file
+        _to_parquet_types(df).to_parquet(fn)
+
+    if export_geojson:
+        save_to_geojson(df, root + ".geojson")
+
+
+def read_geodata(fn, columns=None):
+    """
+    Read a GeoDataFrame saved by save_geodata; the format is specified by the
+    extension of the file: GeoParquet (".parquet") or GeoJSON (".geojson")
+
+    Parameters
+    ----------
+    fn : str
+        Path of the file
+    columns : list
+        (optional) Columns to read; the geometry is always read and the
+        columns missing in the file are ignored.
+        For parquet files, the other columns are not read from disk.
+    """
+    ext = os.path.splitext(fn)[1]
+
+    if os.path.getsize(fn) == 0:
+        # return an empty GeoDataFrame
+        return gpd.GeoDataFrame(geometry=[])
+
+    if columns is not None and "geometry" not in columns:
+        columns = list(columns) + ["geometry"]
+
+    if ext == ".parquet":
+        if columns is not None:
+            import pyarrow.parquet as pq
+
+            names = pq.read_schema(fn).names
+            columns = [c for c in columns if c in names]
+        return gpd.read_parquet(fn, columns=columns)
+    elif ext == ".geojson":
+        gdf = read_geojson(fn)
+        return gdf if columns is None else gdf[gdf.columns.intersection(columns)]
+    else:
+        raise ValueError(f"Unsupported file format {ext} for file {fn}")
@@ -12,6 +12,9 @@ Relevant Settings
 
     countries:
 
+    build_bus_regions_nprocesses:
+    build_bus_regions_cache:
+
 .. seealso::
     Documentation of the configuration file ``config.yaml`` at
     :ref:`toplevel_cf`
@@ -39,22 +42,42 @@ Outputs
 Description
 -----------
 
+With ``build_bus_regions_cache: true``, the clipped Voronoi cells of each
+country are stored in ``resources/bus_regions/cache`` and reused when the
+buses and the shape of the country do not change. The cache is not tracked by
+snakemake and it is never evicted: delete the folder, e.g. by
+``snakemake -j 1 clean_bus_regions_cache``, to free the disk space.
+
 """
+import hashlib
 import logging
+import multiprocessing as mp
 import os
+import warnings
 
 import geopandas as gpd
 import numpy
 import pandas as pd
 import pypsa
-from _helpers import configure_logging, two_2_three_digits_country
-from shapely.geometry import Point, Polygon
+import shapely
+from _helpers import (
+    configure_logging,
+    read_geodata,
+    save_geodata,
+    two_2_three_digits_country,
+)
+from shapely.geometry import Polygon
+from shapely.prepared import prep
 from vresutils.graph import voronoi_partition_pts
 
 # from scripts.build_shapes import gadm
 
 _logger = logging.getLogger(__name__)
 
+BUS_REGIONS_CACHE_DIR = "resources/bus_regions/cache"
+# version of the cached Voronoi cells, increase it when their calculation changes
+VORONOI_CACHE_VERSION = 1
+
 
 def save_to_geojson(df, fn):
     # remove file if it exists
@@ -140,45 +163,258 @@ def custom_voronoi_partition_pts(points, outline, add_bounds_shape=True, multipl
             if not poly.is_valid:
                 poly = poly.buffer(0)
 
-            poly = poly.intersection(outline)
-
             polygons_arr[i] = poly
 
+        polygons_arr = clip_polygons(polygons_arr, outline)
+
     return polygons_arr
 
 
-def get_gadm_shape(onshore_locs, gadm_shapes):
-    def locate_bus(coords):
-        point = Point(Point(coords["x"], coords["y"]))
-        gadm_shapes_country = gadm_shapes.filter(
-            like=two_2_three_digits_country(country), axis=0
-        )
+def clip_polygons(polygons, outline):
+    """
+    Clip the polygons to the outline.
 
-        try:
-            return gadm_shapes[gadm_shapes.contains(point)].item()
-        except ValueError:
-            return min(
-                gadm_shapes_country, key=(point.distance)
-            )  # TODO returns closest shape if the point was not inside one. Works well but will not catch an outlier bus.
-
-    def get_id(coords):
-        point = Point(Point(coords["x"], coords["y"]))
-        gadm_shapes_country = gadm_shapes.filter(
-            like=two_2_three_digits_country(country), axis=0
-        )
+    The outline is prepared and only the polygons that are not fully within
+    the outline are intersected with it, in a single vectorized call when
+    shapely >= 2 is available.
+
+    Parameters
+    ----------
+    polygons : N - ndarray[dtype=Polygon]
+    outline : Polygon|MultiPolygon
 
-        try:
-            return gadm_shapes[gadm_shapes.contains(point)].index.item()
-        except ValueError:
-            # return 'not_found'
-            return gadm_shapes_country[
-                gadm_shapes_country.geometry
-                == min(gadm_shapes_country, key=(point.distance))
-            ].index.item()  # TODO returns closest shape if the point was not inside one.
+    Returns
+    -------
+    polygons : N - ndarray[dtype=Polygon|MultiPolygon]
+    """
+    polygons = numpy.array(polygons, dtype=object)
 
-    regions = onshore_locs[["x", "y"]].apply(locate_bus, axis=1)
-    ids = onshore_locs[["x", "y"]].apply(get_id, axis=1)
-    return regions.values, ids.values
+    if hasattr(shapely, "prepare"):
+        # shapely >= 2: vectorized operations
+        shapely.prepare(outline)
+        to_clip = ~shapely.contains_properly(outline, polygons)
+        polygons[to_clip] = shapely.intersection(polygons[to_clip], outline)
+    else:
+        prepared_outline = prep(outline)
+        for i, poly in enumerate(polygons):
+            if not prepared_outline.contains_properly(poly):
+                polygons[i] = poly.intersection(outline)
+
+    return polygons
+
+
+def get_gadm_shape(onshore_locs, gadm_shapes, country):
+    """
+    Get the GADM shape containing each bus, by a spatial join.
+
+    When a bus is not within a single GADM shape, the closest shape of
+    the country is selected.
+
+    Parameters
+    ----------
+    onshore_locs : pd.DataFrame
+        Coordinates ["x", "y"] of the buses
+    gadm_shapes : GeoSeries
+        GADM shapes indexed by GADM_ID
+    country : str
+        Two letter code of the country of the buses
+
+    Returns
+    -------
+    regions : N - ndarray[dtype=Polygon|MultiPolygon]
+        GADM shape of each bus
+    ids : N - ndarray
+        GADM_ID of each bus
+    """
+    gadm_gdf = gpd.GeoDataFrame(
+        {"GADM_ID": gadm_shapes.index},
+        geometry=gadm_shapes.values,
+        crs=gadm_shapes.crs,
+    )
+    points = gpd.GeoDataFrame(
+        geometry=gpd.points_from_xy(onshore_locs["x"], onshore_locs["y"]),
+        index=numpy.arange(len(onshore_locs)),
+        crs=gadm_gdf.crs,
+    )
+
+    # buses within a single GADM shape
+    joined = gpd.sjoin(points, gadm_gdf, how="inner", predicate="within")
+    n_shapes = joined.index.value_counts()
+    joined = joined[joined.index.isin(n_shapes.index[n_shapes == 1])]
+    ids = pd.Series(joined["GADM_ID"], index=points.index)
+
+    # otherwise, the closest shape of the country is selected
+    missing = ids.isna()
+    if missing.any():
+        # TODO: returns closest shape if the point was not inside one.
+        # Works well but will not catch an outlier bus.
+        gadm_country = gadm_gdf[
+            gadm_gdf["GADM_ID"].str.contains(two_2_three_digits_country(country))
+        ]
+        with warnings.catch_warnings():
+            # distances are calculated in the crs of the shapes, as done so far
+            warnings.filterwarnings("ignore", message="Geometry is in a geographic CRS")
+            nearest = gpd.sjoin_nearest(points[missing], gadm_country, how="inner")
+        nearest = nearest[~nearest.index.duplicated(keep="first")]
+        ids[nearest.index] = nearest["GADM_ID"]
+
+    regions = gadm_shapes.reindex(ids.values).values
+    return regions, ids.values
+
+
+def voronoi_regions(locs, outline, cache_dir=None):
+    """
+    Compute the Voronoi cells of the buses clipped to the outline.
+
+    When cache_dir is given, the cells are cached in a file identified by the
+    bus coordinates, the outline and VORONOI_CACHE_VERSION, so that unchanged
+    countries are skipped on reruns.
+
+    Parameters
+    ----------
+    locs : pd.DataFrame
+        Coordinates ["x", "y"] of the buses
+    outline : Polygon|MultiPolygon
+    cache_dir : str
+        (optional) Folder of the cached cells
+
+    Returns
+    -------
+    polygons : N - ndarray[dtype=Polygon|MultiPolygon]
+    """
+    if cache_dir is not None:
+        key = hashlib.sha256(
+            f"v{VORONOI_CACHE_VERSION}".encode()
+            + pd.util.hash_pandas_object(locs[["x", "y"]]).values.tobytes()
+            + outline.wkb
+        ).hexdigest()[:32]
+        fn_cache = os.path.join(cache_dir, f"voronoi_{key}.parquet")
+        if os.path.exists(fn_cache):
+            polygons = read_geodata(fn_cache).geometry.values
+            if len(polygons) == len(locs):
+                return numpy.array(polygons, dtype=object)
+
+    polygons = custom_voronoi_partition_pts(locs.values, outline)
+
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        # write to a temporary file first, as other processes may read the cache
+        fn_tmp = f"{fn_cache}.{os.getpid()}.tmp.parquet"
+        save_geodata(gpd.GeoDataFrame(geometry=list(polygons)), fn_tmp)
+        os.replace(fn_tmp, fn_cache)
+
+    return polygons
+
+
+def build_country_regions(
+    country,
+    buses,
+    country_shapes,
+    offshore_shapes,
+    gadm_shapes,
+    alternative_clustering,
+    area_crs,
+    cache_dir=None,
+):
+    """
+    Build the onshore and offshore regions of the buses of a country.
+
+    Returns
+    -------
+    onshore_regions, offshore_regions : GeoDataFrame
+        Regions of the country; None when no region is available
+    """
+    c_b = buses.country == country
+    if buses.loc[c_b & buses.substation_lv, ["x", "y"]].empty:
+        _logger.warning(f"No low voltage buses found for {country}!")
+        return None, None
+
+    onshore_shape = country_shapes[country]
+    onshore_locs = buses.loc[c_b & buses.substation_lv, ["x", "y"]]
+    if alternative_clustering:
+        onshore_geometry, shape_id = get_gadm_shape(onshore_locs, gadm_shapes, country)
+    else:
+        onshore_geometry = voronoi_regions(onshore_locs, onshore_shape, cache_dir)
+        shape_id = 0  # Not used
+    onshore_regions = gpd.GeoDataFrame(
+        {
+            "name": onshore_locs.index,
+            "x": onshore_locs["x"],
+            "y": onshore_locs["y"],
+            "geometry": onshore_geometry,
+            "country": country,
+            "shape_id": shape_id,
+        },
+        crs=country_shapes.crs,
+    )
+
+    # These two logging could be commented out
+    if country not in offshore_shapes.index:
+        _logger.warning(f"No off-shore shapes for {country}")
+        return onshore_regions, None
+
+    offshore_shape = offshore_shapes[country]
+
+    if buses.loc[c_b & buses.substation_off, ["x", "y"]].empty:
+        _logger.warning(f"No off-shore substations found for {country}")
+        return onshore_regions, None
+
+    offshore_locs = buses.loc[c_b & buses.substation_off, ["x", "y"]]
+    shape_id = 0  # Not used
+    offshore_geometry = voronoi_regions(offshore_locs, offshore_shape, cache_dir)
+    offshore_regions = gpd.GeoDataFrame(
+        {
+            "name": offshore_locs.index,
+            "x": offshore_locs["x"],
+            "y": offshore_locs["y"],
+            "geometry": offshore_geometry,
+            "country": country,
+            "shape_id": shape_id,
+        },
+        crs=country_shapes.crs,
+    )
+    offshore_regions = offshore_regions.loc[
+        offshore_regions.to_crs(area_crs).area > 1e-2
+    ]
+
+    return onshore_regions, offshore_regions
+
+
+def _init_process_regions(
+    buses_,
+    country_shapes_,
+    offshore_shapes_,
+    gadm_shapes_,
+    alternative_clustering_,
+    area_crs_,
+    cache_dir_,
+):
+    global buses, country_shapes, offshore_shapes, gadm_shapes
+    global alternative_clustering, area_crs, cache_dir
+    buses, country_shapes, offshore_shapes, gadm_shapes = (
+        buses_,
+        country_shapes_,
+        offshore_shapes_,
+        gadm_shapes_,
+    )
+    alternative_clustering, area_crs, cache_dir = (
+        alternative_clustering_,
+        area_crs_,
+        cache_dir_,
+    )
+
+
+def _process_func_regions(country):
+    return build_country_regions(
+        country,
+        buses,
+        country_shapes,
+        offshore_shapes,
+        gadm_shapes,
+        alternative_clustering,
+        area_crs,
+        cache_dir,
+    )
 
 
 if __name__ == "__main__":
@@ -204,71 +440,39 @@ if __name__ == "__main__":
         "geometry"
     ]
 
-    onshore_regions = []
-    offshore_regions = []
-
-    for country in countries:
-
-        c_b = n.buses.country == country
-        if n.buses.loc[c_b & n.buses.substation_lv, ["x", "y"]].empty:
-            _logger.warning(f"No low voltage buses found for {country}!")
-            continue
-
-        onshore_shape = country_shapes[country]
-        onshore_locs = n.buses.loc[c_b & n.buses.substation_lv, ["x", "y"]]
-        if snakemake.config["cluster_options"]["alternative_clustering"]:
-            onshore_geometry = get_gadm_shape(onshore_locs, gadm_shapes)[0]
-            shape_id = get_gadm_shape(onshore_locs, gadm_shapes)[1]
-        else:
-            onshore_geometry = custom_voronoi_partition_pts(
-                onshore_locs.values, onshore_shape
-            )
-            shape_id = 0  # Not used
-        onshore_regions.append(
-            gpd.GeoDataFrame(
-                {
-                    "name": onshore_locs.index,
-                    "x": onshore_locs["x"],
-                    "y": onshore_locs["y"],
-                    "geometry": onshore_geometry,
-                    "country": country,
-                    "shape_id": shape_id,
-                },
-                crs=country_shapes.crs,
-            )
-        )
+    buses = n.buses[["x", "y", "country", "substation_lv", "substation_off"]]
+    alternative_clustering = snakemake.config["cluster_options"][
+        "alternative_clustering"
+    ]
+    nprocesses = snakemake.config.get("build_bus_regions_nprocesses", 1)
+    cache_dir = (
+        BUS_REGIONS_CACHE_DIR
+        if snakemake.config.get("build_bus_regions_cache", False)
+        else None
+    )
 
-        # These two logging could be commented out
-        if country not in offshore_shapes.index:
-            _logger.warning(f"No off-shore shapes for {country}")
-            continue
-
-        offshore_shape = offshore_shapes[country]
-
-        if n.buses.loc[c_b & n.buses.substation_off, ["x", "y"]].empty:
-            _logger.warning(f"No off-shore substations found for {country}")
-            continue
-        else:
-            offshore_locs = n.buses.loc[c_b & n.buses.substation_off, ["x", "y"]]
-            shape_id = 0  # Not used
-            offshore_geometry = custom_voronoi_partition_pts(
-                offshore_locs.values, offshore_shape
-            )
-            offshore_regions_c = gpd.GeoDataFrame(
-                {
-                    "name": offshore_locs.index,
-                    "x": offshore_locs["x"],
-                    "y": offshore_locs["y"],
-                    "geometry": offshore_geometry,
-                    "country": country,
-                    "shape_id": shape_id,
-                },
-                crs=country_shapes.crs,
-            )
-            offshore_regions_c = offshore_regions_c.loc[
-                offshore_regions_c.to_crs(area_crs).area > 1e-2
-            ]
-            offshore_regions.append(offshore_regions_c)
+    args = (
+        buses,
+        country_shapes,
+        offshore_shapes,
+        gadm_shapes,
+        alternative_clustering,
+        area_crs,
+        cache_dir,
+    )
+    if (nprocesses is None) or (nprocesses == 1):
+        country_regions = [build_country_regions(c, *args) for c in countries]
+    else:
+        kwargs = {
+            "initializer": _init_process_regions,
+            "initargs": args,
+            "processes": nprocesses,
+        }
+        with mp.get_context("spawn").Pool(**kwargs) as pool:
+            country_regions = pool.map(_process_func_regions, countries)
+
+    onshore_regions = [r[0] for r in country_regions if r[0] is not None]
+    offshore_regions = [r[1] for r in country_regions if r[1] is not None]
 
     # create geodataframe and remove nan shapes
     onshore_regions = gpd.GeoDataFrame(
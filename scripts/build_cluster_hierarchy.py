@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+# SPDX-FileCopyrightText: : 2021 PyPSA-Africa Authors
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+# coding: utf-8
+"""
+Cuts the busmaps of all configured ``{clusters}`` resolutions from one hierarchical clustering tree per country.
+
+Relevant Settings
+-----------------
+
+.. code:: yaml
+
+    scenario:
+        clusters:
+
+    cluster_options:
+        distribute_cluster:
+        algorithm:
+        nprocesses:
+        hierarchy_cache:
+
+    focus_weights:
+
+.. seealso::
+    Documentation of the configuration file ``config.yaml`` at
+    :ref:`toplevel_cf`
+
+Inputs
+------
+
+- ``networks/elec_s{simpl}.nc``: confer :ref:`simplify`
+- ``resources/shapes/gadm_shapes.geojson``: confer :ref:`shapes`, used when the clusters are distributed by population or gdp
+
+Outputs
+-------
+
+- ``resources/cluster_hierarchy/busmaps_elec_s{simpl}.csv``: Mapping of the buses of ``networks/elec_s{simpl}.nc`` to the clusters, with one column per resolution
+
+Description
+-----------
+
+The rule is only used when ``algorithm`` is "hierarchical" and ``hierarchy_cache``
+is enabled. The topology of the network, the tree of each country and the
+distribution of the clusters among the countries are then computed once for
+all the resolutions of ``scenario: clusters``, and :mod:`cluster_network` only
+aggregates the network with the busmap of its resolution. Resolutions which
+are not listed in the configuration are clustered by :mod:`cluster_network`
+itself.
+"""
+import logging
+import os
+
+import pandas as pd
+import pypsa
+from _helpers import configure_logging, sets_path_to_root
+from cluster_network import busmap_for_n_clusters
+
+logger = logging.getLogger(__name__)
+
+
+if __name__ == "__main__":
+    if "snakemake" not in globals():
+        from _helpers import mock_snakemake
+
+        os.chdir(os.path.dirname(os.path.abspath(__file__)))
+        snakemake = mock_snakemake("build_cluster_hierarchy", network="elec", simpl="")
+        sets_path_to_root("pypsa-africa")
+    configure_logging(snakemake)
+
+    n = pypsa.Network(snakemake.input.network)
+
+    cluster_options = snakemake.config["cluster_options"]
+
+    # resolutions of the clusters wildcard which require a clustering
+    n_clusters = sorted(
+        {
+            int(str(c).rstrip("m"))
+            for c in snakemake.config["scenario"]["clusters"]
+            if str(c).rstrip("m").isdigit()
+        }
+    )
+    n_clusters = [k for k in n_clusters if k < len(n.buses)]
+    logger.info(f"Cutting the busmaps for {n_clusters} clusters")
+
+    if n_clusters:
+        busmaps = busmap_for_n_clusters(
+            n,
+            n_clusters,
+            snakemake.config["solving"]["solver"]["name"],
+            focus_weights=snakemake.config.get("focus_weights", None),
+            algorithm="hierarchical",
+            nprocesses=cluster_options.get("nprocesses"),
+            distribution_cluster=cluster_options["distribute_cluster"],
+            gadm_shapes=snakemake.input.gadm_shapes,
+        )
+    else:
+        busmaps = pd.DataFrame(index=n.buses.index)
+
+    busmaps.index.name = "Bus"
+    busmaps.to_csv(snakemake.output.busmaps)
@@ -50,14 +50,19 @@ Steps to retrieve the protected area data (as apparently no API is given for the
 Tip: The output file `natura.tiff` contains now the 100x100m rasters of protective areas. This operation can make the filesize of that TIFF quite large and leads to problems when trying to open. QGIS, an open source tool helps exploring the file.
 """
 import logging
+import multiprocessing as mp
 import os
 
 import atlite
 import geopandas as gpd
+import numpy as np
+import pandas as pd
 import rasterio as rio
 from _helpers import configure_logging
-from rasterio.features import geometry_mask
+from rasterio.features import rasterize
 from rasterio.warp import transform_bounds
+from rasterio.windows import Window
+from tqdm import tqdm
 
 _logger = logging.getLogger(__name__)
 _logger.setLevel(logging.INFO)
@@ -106,55 +111,158 @@ def get_transform_and_shape(bounds, res, out_logging):
     return transform, shape
 
 
-def unify_protected_shape_areas(inputs, area_crs, out_logging):
+def read_protected_shape_areas(inputs, cutout_bounds, area_crs, out_logging):
     """
-    Iterates thorugh all snakemake rule inputs and unifies shapefiles (.shp) only.
+    Reads the shapefiles (.shp) of the snakemake rule inputs, each one once.
 
-    The input is given in the Snakefile and shapefiles are given by .shp
+    Only the shapes intersecting the cutout bounds are read.
 
+    Parameters
+    ----------
+    inputs : list
+        Paths of the shapefiles
+    cutout_bounds : list
+        Bounds of the cutouts [x, y, X, Y] in the CUTOUT_CRS
+    area_crs : str
+        Crs of the returned shapes
 
     Returns
     -------
-    unified_shape : GeoDataFrame with a unified "multishape"
+    shapes : GeoSeries with the valid protected shapes
 
     """
-    import pandas as pd
-    from shapely.ops import unary_union
+    from shapely.geometry import box
 
     if out_logging:
-        _logger.info("Stage 3/5: Unify protected shape area.")
+        _logger.info("Stage 3/5: Read protected shape areas")
 
     # Read only .shp snakemake inputs
     shp_files = [string for string in inputs if ".shp" in string]
     assert len(shp_files) != 0, "no input shapefiles given"
-    # Create one geodataframe with all geometries, of all .shp files
-    if out_logging:
-        _logger.info(
-            "Stage 3/5: Unify protected shape area. Step 1: Create one geodataframe with all shapes"
-        )
-    for i in shp_files:
-        shape = gpd.GeoDataFrame(
-            pd.concat([gpd.read_file(i) for i in shp_files])
-        ).to_crs(area_crs)
-
-    # Removes shapely geometry with null values. Returns geoseries.
-    shape = shape["geometry"][shape["geometry"].is_valid]
-
-    # Create Geodataframe with crs
-    shape = gpd.GeoDataFrame(shape, crs=area_crs)
-    shape = shape.rename(columns={0: "geometry"}).set_geometry("geometry")
-
-    # Unary_union makes out of i.e. 1000 shapes -> 1 unified shape
-    if out_logging:
-        _logger.info("Stage 3/5: Unify protected shape area. Step 2: Unify all shapes")
-    unified_shape_file = unary_union(shape["geometry"])
+
+    # bounding box to filter the shapes while reading the files
+    bbox = gpd.GeoSeries([box(*cutout_bounds)], crs=CUTOUT_CRS)
+
+    shapes = []
+    for shp_file in shp_files:
+        if out_logging:
+            _logger.info(f"Stage 3/5: Read {shp_file}")
+        shape = gpd.read_file(shp_file, bbox=bbox)["geometry"]
+
+        # Removes shapely geometry with null values
+        shapes.append(shape[shape.is_valid].to_crs(area_crs))
+
+    shapes = gpd.GeoSeries(pd.concat(shapes, ignore_index=True), crs=area_crs)
+
+    return shapes
+
+
+def _init_process_tile(geoms_, bounds_, transform_):
+    global _tile_geoms, _tile_bounds, _tile_transform
+    _tile_geoms, _tile_bounds, _tile_transform = geoms_, bounds_, transform_
+
+
+def _process_func_tile(window):
+    left, bottom, right, top = rio.windows.bounds(window, _tile_transform)
+
+    # shapes overlapping the tile
+    in_tile = (
+        (_tile_bounds[:, 0] <= right)
+        & (_tile_bounds[:, 2] >= left)
+        & (_tile_bounds[:, 1] <= top)
+        & (_tile_bounds[:, 3] >= bottom)
+    )
+
+    if not in_tile.any():
+        return window, None
+
+    tile = rasterize(
+        _tile_geoms[in_tile],
+        out_shape=(window.height, window.width),
+        transform=rio.windows.transform(window, _tile_transform),
+        fill=0,
+        default_value=1,
+        dtype=rio.uint8,
+    )
+
+    return window, tile
+
+
+def rasterize_protected_shape_areas(
+    shapes, transform, out_shape, fn, out_logging, tile_size=4096, nprocesses=None
+):
+    """
+    Burns the protected shapes into the raster fn, tile by tile.
+
+    The shapes are not unified: every shape is burnt directly in the tiles
+    it overlaps; the tiles are processed in parallel when nprocesses > 1.
+
+    Parameters
+    ----------
+    shapes : GeoSeries
+        Protected shapes in the crs of the raster
+    transform : Affine
+        Transform of the raster
+    out_shape : tuple
+        (height, width) of the raster
+    fn : str
+        Path of the output raster
+    tile_size : int
+        Number of rows and columns of the tiles
+    nprocesses : int
+        Number of processes used to rasterize the tiles
+    """
     if out_logging:
-        _logger.info(
-            "Stage 3/5: Unify protected shape area. Step 3: Set geometry of unified shape"
-        )
-    unified_shape = gpd.GeoDataFrame(geometry=[unified_shape_file], crs=area_crs)
+        _logger.info("Stage 4/5: Rasterize protected shape areas")
+
+    height, width = out_shape
+    windows = [
+        Window(col, row, min(tile_size, width - col), min(tile_size, height - row))
+        for row in range(0, height, tile_size)
+        for col in range(0, width, tile_size)
+    ]
 
-    return unified_shape
+    geoms = np.asarray(shapes.values, dtype=object)
+    bounds = shapes.bounds.values
+
+    with rio.open(
+        fn,
+        "w",
+        driver="GTiff",
+        dtype=rio.uint8,
+        count=1,
+        transform=transform,
+        crs=shapes.crs,
+        compress="lzw",
+        tiled=True,
+        blockxsize=512,
+        blockysize=512,
+        width=width,
+        height=height,
+    ) as dst:
+
+        if (nprocesses is None) or (nprocesses == 1):
+            _init_process_tile(geoms, bounds, transform)
+            tiles = map(_process_func_tile, windows)
+            pool = None
+        else:
+            pool = mp.get_context("spawn").Pool(
+                processes=nprocesses,
+                initializer=_init_process_tile,
+                initargs=(geoms, bounds, transform),
+            )
+            tiles = pool.imap_unordered(_process_func_tile, windows)
+
+        for window, tile in tqdm(
+            tiles, total=len(windows), ascii=False, unit=" tiles", desc="Tiles "
+        ):
+            if tile is None:
+                tile = np.zeros((window.height, window.width), dtype=rio.uint8)
+            dst.write(tile, indexes=1, window=window)
+
+        if pool is not None:
+            pool.close()
+            pool.join()
 
 
 if __name__ == "__main__":
@@ -167,6 +275,7 @@ if __name__ == "__main__":
 
     # get crs
     area_crs = snakemake.config["crs"]["area_crs"]
+    nprocesses = snakemake.config["atlite"].get("nprocesses")
 
     out_logging = True
     inputs = snakemake.input
@@ -180,25 +289,21 @@ if __name__ == "__main__":
         bounds, res=100, out_logging=out_logging
     )
     # adjusted boundaries
-    shapes = unify_protected_shape_areas(shapefiles, area_crs, out_logging=out_logging)
+    shapes = read_protected_shape_areas(
+        shapefiles,
+        [min(xs), min(ys), max(Xs), max(Ys)],
+        area_crs,
+        out_logging=out_logging,
+    )
 
-    if out_logging:
-        _logger.info("Stage 4/5: Mask geometry")
-    raster = ~geometry_mask(shapes.geometry, out_shape[::-1], transform)
-    raster = raster.astype(rio.uint8)
+    rasterize_protected_shape_areas(
+        shapes,
+        transform,
+        out_shape,
+        snakemake.output[0],
+        out_logging=out_logging,
+        nprocesses=nprocesses,
+    )
 
     if out_logging:
-        _logger.info("Stage 5/5: Export as .tiff")
-    with rio.open(
-        snakemake.output[0],
-        "w",
-        driver="GTiff",
-        dtype=rio.uint8,
-        count=1,
-        transform=transform,
-        crs=area_crs,
-        compress="lzw",
-        width=raster.shape[1],
-        height=raster.shape[0],
-    ) as dst:
-        dst.write(raster, indexes=1)
+        _logger.info("Stage 5/5: Raster exported as .tiff")
@@ -8,10 +8,10 @@ import os
 import geopandas as gpd
 import numpy as np
 import pandas as pd
-from _helpers import configure_logging, read_geojson, sets_path_to_root, to_csv_nafix
-from shapely.geometry import LineString, Point
-from shapely.ops import linemerge, split
-from tqdm import tqdm
+from _helpers import configure_logging, read_geodata, sets_path_to_root, to_csv_nafix
+from scipy.spatial import cKDTree as KDTree
+import shapely
+from shapely.geometry import LineString, Point, box
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -119,75 +119,69 @@ def set_substations_ids(buses, distance_crs, tol=2000):
         2. when all the substations in tolerance have substation_id < 0, then specify a new substation_id
         3. otherwise, if one of the substation in tolerance has a substation_id >= 0, then set that substation_id to all the others;
            in case of multiple substations with substation_ids >= 0, the first value is picked for all
-    """
 
-    buses["station_id"] = -1
+    The substations within tolerance of all the buses are obtained by a single
+    radius query on a KD-tree of the coordinates projected in distance_crs.
+    Note that chains of buses within tolerance are not merged transitively:
+    the result depends on the order of the buses, as described above.
+    """
 
     # create temporary series to execute distance calculations using m as reference distances
     temp_bus_geom = buses.geometry.to_crs(distance_crs)
+    coords = np.column_stack([temp_bus_geom.x.values, temp_bus_geom.y.values])
+    n_buses = coords.shape[0]
 
-    # set tqdm options for substation ids
-    tqdm_kwargs_substation_ids = dict(
-        ascii=False,
-        unit=" buses",
-        total=buses.shape[0],
-        desc="Set substation ids ",
+    station_ids = np.full(n_buses, -1)
+    if n_buses == 0:
+        buses["station_id"] = station_ids
+        return
+
+    # substations within tolerance of every bus, sorted by position
+    close_nodes_list = KDTree(coords).query_ball_point(
+        coords, r=tol, return_sorted=True
     )
 
     station_id = 0
-    for i, row in tqdm(buses.iterrows(), **tqdm_kwargs_substation_ids):
-        if buses.loc[i, "station_id"] >= 0:
+    for i, close_nodes in enumerate(close_nodes_list):
+        if station_ids[i] >= 0:
             continue
 
-        # get substations within tolerance
-        close_nodes = np.flatnonzero(
-            temp_bus_geom.distance(temp_bus_geom.loc[i]) <= tol
-        )
-
         if len(close_nodes) == 1:
-            # if only one substation is in tolerance, then the substation is the current one iì
-            # Note that the node cannot be with substation_id >= 0, given the preliminary check
-            # at the beginning of the for loop
-            buses.loc[buses.index[i], "station_id"] = station_id
-            # update station id
+            # if only one substation is in tolerance, then the substation is the current one
+            station_ids[i] = station_id
+            station_id += 1
+            continue
+
+        # several substations in tolerance
+        subset_substation_ids = station_ids[close_nodes]
+        assigned_ids = subset_substation_ids[subset_substation_ids >= 0]
+        if len(assigned_ids) == 0:
+            # when all substation_ids are negative, then this is a new substation id
+            station_ids[close_nodes] = station_id
             station_id += 1
         else:
-            # several substations in tolerance
-            # get their ids
-            subset_substation_ids = buses.loc[buses.index[close_nodes], "station_id"]
-            # check if all substation_ids are negative (<0)
-            all_neg = subset_substation_ids.max() < 0
-            # check if at least a substation_id is negative (<0)
-            some_neg = subset_substation_ids.min() < 0
-
-            if all_neg:
-                # when all substation_ids are negative, then this is a new substation id
-                # set the current station_id and increment the counter
-                buses.loc[buses.index[close_nodes], "station_id"] = station_id
-                station_id += 1
-            elif some_neg:
-                # otherwise, when at least a substation_id is non-negative, then pick the first value
-                # and set it to all the other substations within tolerance
-                sub_id = -1
-                for substation_id in subset_substation_ids:
-                    if substation_id >= 0:
-                        sub_id = substation_id
-                        break
-                buses.loc[buses.index[close_nodes], "station_id"] = sub_id
+            # otherwise, pick the first non-negative value
+            # and set it to all the other substations within tolerance
+            station_ids[close_nodes] = assigned_ids[0]
+
+    buses["station_id"] = station_ids
+
+    logger.info(
+        f"Grouped {n_buses} buses into {len(np.unique(station_ids))} substations "
+        f"with tolerance {tol} m"
+    )
 
 
 def set_lines_ids(lines, buses, distance_crs):
     """
     Function to set line buses ids to the closest bus in the list
-    """
-    # set tqdm options for set lines ids
-    tqdm_kwargs_line_ids = dict(
-        ascii=False,
-        unit=" lines",
-        total=lines.shape[0],
-        desc="Set line bus ids ",
-    )
 
+    Lines are grouped by voltage level and polarity (AC/DC); for every group
+    a nearest-neighbour index of the compatible buses is built once and all
+    the line endings are queried in a single call.
+    Line geometries that do not start or end exactly at the selected bus
+    are extended to the bus location.
+    """
     # initialization
     lines["bus0"] = -1
     lines["bus1"] = -1
@@ -195,58 +189,69 @@ def set_lines_ids(lines, buses, distance_crs):
     busesepsg = buses.to_crs(distance_crs)
     linesepsg = lines.to_crs(distance_crs)
 
-    for i, row in tqdm(linesepsg.iterrows(), **tqdm_kwargs_line_ids):
+    # coordinates of the line endings in the distance crs
+    boundaries_epsg = linesepsg.geometry.boundary
+    start_epsg = np.array([[b.geoms[0].x, b.geoms[0].y] for b in boundaries_epsg])
+    end_epsg = np.array([[b.geoms[1].x, b.geoms[1].y] for b in boundaries_epsg])
 
-        row["dc"] = float(row["tag_frequency"]) == 0
+    buses_xy = np.column_stack([busesepsg.geometry.x, busesepsg.geometry.y])
 
-        # select buses having the voltage level of the current line
-        buses_sel = busesepsg[
-            (buses["voltage"] == row["voltage"]) & (buses["dc"] == row["dc"])
-        ]
+    lines_dc = lines["tag_frequency"].astype(float) == 0
 
-        # find the closest node of the bus0 of the line
-        bus0_id = buses_sel.geometry.distance(row.geometry.boundary.geoms[0]).idxmin()
-        lines.loc[i, "bus0"] = buses.loc[bus0_id, "bus_id"]
+    # positional index of the closest bus to the line endings
+    bus0_pos = np.full(len(lines), -1)
+    bus1_pos = np.full(len(lines), -1)
+    distance_bus0 = np.zeros(len(lines))
+    distance_bus1 = np.zeros(len(lines))
 
-        # check if the line starts exactly in the node, otherwise modify the linestring
-        distance_bus0 = busesepsg.geometry.loc[bus0_id].distance(
-            row.geometry.boundary.geoms[0]
+    for (voltage, dc), lines_group in lines.groupby([lines["voltage"], lines_dc]):
+
+        # select buses having the voltage level and polarity of the lines
+        buses_sel_pos = np.flatnonzero(
+            ((buses["voltage"] == voltage) & (buses["dc"] == dc)).values
         )
-        if distance_bus0 > 0.0:
-            # the line does not start in the node, thus modify the linestring
-            lines.geometry.loc[i] = linemerge(
-                [
-                    LineString(
-                        [
-                            buses.geometry.loc[bus0_id],
-                            lines.geometry.loc[i].boundary.geoms[0],
-                        ]
-                    ),
-                    lines.geometry.loc[i],
-                ]
+        if len(buses_sel_pos) == 0:
+            logger.warning(
+                f"No bus with voltage {voltage} and dc {dc}: "
+                f"{len(lines_group)} line endings left unassigned"
             )
+            continue
+
+        lines_pos = lines.index.get_indexer(lines_group.index)
 
-        # find the closest node of the bus1 of the line
-        bus1_id = buses_sel.geometry.distance(row.geometry.boundary.geoms[1]).idxmin()
-        lines.loc[i, "bus1"] = buses.loc[bus1_id, "bus_id"]
+        tree = KDTree(buses_xy[buses_sel_pos])
 
-        # check if the line ends exactly in the node, otherwise modify the linestring
-        distance_bus1 = busesepsg.geometry.loc[bus1_id].distance(
-            row.geometry.boundary.geoms[1]
+        # find the closest nodes of the line endings
+        dist0, near0 = tree.query(start_epsg[lines_pos])
+        dist1, near1 = tree.query(end_epsg[lines_pos])
+
+        bus0_pos[lines_pos] = buses_sel_pos[near0]
+        bus1_pos[lines_pos] = buses_sel_pos[near1]
+        distance_bus0[lines_pos] = dist0
+        distance_bus1[lines_pos] = dist1
+
+    assigned = bus0_pos >= 0
+    lines.loc[assigned, "bus0"] = buses["bus_id"].values[bus0_pos[assigned]]
+    lines.loc[assigned, "bus1"] = buses["bus_id"].values[bus1_pos[assigned]]
+
+    # extend the linestrings that do not start or end exactly in the node
+    to_extend = np.flatnonzero(
+        assigned & ((distance_bus0 > 0.0) | (distance_bus1 > 0.0))
+    )
+    if len(to_extend) > 0:
+        buses_geo = buses.geometry.values
+        new_geometries = []
+        for pos in to_extend:
+            coords = list(lines.geometry.iloc[pos].coords)
+            if distance_bus0[pos] > 0.0:
+                coords.insert(0, buses_geo[bus0_pos[pos]].coords[0])
+            if distance_bus1[pos] > 0.0:
+                coords.append(buses_geo[bus1_pos[pos]].coords[0])
+            new_geometries.append(LineString(coords))
+
+        lines.loc[lines.index[to_extend], "geometry"] = gpd.GeoSeries(
+            new_geometries, index=lines.index[to_extend], crs=lines.crs
         )
-        if distance_bus1 > 0.0:
-            # the line does not end in the node, thus modify the linestring
-            lines.geometry.loc[i] = linemerge(
-                [
-                    lines.geometry.loc[i],
-                    LineString(
-                        [
-                            lines.geometry.loc[i].boundary.geoms[1],
-                            buses.geometry.loc[bus1_id],
-                        ]
-                    ),
-                ]
-            )
 
     return lines, buses
 
@@ -659,32 +664,99 @@ def create_station_at_equal_bus_locations(
     return lines, buses
 
 
-def _split_linestring_by_point(linestring, points):
+def _split_linestrings_by_points(linestrings, points, line_pos):
     """
-    Function to split a linestring geometry by multiple inner points
+    Function to split multiple linestrings by their inner points at once
+
+    Each linestring is cut at the sorted positions of its points along the
+    line, hence it returns the same pieces as splitting the linestring
+    point by point with ``shapely.ops.split``. Points that do not lie on the
+    interior of their linestring are ignored, as by ``shapely.ops.split``.
 
     Parameters
     ----------
-    lstring : LineString
-        Linestring of the line to be splitted
-    points : list
-        List of points to split the linestring
+    linestrings : array of LineString
+        Linestrings of the lines to be splitted
+    points : array of Point
+        Points to split the linestrings
+    line_pos : array of int
+        Position in linestrings of the line to split by each point
 
     Return
     ------
-    list_lines : list
-        List of linestring to split the line
+    geometries : array of LineString
+        Pieces of the linestrings, ordered by linestring and along the line
+    n_geoms : array of int
+        Number of pieces of each linestring
     """
+    linestrings = np.asarray(linestrings, dtype=object)
+    points = np.asarray(points, dtype=object)
+    line_pos = np.asarray(line_pos, dtype=int)
+
+    # only points on the interior of the line split it
+    on_line = shapely.relate_pattern(linestrings[line_pos], points, "0********")
+    points, line_pos = points[on_line], line_pos[on_line]
+
+    # cuts sorted along each line; a point splits its line only once
+    cut_dist = shapely.line_locate_point(linestrings[line_pos], points)
+    cut_xy = shapely.get_coordinates(points)
+    order = np.lexsort((cut_dist, line_pos))
+    cut_line, cut_dist, cut_xy = line_pos[order], cut_dist[order], cut_xy[order]
+    unique = np.ones(len(cut_line), dtype=bool)
+    unique[1:] = (cut_line[1:] != cut_line[:-1]) | (cut_dist[1:] != cut_dist[:-1])
+    cut_line, cut_dist, cut_xy = cut_line[unique], cut_dist[unique], cut_xy[unique]
+
+    n_cuts = np.bincount(cut_line, minlength=len(linestrings))
+    first_cut = np.cumsum(n_cuts) - n_cuts
+    cut_rank = np.arange(len(cut_line)) - first_cut[cut_line]
+
+    # vertices of the lines and their position along the line
+    vertex_xy, vertex_line = shapely.get_coordinates(linestrings, return_index=True)
+    vertex_dist = shapely.line_locate_point(
+        linestrings[vertex_line], shapely.points(vertex_xy)
+    )
+    vertex_order = np.arange(len(vertex_line))
+
+    # piece of each vertex, as the number of cuts before it along the line:
+    # vertices and cuts are sorted together, vertices first at equal position
+    event_line = np.concatenate([vertex_line, cut_line])
+    event_dist = np.concatenate([vertex_dist, cut_dist])
+    is_cut = np.concatenate(
+        [np.zeros(len(vertex_line), dtype=bool), np.ones(len(cut_line), dtype=bool)]
+    )
+    order = np.lexsort((is_cut, event_dist, event_line))
+    cuts_before = np.empty(len(order), dtype=int)
+    cuts_before[order] = np.cumsum(is_cut[order]) - is_cut[order]
+    next_cut = cuts_before[: len(vertex_line)]
+    vertex_piece = next_cut - first_cut[vertex_line]
+    # a vertex at a cut is replaced by the cut point
+    at_cut = next_cut < len(cut_line)
+    at_cut[at_cut] = (cut_line[next_cut[at_cut]] == vertex_line[at_cut]) & (
+        cut_dist[next_cut[at_cut]] == vertex_dist[at_cut]
+    )
+    keep = ~at_cut
+
+    # a cut ends its piece and starts the next one
+    line_ids = np.concatenate([vertex_line[keep], cut_line, cut_line])
+    piece_ids = np.concatenate([vertex_piece[keep], cut_rank, cut_rank + 1])
+    part = np.concatenate(
+        [
+            np.ones(keep.sum(), dtype=int),
+            np.full(len(cut_line), 2),
+            np.zeros(len(cut_line), dtype=int),
+        ]
+    )
+    sub_order = np.concatenate(
+        [vertex_order[keep], np.zeros(2 * len(cut_line), dtype=int)]
+    )
+    xy = np.concatenate([vertex_xy[keep], cut_xy, cut_xy])
 
-    list_linestrings = [linestring]
-
-    for p in points:
-        # execute split to all lines and store results
-        temp_list = [split(l, p) for l in list_linestrings]
-        # nest all geometries
-        list_linestrings = [lstring for tval in temp_list for lstring in tval.geoms]
+    order = np.lexsort((sub_order, part, piece_ids, line_ids))
+    n_geoms = n_cuts + 1
+    geom_index = (np.cumsum(n_geoms) - n_geoms)[line_ids] + piece_ids
+    geometries = shapely.linestrings(xy[order], indices=geom_index[order])
 
-    return list_linestrings
+    return geometries, n_geoms
 
 
 def fix_overpassing_lines(lines, buses, distance_crs, tol=1):
@@ -692,6 +764,11 @@ def fix_overpassing_lines(lines, buses, distance_crs, tol=1):
     Function to avoid buses overpassing lines with no connection
     when the bus is within a given tolerance from the line
 
+    Candidate buses are selected by a spatial join against the bounding boxes
+    of the lines enlarged by the tolerance; the exact distance check is then
+    performed only on the candidate (bus, line) pairs. All the lines are then
+    splitted at once by the buses lying on them.
+
     Parameters
     ----------
     lines : GeoDataFrame
@@ -703,69 +780,76 @@ def fix_overpassing_lines(lines, buses, distance_crs, tol=1):
         below which the line will be splitted
     """
 
-    lines_to_add = []  # list of lines to be added
-    lines_to_split = []  # list of lines that have been splitted
-
-    lines_epsgmod = lines.to_crs(distance_crs)
-    buses_epsgmod = buses.to_crs(distance_crs)
-
-    # set tqdm options for substation ids
-    tqdm_kwargs_substation_ids = dict(
-        ascii=False,
-        unit=" lines",
-        total=lines.shape[0],
-        desc="Verify lines overpassing nodes ",
+    lines_epsgmod = lines.to_crs(distance_crs).geometry.reset_index(drop=True)
+    buses_epsgmod = buses.to_crs(distance_crs).geometry.reset_index(drop=True)
+
+    # bounding boxes of the lines enlarged by the tolerance
+    lines_bounds = lines_epsgmod.bounds
+    lines_boxes = gpd.GeoDataFrame(
+        geometry=[
+            box(minx - tol, miny - tol, maxx + tol, maxy + tol)
+            for minx, miny, maxx, maxy in lines_bounds.itertuples(index=False)
+        ],
+        crs=distance_crs,
     )
 
-    for l in tqdm(lines.index, **tqdm_kwargs_substation_ids):
-
-        # bus indices being within tolerance from the line
-        bus_in_tol_epsg = buses_epsgmod[
-            buses_epsgmod.geometry.distance(lines_epsgmod.geometry.loc[l]) <= tol
-        ]
-
-        # exclude endings of the lines
-        bus_in_tol_epsg = bus_in_tol_epsg[
-            (
-                (
-                    bus_in_tol_epsg.geometry.distance(
-                        lines_epsgmod.geometry.loc[l].boundary.geoms[0]
-                    )
-                    > tol
-                )
-                | (
-                    bus_in_tol_epsg.geometry.distance(
-                        lines_epsgmod.geometry.loc[l].boundary.geoms[1]
-                    )
-                    > tol
-                )
-            )
-        ]
-
-        if not bus_in_tol_epsg.empty:
-            # add index of line to split
-            lines_to_split.append(l)
-
-            buses_locs = buses.geometry.loc[bus_in_tol_epsg.index]
-
-            # get new line geometries
-            new_geometries = _split_linestring_by_point(lines.geometry[l], buses_locs)
-            n_geoms = len(new_geometries)
+    # candidate pairs of buses and lines
+    candidates = gpd.sjoin(
+        gpd.GeoDataFrame(geometry=buses_epsgmod, crs=distance_crs),
+        lines_boxes,
+        how="inner",
+        predicate="intersects",
+    )
+    bus_pos = candidates.index.values
+    line_pos = candidates["index_right"].values
 
-            # create temporary copies of the line
-            df_append = gpd.GeoDataFrame([lines.loc[l]] * n_geoms)
-            # update geometries
-            df_append["geometry"] = new_geometries
-            # update name of the line
-            df_append["line_id"] = [
-                str(df_append["line_id"].iloc[0]) + f"_{id}" for id in range(n_geoms)
-            ]
+    # exact check: buses within tolerance from the line
+    def _pairwise_distance(geoms_a, geoms_b):
+        return gpd.GeoSeries(geoms_a.values[bus_pos], crs=distance_crs).distance(
+            gpd.GeoSeries(geoms_b.values[line_pos], crs=distance_crs)
+        )
 
-            lines_to_add.append(df_append)
+    in_tol = (_pairwise_distance(buses_epsgmod, lines_epsgmod) <= tol).values
+    bus_pos, line_pos = bus_pos[in_tol], line_pos[in_tol]
+
+    # exclude endings of the lines
+    boundaries = lines_epsgmod.boundary
+    lines_start = gpd.GeoSeries([b.geoms[0] for b in boundaries], crs=distance_crs)
+    lines_end = gpd.GeoSeries([b.geoms[1] for b in boundaries], crs=distance_crs)
+    not_ending = (
+        (_pairwise_distance(buses_epsgmod, lines_start) > tol)
+        | (_pairwise_distance(buses_epsgmod, lines_end) > tol)
+    ).values
+    bus_pos, line_pos = bus_pos[not_ending], line_pos[not_ending]
+
+    if len(line_pos) == 0:
+        return lines, buses
+
+    # sort the pairs by line
+    order = np.lexsort((bus_pos, line_pos))
+    bus_pos, line_pos = bus_pos[order], line_pos[order]
+    lines_to_split = np.unique(line_pos)
+
+    logger.info(f"Splitting {len(lines_to_split)} lines overpassing buses")
+
+    # get new line geometries of all the lines at once
+    new_geometries, n_geoms = _split_linestrings_by_points(
+        lines.geometry.values[lines_to_split],
+        buses.geometry.values[bus_pos],
+        np.searchsorted(lines_to_split, line_pos),
+    )
 
-    df_to_add = gpd.GeoDataFrame(pd.concat(lines_to_add, ignore_index=True))
-    df_to_add.set_crs(lines.crs, inplace=True)
-    df_to_add.set_index(lines.index[-1] + df_to_add.index, inplace=True)
+    # create the copies of the splitted lines all at once
+    df_to_add = lines.iloc[np.repeat(lines_to_split, n_geoms)].reset_index(drop=True)
+    # update geometries
+    df_to_add["geometry"] = gpd.GeoSeries(new_geometries, crs=lines.crs)
+    # update name of the line
+    df_to_add["line_id"] = [
+        f"{line_id}_{id}"
+        for line_id, n in zip(lines["line_id"].iloc[lines_to_split], n_geoms)
+        for id in range(n)
+    ]
+    df_to_add = gpd.GeoDataFrame(df_to_add, crs=lines.crs)
 
     # update length
     df_to_add["length"] = df_to_add.to_crs(distance_crs).geometry.length
@@ -774,7 +858,7 @@ def fix_overpassing_lines(lines, buses, distance_crs, tol=1):
     df_to_add = line_endings_to_bus_conversion(df_to_add)
 
     # remove original lines
-    lines.drop(lines_to_split, inplace=True)
+    lines = lines.drop(lines.index[lines_to_split])
 
     lines = gpd.GeoDataFrame(
         pd.concat([lines, df_to_add], ignore_index=True).reset_index(drop=True),
@@ -788,9 +872,10 @@ def built_network(inputs, outputs, geo_crs, distance_crs):
 
     logger.info("Stage 1/5: Read input data")
 
-    substations = gpd.read_file(inputs["substations"])
-    lines = gpd.read_file(inputs["lines"])
-    generators = read_geojson(inputs["generators"])
+    # all the columns of the clean lines and substations are written to the
+    # outputs; the generators are not used to build the network
+    substations = read_geodata(inputs["substations"])
+    lines = read_geodata(inputs["lines"])
 
     logger.info("Stage 2/5: Add line endings to the substation datasets")
 
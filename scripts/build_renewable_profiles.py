@@ -20,6 +20,7 @@ Relevant settings
 
     atlite:
         nprocesses:
+        availability_cache:
 
     renewable:
         {technology}:
@@ -99,6 +100,11 @@ Outputs
                                            e.g. due to river inflow in hydro reservoir.
     ===================  ================  ========================================================
 
+- ``resources/availability_{technology}.npz``: sparse availability matrix (bus x cutout
+  grid cell) of the technology in the compressed sparse row format (``data``, ``indices``,
+  ``indptr``, ``shape``), with the bus index (``bus``) and the cutout coordinates
+  (``x``, ``y``); empty for the hydro technology
+
     - **profile**
 
     .. image:: ../img/profile_ts.png
@@ -132,6 +138,15 @@ Outputs
 Description
 -----------
 
+With ``atlite: availability_cache: true``, the availability matrices and the
+exclusion rasters reprojected on the grid of the exclusion calculation are
+stored in ``resources/availability_cache``, as well as the hydrobasin of each
+bus. A cached file is identified by the content of its inputs and reused by
+the technologies with the same exclusions, by the weather years with the same
+buses and by later runs. The cache is not tracked by snakemake and it is never
+evicted: delete the folder, e.g. by ``snakemake -j 1 clean_availability_cache``,
+to free the disk space.
+
 This script leverages on atlite function to derivate hourly time series for an entire year
 for solar, wind (onshore and offshore), and hydro data.
 
@@ -189,6 +204,8 @@ node (`p_nom_max`): ``simple`` and ``conservative``:
 
 """
 import functools
+import hashlib
+import json
 import logging
 import os
 import time
@@ -199,11 +216,17 @@ import geopandas as gpd
 import numpy as np
 import pandas as pd
 import progressbar as pgb
+import rasterio as rio
+import shapely
 import xarray as xr
 from _helpers import configure_logging, read_csv_nafix, sets_path_to_root
 from add_electricity import load_powerplants
-from pypsa.geo import haversine
+from pypsa.geo import haversine_pts
+from rasterio.warp import Resampling, reproject, transform_bounds
+from rasterio.windows import Window
+from scipy.sparse import csr_matrix, diags, vstack
 from shapely.geometry import LineString
+from shapely.prepared import prep
 
 cc = coco.CountryConverter()
 
@@ -211,6 +234,7 @@ logger = logging.getLogger(__name__)
 
 COPERNICUS_CRS = "EPSG:4326"
 GEBCO_CRS = "EPSG:4326"
+AVAILABILITY_CACHE_DIR = "resources/availability_cache"
 
 
 def get_eia_annual_hydro_generation(fn, countries):
@@ -263,6 +287,437 @@ def get_hydro_capacity_annual_hydro_generation(
     return normalize_using_yearly
 
 
+def calculate_average_distance(weights, cell_coords, bus_coords):
+    """
+    Calculate the weighted average distance between the buses and the grid
+    cells, and the weighted centre of mass of the cells of each bus.
+
+    Parameters
+    ----------
+    weights : scipy.sparse matrix
+        Bus x cell matrix of the weights, e.g. the layout of the available cells
+    cell_coords : np.array
+        (x, y) coordinates of the cells
+    bus_coords : np.array
+        (x, y) coordinates of the buses
+
+    Returns
+    -------
+    average_distance : np.array
+        Weighted average distance [km] of the cells of each bus; NaN for the
+        buses without weights
+    centre_of_mass : np.array
+        Weighted (x, y) centre of mass of the cells of each bus; NaN for the
+        buses without weights
+    """
+    weights = csr_matrix(weights)
+
+    # normalize the weights of each bus
+    weights_sum = np.asarray(weights.sum(axis=1)).ravel()
+    norm = np.divide(
+        1.0, weights_sum, out=np.zeros_like(weights_sum), where=weights_sum != 0
+    )
+    weights = diags(norm) @ weights
+
+    # distances of the non-zero entries only
+    bus_ids = np.repeat(np.arange(weights.shape[0]), np.diff(weights.indptr))
+    distances = haversine_pts(bus_coords[bus_ids], cell_coords[weights.indices])
+    distances = csr_matrix(
+        (weights.data * distances, weights.indices, weights.indptr),
+        shape=weights.shape,
+    )
+
+    average_distance = np.asarray(distances.sum(axis=1)).ravel()
+    centre_of_mass = np.asarray(weights @ cell_coords, dtype=float)
+
+    # buses without weights have no cells to average over
+    average_distance[weights_sum == 0] = np.nan
+    centre_of_mass[weights_sum == 0] = np.nan
+
+    return average_distance, centre_of_mass
+
+
+def calculate_underwater_fraction(centre_of_mass, bus_coords, offshore_shape):
+    """
+    Calculate the fraction of the connection lines, from the centre of mass of
+    the cells to the bus, that lays within the offshore shape.
+
+    Parameters
+    ----------
+    centre_of_mass : np.array
+        (x, y) coordinates of the centres of mass
+    bus_coords : np.array
+        (x, y) coordinates of the buses
+    offshore_shape : shapely geometry
+        Union of the offshore shapes
+
+    Returns
+    -------
+    underwater_fraction : np.array
+    """
+    underwater_fraction = np.full(len(bus_coords), np.nan)
+    valid = np.isfinite(centre_of_mass).all(axis=1)
+
+    if hasattr(shapely, "linestrings"):
+        # shapely >= 2: vectorized operations
+        lines = shapely.linestrings(
+            np.stack([centre_of_mass[valid], bus_coords[valid]], axis=1)
+        )
+        shapely.prepare(offshore_shape)
+        frac = np.zeros(len(lines))
+
+        # lines fully within or crossing the offshore shape
+        within = shapely.contains_properly(offshore_shape, lines)
+        crossing = ~within & shapely.intersects(offshore_shape, lines)
+        frac[within] = 1.0
+        frac[crossing] = shapely.length(
+            shapely.intersection(lines[crossing], offshore_shape)
+        ) / shapely.length(lines[crossing])
+    else:
+        prepared_shape = prep(offshore_shape)
+        frac = []
+        for p, b in zip(centre_of_mass[valid], bus_coords[valid]):
+            line = LineString([p, b])
+            if not prepared_shape.intersects(line):
+                frac.append(0.0)
+            else:
+                frac.append(line.intersection(offshore_shape).length / line.length)
+
+    underwater_fraction[valid] = frac
+
+    return underwater_fraction
+
+
+@functools.lru_cache(maxsize=None)
+def calculate_file_hash(fname):
+    "Calculate the sha256 hash of the content of a file"
+    hash_sha256 = hashlib.sha256()
+    with open(fname, "rb") as f:
+        for chunk in iter(lambda: f.read(2**20), b""):
+            hash_sha256.update(chunk)
+    return hash_sha256.hexdigest()
+
+
+def calculate_cache_key(*items):
+    "Calculate the key of a cached file from json serializable items"
+    content = json.dumps(items, sort_keys=True, default=str).encode()
+    return hashlib.sha256(content).hexdigest()[:32]
+
+
+def calculate_availability_cache_key(
+    config, exclusion_files, fn_regions, alternative_clustering, area_crs, res, cutout
+):
+    """
+    Calculate the key of the cached availability matrix of a technology.
+
+    The availability depends only on the regions, the exclusions and the
+    cutout grid, hence the technologies with the same exclusions share one
+    cached matrix.
+
+    Parameters
+    ----------
+    config : dict
+        Configuration of the technology
+    exclusion_files : list
+        Input files of the exclusions
+    fn_regions : str
+        Path of the regions
+    alternative_clustering : bool
+        Whether the regions are GADM shapes
+    area_crs : str
+        Crs of the exclusion calculation
+    res : float
+        Resolution of the exclusion calculation
+    cutout : atlite.Cutout
+
+    Returns
+    -------
+    key : str
+    """
+    exclusion_config = {
+        k: config[k]
+        for k in [
+            "natura",
+            "copernicus",
+            "max_depth",
+            "min_shore_distance",
+            "max_shore_distance",
+        ]
+        if k in config
+    }
+    cutout_grid = hashlib.sha256(
+        cutout.data.x.values.tobytes() + cutout.data.y.values.tobytes()
+    ).hexdigest()
+    return calculate_cache_key(
+        calculate_file_hash(fn_regions),
+        alternative_clustering,
+        exclusion_config,
+        [calculate_file_hash(fn) for fn in exclusion_files],
+        area_crs,
+        res,
+        str(cutout.crs),
+        cutout_grid,
+        atlite.__version__,
+    )
+
+
+def cache_excluder_raster(
+    fn, crs, bounds, area_crs, res, cache_dir, nodata=None, tile_size=4096
+):
+    """
+    Reproject a raster on the grid of the exclusion calculation and cache it.
+
+    The grid has resolution res in area_crs and it is aligned to multiples of
+    res, as the grids used by atlite for each region. Hence, the raster is
+    reprojected only once and the exclusion calculation of every region reads
+    a window of the cached raster, with no further resampling.
+
+    Parameters
+    ----------
+    fn : str
+        Path of the raster
+    crs : str
+        Crs of the raster
+    bounds : list
+        Bounds [x, y, X, Y] in area_crs covered by the cached raster
+    area_crs : str
+        Crs of the exclusion calculation
+    res : float
+        Resolution of the exclusion calculation
+    cache_dir : str
+        Folder of the cached files
+    nodata : float
+        (optional) Nodata value of the raster
+    tile_size : int
+        Number of rows and columns of the tiles reprojected at once
+
+    Returns
+    -------
+    fn_cache : str
+        Path of the cached raster
+    """
+    left, bottom = [(b // res) * res for b in bounds[:2]]
+    right, top = [(b // res + 1) * res for b in bounds[2:]]
+    height, width = int(round((top - bottom) / res)), int(round((right - left) / res))
+    transform = rio.Affine(res, 0, left, 0, -res, top)
+
+    key = calculate_cache_key(
+        calculate_file_hash(fn), crs, area_crs, res, [left, bottom, right, top], nodata
+    )
+    fn_cache = os.path.join(cache_dir, f"raster_{key}.tif")
+
+    if os.path.exists(fn_cache):
+        logger.info(f"Use cached raster {fn_cache} for {fn}")
+        return fn_cache
+
+    logger.info(f"Reproject raster {fn} into cached raster {fn_cache}")
+    os.makedirs(cache_dir, exist_ok=True)
+    fn_tmp = f"{fn_cache}.{os.getpid()}.tmp"
+
+    with rio.open(fn) as src:
+        nodata = src.nodata if nodata is None else nodata
+        dtype = src.dtypes[0]
+        with rio.open(
+            fn_tmp,
+            "w",
+            driver="GTiff",
+            dtype=dtype,
+            count=1,
+            transform=transform,
+            crs=area_crs,
+            nodata=nodata,
+            compress="lzw",
+            tiled=True,
+            blockxsize=512,
+            blockysize=512,
+            width=width,
+            height=height,
+        ) as dst:
+            for row in range(0, height, tile_size):
+                for col in range(0, width, tile_size):
+                    window = Window(
+                        col,
+                        row,
+                        min(tile_size, width - col),
+                        min(tile_size, height - row),
+                    )
+                    tile = np.full(
+                        (window.height, window.width),
+                        0 if nodata is None else nodata,
+                        dtype=dtype,
+                    )
+                    reproject(
+                        source=rio.band(src, 1),
+                        destination=tile,
+                        src_crs=crs,
+                        src_nodata=nodata,
+                        dst_transform=dst.window_transform(window),
+                        dst_crs=area_crs,
+                        dst_nodata=nodata,
+                        resampling=Resampling.nearest,
+                    )
+                    dst.write(tile, indexes=1, window=window)
+
+    # move the complete file, as other technologies may use the same cache
+    os.replace(fn_tmp, fn_cache)
+
+    return fn_cache
+
+
+def calculate_bus_hydrobasins(bus_points, hydrobasins, fn_cache=None):
+    """
+    Map the buses to the hydrobasins containing their location by a spatial join.
+
+    When fn_cache is given, the mapping is loaded from fn_cache, if available,
+    otherwise it is calculated and saved in fn_cache. The hydrobasins are
+    still needed by ``atlite.Cutout.hydro``, so the cache saves the spatial
+    join only.
+
+    Parameters
+    ----------
+    bus_points : GeoDataFrame
+        Location of the buses
+    hydrobasins : GeoDataFrame
+        Hydrobasins, as passed to ``atlite.Cutout.hydro``
+    fn_cache : str
+        (optional) Path of the cached mapping
+
+    Returns
+    -------
+    bus_basins : pd.Series
+        Id of the hydrobasin of each bus (HYBAS_ID, if available);
+        NaN for the buses outside all the hydrobasins
+    """
+    if fn_cache is not None and os.path.exists(fn_cache):
+        logger.info(f"Load cached hydrobasins of the buses {fn_cache}")
+        bus_basins = pd.read_csv(fn_cache, index_col=0)["basin"]
+        if np.array_equal(
+            bus_basins.index.astype(str), np.asarray(bus_points.index, dtype=str)
+        ):
+            bus_basins.index = bus_points.index
+            return bus_basins
+        logger.warning(f"Buses of {fn_cache} do not match: recalculate hydrobasins")
+
+    if "HYBAS_ID" in hydrobasins.columns:
+        basin_ids = hydrobasins["HYBAS_ID"]
+    else:
+        basin_ids = hydrobasins.index.to_series()
+
+    hydrobasins = hydrobasins[["geometry"]]
+    if hydrobasins.crs is not None:
+        hydrobasins = hydrobasins.to_crs(bus_points.crs)
+
+    joined = gpd.sjoin(
+        bus_points,
+        hydrobasins,
+        how="left",
+        predicate="intersects",
+    )
+    # keep the first hydrobasin of the buses laying on the border of basins
+    index_right = joined["index_right"].groupby(level=0, sort=False).first()
+    bus_basins = pd.Series(
+        basin_ids.reindex(index_right.values).values,
+        index=index_right.index,
+        name="basin",
+    ).reindex(bus_points.index)
+
+    if fn_cache is not None:
+        os.makedirs(os.path.dirname(fn_cache), exist_ok=True)
+        fn_tmp = f"{fn_cache}.{os.getpid()}.tmp"
+        bus_basins.to_csv(fn_tmp)
+        os.replace(fn_tmp, fn_cache)
+
+    return bus_basins
+
+
+def save_availability(fn, availability, buses, cutout):
+    """
+    Save the sparse availability matrix (bus x cell) in a compressed npz file,
+    together with the bus index and the coordinates of the cutout.
+    """
+    availability = csr_matrix(availability)
+    # write to a temporary file first, as other technologies may use the same cache
+    fn_tmp = f"{fn}.{os.getpid()}.tmp"
+    with open(fn_tmp, "wb") as f:
+        np.savez_compressed(
+            f,
+            data=availability.data,
+            indices=availability.indices,
+            indptr=availability.indptr,
+            shape=availability.shape,
+            bus=np.asarray(buses, dtype=str),
+            x=cutout.coords["x"].values,
+            y=cutout.coords["y"].values,
+        )
+    os.replace(fn_tmp, fn)
+
+
+def load_availability(fn):
+    """
+    Load a sparse availability matrix saved by save_availability.
+
+    Returns
+    -------
+    availability : scipy.sparse.csr_matrix
+        Bus x cell availability matrix; cells in the order of cutout.grid
+    buses : np.array
+        Bus index of the rows
+    """
+    with np.load(fn) as f:
+        availability = csr_matrix(
+            (f["data"], f["indices"], f["indptr"]), shape=tuple(f["shape"])
+        )
+        buses = f["bus"]
+    return availability, buses
+
+
+def calculate_availability(
+    cutout, regions, excluder, fn_cache=None, max_dense_size=5e7, **kwargs
+):
+    """
+    Calculate the sparse availability matrix of the cutout cells for the regions.
+
+    The availability is calculated by atlite for chunks of regions, whose
+    dense matrices have at most max_dense_size elements, and each chunk is
+    converted into a sparse matrix. When fn_cache is given, the availability
+    matrix is loaded from fn_cache, if available, otherwise it is calculated
+    and saved in fn_cache.
+
+    Returns
+    -------
+    availability : scipy.sparse.csr_matrix
+        Bus x cell availability matrix; cells in the order of cutout.grid
+    """
+    if fn_cache is not None and os.path.exists(fn_cache):
+        logger.info(f"Load cached availability matrix {fn_cache}")
+        availability, cached_buses = load_availability(fn_cache)
+        if np.array_equal(cached_buses, np.asarray(regions.index, dtype=str)):
+            return availability
+        logger.warning(f"Buses of {fn_cache} do not match: recalculate availability")
+
+    n_cells = np.prod(cutout.shape)
+    chunk_size = max(int(max_dense_size // n_cells), 1)
+
+    logger.info("Calculate landuse availabilities...")
+    start = time.time()
+    chunks = []
+    for i in range(0, len(regions), chunk_size):
+        availability = cutout.availabilitymatrix(
+            regions.iloc[i : i + chunk_size], excluder, **kwargs
+        ).transpose(..., "y", "x")
+        chunks.append(csr_matrix(availability.values.reshape(-1, n_cells)))
+    availability = vstack(chunks, format="csr")
+    availability.eliminate_zeros()
+    duration = time.time() - start
+    logger.info(f"Completed availability calculation ({duration:2.2f}s)")
+
+    if fn_cache is not None:
+        os.makedirs(os.path.dirname(fn_cache), exist_ok=True)
+        save_availability(fn_cache, availability, regions.index, cutout)
+
+    return availability
+
+
 if __name__ == "__main__":
     if "snakemake" not in globals():
         from _helpers import mock_snakemake
@@ -319,8 +774,14 @@ if __name__ == "__main__":
 
     # filter plants for hydro
     if snakemake.wildcards.technology.startswith("hydro"):
-        country_shapes = gpd.read_file(paths.country_shapes)
-        hydrobasins = gpd.read_file(resource["hydrobasins"])
+        # availability matrices are not used for hydro: save an empty matrix
+        save_availability(
+            snakemake.output.availability,
+            csr_matrix((0, np.prod(cutout.shape))),
+            [],
+            cutout,
+        )
+
         ppls = load_powerplants(snakemake.input.powerplants)
 
         hydro_ppls = ppls[ppls.carrier == "hydro"]
@@ -333,26 +794,42 @@ if __name__ == "__main__":
         #     ]
         # ]  # exclude hydrobasins shapes that do not intersect the countries of interest
 
+        bus_points = gpd.GeoDataFrame(
+            geometry=gpd.points_from_xy(regions.x, regions.y, crs=regions.crs),
+            index=regions.index,
+        )
+
+        fn_bus_basins = None
+        if snakemake.config["atlite"].get("availability_cache", False):
+            # the mapping depends only on the hydrobasins and the bus locations,
+            # hence it is shared among weather years
+            key = calculate_cache_key(
+                calculate_file_hash(resource["hydrobasins"]),
+                pd.util.hash_pandas_object(regions[["x", "y"]]).tolist(),
+            )
+            fn_bus_basins = os.path.join(
+                AVAILABILITY_CACHE_DIR, f"bus_hydrobasins_{key}.csv"
+            )
+
+        # the hydrobasins are read once and passed to atlite as a GeoDataFrame
+        resource["hydrobasins"] = gpd.read_file(resource["hydrobasins"])
+        bus_basins = calculate_bus_hydrobasins(
+            bus_points, resource["hydrobasins"], fn_cache=fn_bus_basins
+        )
+
         # select busbar whose location (p) belongs to at least one hydrobasin geometry
         # if extendable option is true, all buses are included
         # otherwise only where hydro powerplants are available are considered
-        busbus_to_consider = [
-            (config.get("extendable", False) | (bus_id in hydro_ppls.bus.values))
-            & any(hydrobasins.geometry.intersects(p))
-            for (p, bus_id) in zip(
-                gpd.points_from_xy(regions.x, regions.y, crs=regions.crs),
-                regions.index,
-            )
-        ]
+        has_hydro_ppls = regions.index.isin(hydro_ppls.bus.values)
+        busbus_to_consider = (
+            config.get("extendable", False) | has_hydro_ppls
+        ) & bus_basins.reindex(regions.index).notna().values
 
         resource["plants"] = regions.rename(
             columns={"x": "lon", "y": "lat", "country": "countries"}
         ).loc[busbus_to_consider, ["lon", "lat", "countries"]]
 
-        resource["plants"]["installed_hydro"] = [
-            True if (bus_id in hydro_ppls.bus.values) else False
-            for bus_id in resource["plants"].index
-        ]
+        resource["plants"]["installed_hydro"] = has_hydro_ppls[busbus_to_consider]
 
         # check if normalization field belongs to the settings and it is not false
         if ("normalization" in resource) & (type(resource["normalization"]) == str):
@@ -397,66 +874,136 @@ if __name__ == "__main__":
 
         capacity_per_sqkm = config["capacity_per_sqkm"]
 
-        excluder = atlite.ExclusionContainer(crs=area_crs, res=100)
+        excluder_res = 100
+        excluder = atlite.ExclusionContainer(crs=area_crs, res=excluder_res)
+
+        availability_cache = snakemake.config["atlite"].get("availability_cache", False)
+        if availability_cache:
+            # bounds of the cached rasters: the cutout bounds, padded by the
+            # largest buffer of the exclusions
+            copernicus_buffer = (config.get("copernicus") or {}).get("distance", 0)
+            pad = max(copernicus_buffer, 0) + 2 * excluder_res
+            x, X, y, Y = cutout.extent
+            cache_bounds = np.array(
+                transform_bounds(
+                    cutout.crs,
+                    area_crs,
+                    x - cutout.dx,
+                    y - cutout.dy,
+                    X + cutout.dx,
+                    Y + cutout.dy,
+                )
+            ) + [-pad, -pad, pad, pad]
+
+            # cache the rasters only when they cover the regions
+            regions_bounds = regions.to_crs(area_crs).total_bounds
+            if (regions_bounds[:2] < cache_bounds[:2]).any() or (
+                regions_bounds[2:] > cache_bounds[2:]
+            ).any():
+                logger.info("Regions exceed the cutout: excluder rasters not cached")
+                cache_bounds = None
+
+        def excluder_raster(fn, crs, nodata=None):
+            "Path and crs of the raster to add to the excluder, cached if enabled"
+            if not availability_cache or cache_bounds is None:
+                return fn, crs
+            fn_cache = cache_excluder_raster(
+                fn,
+                crs,
+                cache_bounds,
+                area_crs,
+                excluder_res,
+                AVAILABILITY_CACHE_DIR,
+                nodata=nodata,
+            )
+            return fn_cache, area_crs
+
+        # input files of the exclusions, to identify the cached availability
+        exclusion_files = []
 
         if "natura" in config and config["natura"]:
             excluder.add_raster(paths.natura, nodata=0, allow_no_overlap=True)
+            exclusion_files.append(paths.natura)
 
         if "copernicus" in config and config["copernicus"]:
             copernicus = config["copernicus"]
+            copernicus_fn, copernicus_crs = excluder_raster(
+                paths.copernicus, COPERNICUS_CRS
+            )
             excluder.add_raster(
-                paths.copernicus,
+                copernicus_fn,
                 codes=copernicus["grid_codes"],
                 invert=True,
-                crs=COPERNICUS_CRS,
+                crs=copernicus_crs,
             )
             if "distance" in copernicus and config["copernicus"]["distance"] > 0:
                 excluder.add_raster(
-                    paths.copernicus,
+                    copernicus_fn,
                     codes=copernicus["distance_grid_codes"],
                     buffer=copernicus["distance"],
-                    crs=COPERNICUS_CRS,
+                    crs=copernicus_crs,
                 )
+            exclusion_files.append(paths.copernicus)
 
         if "max_depth" in config:
             # lambda not supported for atlite + multiprocessing
             # use named function np.greater with partially frozen argument instead
             # and exclude areas where: -max_depth > grid cell depth
             func_depth = functools.partial(np.greater, -config["max_depth"])
-            excluder.add_raster(
-                paths.gebco, codes=func_depth, crs=GEBCO_CRS, nodata=-1000
-            )
+            gebco_fn, gebco_crs = excluder_raster(paths.gebco, GEBCO_CRS, nodata=-1000)
+            excluder.add_raster(gebco_fn, codes=func_depth, crs=gebco_crs, nodata=-1000)
+            exclusion_files.append(paths.gebco)
 
         if "min_shore_distance" in config:
             buffer = config["min_shore_distance"]
             excluder.add_geometry(paths.country_shapes, buffer=buffer)
+            exclusion_files.append(paths.country_shapes)
 
         if "max_shore_distance" in config:
             buffer = config["max_shore_distance"]
             excluder.add_geometry(paths.country_shapes, buffer=buffer, invert=True)
+            exclusion_files.append(paths.country_shapes)
+
+        fn_availability = None
+        if availability_cache:
+            key = calculate_availability_cache_key(
+                config,
+                exclusion_files,
+                paths.regions,
+                snakemake.config["cluster_options"]["alternative_clustering"],
+                area_crs,
+                excluder_res,
+                cutout,
+            )
+            fn_availability = os.path.join(
+                AVAILABILITY_CACHE_DIR, f"availability_{key}.npz"
+            )
 
         kwargs = dict(nprocesses=nprocesses, disable_progressbar=noprogress)
-        if noprogress:
-            logger.info("Calculate landuse availabilities...")
-            start = time.time()
-            availability = cutout.availabilitymatrix(regions, excluder, **kwargs)
-            duration = time.time() - start
-            logger.info(f"Completed availability calculation ({duration:2.2f}s)")
-        else:
-            availability = cutout.availabilitymatrix(regions, excluder, **kwargs)
+        availability = calculate_availability(
+            cutout, regions, excluder, fn_cache=fn_availability, **kwargs
+        )
+
+        save_availability(snakemake.output.availability, availability, buses, cutout)
 
         area = cutout.grid.to_crs(area_crs).area / 1e6
         area = xr.DataArray(
             area.values.reshape(cutout.shape), [cutout.coords["y"], cutout.coords["x"]]
         )
 
-        potential = capacity_per_sqkm * availability.sum("bus") * area
+        potential = capacity_per_sqkm * (
+            xr.DataArray(
+                np.asarray(availability.sum(axis=0)).reshape(cutout.shape),
+                [cutout.coords["y"], cutout.coords["x"]],
+            )
+            * area
+        )
 
         capacity_factor = correction_factor * func(capacity_factor=True, **resource)
         layout = capacity_factor * area * capacity_per_sqkm
 
         profile, capacities = func(
-            matrix=availability.stack(spatial=["y", "x"]),
+            matrix=availability,
             layout=layout,
             index=buses,
             per_unit=True,
@@ -466,10 +1013,19 @@ if __name__ == "__main__":
 
         logger.info(f"Calculating maximal capacity per bus (method '{p_nom_max_meth}')")
         if p_nom_max_meth == "simple":
-            p_nom_max = capacity_per_sqkm * availability @ area
+            p_nom_max = capacity_per_sqkm * xr.DataArray(
+                availability @ area.values.ravel(), [buses]
+            )
         elif p_nom_max_meth == "conservative":
-            max_cap_factor = capacity_factor.where(availability != 0).max(["x", "y"])
-            p_nom_max = capacities / max_cap_factor
+            # maximum capacity factor among the available cells of each bus
+            cf_cells = capacity_factor.transpose("y", "x").values.ravel()
+            max_cap_factor = np.full(len(buses), np.nan)
+            has_cells = np.diff(availability.indptr) > 0
+            if has_cells.any():
+                max_cap_factor[has_cells] = np.fmax.reduceat(
+                    cf_cells[availability.indices], availability.indptr[:-1][has_cells]
+                )
+            p_nom_max = capacities / xr.DataArray(max_cap_factor, [buses])
         else:
             raise AssertionError(
                 'Config key `potential` should be one of "simple" '
@@ -477,21 +1033,13 @@ if __name__ == "__main__":
             )
 
         logger.info("Calculate average distances.")
-        layoutmatrix = (layout * availability).stack(spatial=["y", "x"])
-
-        coords = cutout.grid[["x", "y"]]
-        bus_coords = regions[["x", "y"]]
-
-        average_distance = []
-        centre_of_mass = []
-        for bus in buses:
-            row = layoutmatrix.sel(bus=bus).data
-            nz_b = row != 0
-            row = row[nz_b]
-            co = coords[nz_b]
-            distances = haversine(bus_coords.loc[bus], co)
-            average_distance.append((distances * (row / row.sum())).sum())
-            centre_of_mass.append(co.values.T @ (row / row.sum()))
+        layoutmatrix = availability @ diags(layout.transpose("y", "x").values.ravel())
+
+        average_distance, centre_of_mass = calculate_average_distance(
+            layoutmatrix,
+            cutout.grid[["x", "y"]].values,
+            regions.loc[buses, ["x", "y"]].values,
+        )
 
         average_distance = xr.DataArray(average_distance, [buses])
         centre_of_mass = xr.DataArray(centre_of_mass, [buses, ("spatial", ["x", "y"])])
@@ -509,12 +1057,11 @@ if __name__ == "__main__":
         if snakemake.wildcards.technology.startswith("offwind"):
             logger.info("Calculate underwater fraction of connections.")
             offshore_shape = gpd.read_file(paths["offshore_shapes"]).unary_union
-            underwater_fraction = []
-            for bus in buses:
-                p = centre_of_mass.sel(bus=bus).data
-                line = LineString([p, regions.loc[bus, ["x", "y"]]])
-                frac = line.intersection(offshore_shape).length / line.length
-                underwater_fraction.append(frac)
+            underwater_fraction = calculate_underwater_fraction(
+                centre_of_mass.data,
+                regions.loc[buses, ["x", "y"]].values,
+                offshore_shape,
+            )
 
             ds["underwater_fraction"] = xr.DataArray(underwater_fraction, [buses])
 
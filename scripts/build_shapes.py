@@ -25,7 +25,8 @@ from _helpers import (
     two_2_three_digits_country,
     two_digits_2_name_country,
 )
-from rasterio.mask import mask
+from rasterio.features import rasterize
+from rasterio.windows import Window
 from shapely.geometry import LineString, MultiPolygon, Point, Polygon
 from shapely.geometry.base import BaseGeometry
 from shapely.ops import unary_union
@@ -526,33 +527,115 @@ def load_GDP(
     return GDP_tif, name_file_tif
 
 
-def generalized_mask(src, geom, **kwargs):
-    "Generalize mask function to account for Polygon and MultiPolygon"
-    if geom.geom_type == "Polygon":
-        return mask(src, [geom], **kwargs)
-    elif geom.geom_type == "MultiPolygon":
-        return mask(src, geom.geoms, **kwargs)
-    else:
-        return mask(src, geom, **kwargs)
+def _sum_raster_over_shapes(shapes, src, window_size=4096):
+    """
+    Function to sum the raster values within each shape
 
+    All the shapes are rasterized into a label raster aligned with the grid of
+    the raster and all the sums are calculated in one np.bincount pass.
+    Large rasters are read window by window to limit the memory usage.
+    Approximation: the pixels where the border of a shape lays are included,
+    but each pixel is assigned to a single shape; shapes are rasterized by
+    decreasing area so that small shapes are not hidden by larger neighbours.
+    Nodata values of the raster are not summed.
 
-def _sum_raster_over_mask(shape, img):
-    """
-    Function to sum the raster value within a shape
+    Parameters
+    ----------
+    shapes : GeoSeries
+        Shapes in the crs of the raster
+    src : rasterio.DatasetReader
+        Raster to sum over the shapes
+    window_size : int
+        Maximum number of rows and columns of the windows read at once
+
+    Returns
+    -------
+    sums : numpy.ndarray
+        Sum of the raster values for each shape, in the order of shapes
     """
-    # select the desired area of the raster corresponding to each polygon
-    # Approximation: the population is measured including the pixels
-    #   where the border of the shape lays. This leads to slightly overestimate
-    #   the output, but the error is limited and it enables halving the
-    #   computational time
-    out_image, out_transform = generalized_mask(
-        img, shape, all_touched=True, invert=False, nodata=0.0
+    geoms = np.asarray(shapes.values, dtype=object)
+    sums = np.zeros(len(geoms))
+    bounds = shapes.bounds.values  # minx, miny, maxx, maxy; NaN for empty shapes
+    has_bounds = ~np.isnan(bounds).any(axis=1)
+    if not has_bounds.any():
+        return sums
+
+    # rasterization order: larger shapes first; shape k is labelled k + 1
+    areas = np.array(
+        [geom.area if has_b else 0.0 for geom, has_b in zip(geoms, has_bounds)]
     )
-    # calculate total output in the selected geometry
-    out_sum = out_image.sum()
-    # out_sum = out_image.sum()/2 + out_image_int.sum()/2
+    order = np.argsort(-areas, kind="stable")
+    order = order[has_bounds[order]]
+
+    # range of rows and columns of the raster covering all the shapes
+    minx, miny = bounds[has_bounds, :2].min(axis=0)
+    maxx, maxy = bounds[has_bounds, 2:].max(axis=0)
+    cols, rows = ~src.transform * (np.array([minx, maxx]), np.array([maxy, miny]))
+    row_start = max(int(np.floor(rows.min())), 0)
+    row_stop = min(int(np.ceil(rows.max())), src.height)
+    col_start = max(int(np.floor(cols.min())), 0)
+    col_stop = min(int(np.ceil(cols.max())), src.width)
+
+    for row in range(row_start, row_stop, window_size):
+        for col in range(col_start, col_stop, window_size):
+            window = Window(
+                col,
+                row,
+                min(window_size, col_stop - col),
+                min(window_size, row_stop - row),
+            )
+            left, bottom, right, top = src.window_bounds(window)
+
+            # shapes overlapping the window
+            in_window = (
+                (bounds[order, 0] <= right)
+                & (bounds[order, 2] >= left)
+                & (bounds[order, 1] <= top)
+                & (bounds[order, 3] >= bottom)
+            )
+            idx = order[in_window]
+            if idx.size == 0:
+                continue
+
+            labels = rasterize(
+                zip(geoms[idx], idx + 1),
+                out_shape=(window.height, window.width),
+                transform=src.window_transform(window),
+                fill=0,
+                all_touched=True,
+                dtype="int32",
+            )
+            if not labels.any():
+                continue
+
+            values = src.read(1, window=window).astype(float)
+            invalid = ~np.isfinite(values)
+            if src.nodata is not None:
+                invalid |= values == src.nodata
+            values[invalid] = 0.0
+
+            sums += np.bincount(
+                labels.ravel(), weights=values.ravel(), minlength=len(geoms) + 1
+            )[1:]
+
+    return sums
 
-    return out_sum
+
+def _init_process_gdp(df_gadm_, GDP_tif_):
+    global df_gadm, GDP_tif
+    df_gadm, GDP_tif = df_gadm_, GDP_tif_
+
+
+def _process_func_gdp(c_code):
+
+    # get subset by country code
+    country_rows = df_gadm.loc[df_gadm["country"] == c_code].copy()
+
+    # the GDP file is shared among the processes and opened read-only
+    with rasterio.open(GDP_tif) as src:
+        country_rows["gdp"] = _sum_raster_over_shapes(country_rows.geometry, src)
+
+    return country_rows
 
 
 def add_gdp_data(
@@ -587,45 +670,47 @@ def add_gdp_data(
 
     GDP_tif, name_tif = load_GDP(year, update, out_logging, name_file_nc)
 
-    with rasterio.open(GDP_tif) as src:
-        # resample data to target shape
-        tqdm_kwargs = dict(
-            ascii=False,
-            unit=" geometries",
-            total=df_gadm.shape[0],
-            desc="Compute GDP ",
-        )
-        for i in tqdm(df_gadm.index, **tqdm_kwargs):
-            df_gadm.loc[i, "gdp"] = _sum_raster_over_mask(df_gadm.geometry.loc[i], src)
-    return df_gadm
+    country_codes = df_gadm["country"].unique()
+
+    tqdm_kwargs = dict(
+        ascii=False,
+        unit=" countries",
+        total=len(country_codes),
+        desc="Compute GDP ",
+    )
+    if (nprocesses is None) or (nprocesses == 1):
+
+        with rasterio.open(GDP_tif) as src:
+            # sum the gdp over the shapes, country by country
+            for c_code in tqdm(
+                country_codes, disable=disable_progressbar, **tqdm_kwargs
+            ):
+                country_rows = df_gadm.loc[df_gadm["country"] == c_code]
+                df_gadm.loc[country_rows.index, "gdp"] = _sum_raster_over_shapes(
+                    country_rows.geometry, src
+                )
+
+    else:
+
+        kwargs = {
+            "initializer": _init_process_gdp,
+            "initargs": (df_gadm, GDP_tif),
+            "processes": nprocesses,
+        }
+        with mp.get_context("spawn").Pool(**kwargs) as pool:
+            if disable_progressbar:
+                _ = list(pool.map(_process_func_gdp, country_codes))
+            else:
+                _ = list(
+                    tqdm(
+                        pool.imap(_process_func_gdp, country_codes),
+                        **tqdm_kwargs,
+                    )
+                )
+            for elem in _:
+                df_gadm.loc[elem.index, "gdp"] = elem["gdp"]
 
-    # for index, row in tqdm(df_gadm.iterrows(), index=df_gadm.shape[0]):
-    #     # select the desired area of the raster corresponding to each polygon
-    #     # Approximation: the gdp is measured excluding the pixels
-    #     #   where the border of the shape lays. This may affect the computation
-    #     #   but it is conservative and avoids considering multiple times the same
-    #     #   pixels
-    #     out_image, out_transform = generalized_mask(src,
-    #                                                 row["geometry"],
-    #                                                 all_touched=True,
-    #                                                 invert=False,
-    #                                                 nodata=0.0)
-    #     # out_image_int, out_transform = mask(src,
-    #     #                                row["geometry"],
-    #     #                                all_touched=False,
-    #     #                                invert=False,
-    #     #                                nodata=0.0)
-
-    #     # calculate total gdp in the selected geometry
-    #     gdp_by_geom = np.nansum(out_image)
-    #     # gdp_by_geom = out_image.sum()/2 + out_image_int.sum()/2
-
-    #     if out_logging == True:
-    #         _logger.info("Stage 4/4 GDP: shape: " + str(index) +
-    #                      " out of " + str(df_gadm.shape[0]))
-
-    #     # update the gdp data in the dataset
-    #     df_gadm.loc[index, "gdp"] = gdp_by_geom
+    return df_gadm
 
 
 def _init_process_pop(df_gadm_, year_, worldpop_method_):
@@ -644,11 +729,7 @@ def _process_func_pop(c_code):
     )
 
     with rasterio.open(WorldPop_inputfile) as src:
-
-        for i in country_rows.index:
-            country_rows.loc[i, "pop"] = _sum_raster_over_mask(
-                country_rows.geometry.loc[i], src
-            )
+        country_rows["pop"] = _sum_raster_over_shapes(country_rows.geometry, src)
 
     return country_rows
 
@@ -701,14 +782,14 @@ def add_population_data(
 
                 # get worldpop image
                 WorldPop_inputfile, WorldPop_filename = download_WorldPop(
-                    worldpop_method, c_code, year, update, out_logging
+                    c_code, worldpop_method, year, update, out_logging
                 )
 
                 with rasterio.open(WorldPop_inputfile) as src:
-
-                    for i, row in country_rows.iterrows():
-                        df_gadm.loc[i, "pop"] = _sum_raster_over_mask(row.geometry, src)
-                        pbar.update(1)
+                    df_gadm.loc[country_rows.index, "pop"] = _sum_raster_over_shapes(
+                        country_rows.geometry, src
+                    )
+                pbar.update(country_rows.shape[0])
 
     else:
 
@@ -782,6 +863,7 @@ def gadm(
             update,
             out_logging,
             name_file_nc="GDP_PPP_1990_2015_5arcmin_v2.nc",
+            nprocesses=nprocesses,
         )
 
     # set index and simplify polygons
@@ -9,10 +9,30 @@ import geopandas as gpd
 import numpy as np
 import pandas as pd
 import reverse_geocode as rg
-from _helpers import configure_logging, save_to_geojson, to_csv_nafix
+from _helpers import configure_logging, read_geodata, save_geodata, to_csv_nafix
 
 logger = logging.getLogger(__name__)
 
+# columns of the raw data used by prepare_lines_df and prepare_substation_df
+RAW_LINES_COLUMNS = [
+    "id",
+    "tags.voltage",
+    "tags.circuits",
+    "tags.cables",
+    "tags.frequency",
+    "tags.power",
+    "Country",
+    "Length",
+]
+RAW_SUBSTATIONS_COLUMNS = [
+    "id",
+    "tags.voltage",
+    "tags.power",
+    "tags.substation",
+    "Country",
+    "Area",
+]
+
 
 def prepare_substation_df(df_all_substations):
     """
@@ -660,9 +680,10 @@ def clean_data(
     threshold_voltage=35000,
     add_line_endings=True,
     generator_name_method="OSM",
+    export_geojson=False,
 ):
     # Load raw data lines
-    df_lines = gpd.read_file(input_files["lines"])
+    df_lines = read_geodata(input_files["lines"], columns=RAW_LINES_COLUMNS)
 
     # prepare lines dataframe and data types
     df_lines = prepare_lines_df(df_lines)
@@ -674,7 +695,7 @@ def clean_data(
     # load cables only if data are stored
     if os.path.getsize(input_files["cables"]) > 0:
         # Load raw data lines
-        df_cables = gpd.read_file(input_files["cables"])
+        df_cables = read_geodata(input_files["cables"], columns=RAW_LINES_COLUMNS)
 
         # prepare cables dataframe and data types
         df_cables = prepare_lines_df(df_cables)
@@ -708,11 +729,13 @@ def clean_data(
         df_all_lines, ext_country_shapes, names_by_shapes=names_by_shapes
     )
 
-    save_to_geojson(df_all_lines, output_files["lines"])
+    save_geodata(df_all_lines, output_files["lines"], export_geojson)
 
     # ----------- SUBSTATIONS -----------
 
-    df_all_substations = gpd.read_file(input_files["substations"])
+    df_all_substations = read_geodata(
+        input_files["substations"], columns=RAW_SUBSTATIONS_COLUMNS
+    )
 
     # prepare dataset for substations
     df_all_substations = prepare_substation_df(df_all_substations)
@@ -738,7 +761,7 @@ def clean_data(
     # set unique bus ids
     df_all_substations = set_unique_id(df_all_substations, "bus_id")
 
-    # save to geojson file
+    # save to geodata file
     df_all_substations = gpd.GeoDataFrame(df_all_substations, geometry="geometry")
 
     # set the country name by the shape
@@ -749,11 +772,11 @@ def clean_data(
         col_country="Country",
     )
 
-    save_to_geojson(df_all_substations, output_files["substations"])
+    save_geodata(df_all_substations, output_files["substations"], export_geojson)
 
     # ----------- GENERATORS -----------
 
-    df_all_generators = gpd.read_file(input_files["generators"])
+    df_all_generators = read_geodata(input_files["generators"])
 
     # prepare the generator dataset
     df_all_generators = prepare_generators_df(df_all_generators)
@@ -773,8 +796,8 @@ def clean_data(
     # save to csv
     to_csv_nafix(df_all_generators, output_files["generators_csv"])
 
-    # save to geojson
-    save_to_geojson(df_all_generators, output_files["generators"])
+    # save to geodata file
+    save_geodata(df_all_generators, output_files["generators"], export_geojson)
 
     return None
 
@@ -798,6 +821,7 @@ if __name__ == "__main__":
     onshore_shape_path = snakemake.input.country_shapes
     geo_crs = snakemake.config["crs"]["geo_crs"]
     distance_crs = snakemake.config["crs"]["distance_crs"]
+    export_geojson = snakemake.config.get("osm_data_geojson_export", False)
 
     input_files = snakemake.input
     output_files = snakemake.output
@@ -833,4 +857,5 @@ if __name__ == "__main__":
         threshold_voltage=threshold_voltage,
         add_line_endings=add_line_endings,
         generator_name_method=generator_name_method,
+        export_geojson=export_geojson,
     )
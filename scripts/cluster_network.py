@@ -13,6 +13,9 @@ Relevant Settings
 
     clustering:
         aggregation_strategies:
+        algorithm:
+        nprocesses:
+        hierarchy_cache:
 
     focus_weights:
 
@@ -34,6 +37,7 @@ Inputs
 - ``resources/regions_offshore_elec_s{simpl}.geojson``: confer :ref:`simplify`
 - ``resources/busmap_elec_s{simpl}.csv``: confer :ref:`simplify`
 - ``networks/elec_s{simpl}.nc``: confer :ref:`simplify`
+- ``resources/shapes/gadm_shapes.geojson``: confer :ref:`shapes`, used when ``alternative_clustering`` is enabled or the clusters are distributed by population or gdp
 - ``data/custom_busmap_elec_s{simpl}_{clusters}.csv``: optional input
 
 Outputs
@@ -119,33 +123,30 @@ Exemplary unsolved network clustered to 37 nodes:
     :align: center
 
 """
+import heapq
 import logging
+import multiprocessing as mp
 import os
+import warnings
 from functools import reduce
 
 import geopandas as gpd
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
-import pyomo.environ as po
 import pypsa
 import seaborn as sns
 import shapely
 from _helpers import (
     configure_logging,
     get_aggregation_strategies,
+    read_geojson,
     sets_path_to_root,
-    two_2_three_digits_country,
     update_p_nom_max,
 )
 from add_electricity import load_costs
-from build_shapes import add_gdp_data, add_population_data, get_GADM_layer
-from pypsa.networkclustering import (
-    _make_consense,
-    busmap_by_kmeans,
-    get_clustering_from_busmap,
-)
-from shapely.geometry import Point
+from pypsa.networkclustering import _make_consense, get_clustering_from_busmap
+from scipy.cluster.hierarchy import cut_tree, linkage
 
 idx = pd.IndexSlice
 
@@ -156,7 +157,24 @@ def normed(x):
     return (x / x.sum()).fillna(0.0)
 
 
-def weighting_for_country(n, x):
+def conventional_capacity_and_load(n):
+    """
+    Compute the conventional capacity and the mean load of the buses.
+
+    The values are shared by the weightings of all country groups and the
+    distribution of the clusters, so the load time series is averaged once.
+
+    Parameters
+    ----------
+    n : pypsa.Network
+
+    Returns
+    -------
+    gen : pd.Series
+        Conventional generation and storage capacity of each bus
+    load : pd.Series
+        Mean load of each bus with loads
+    """
     conv_carriers = {"OCGT", "CCGT", "PHS", "hydro"}
     gen = n.generators.loc[n.generators.carrier.isin(conv_carriers)].groupby(
         "bus"
@@ -169,6 +187,13 @@ def weighting_for_country(n, x):
     )
     load = n.loads_t.p_set.mean().groupby(n.loads.bus).sum()
 
+    return gen, load
+
+
+def weighting_for_country(n, x, gen=None, load=None):
+    if gen is None or load is None:
+        gen, load = conventional_capacity_and_load(n)
+
     b_i = x.index
     g = normed(gen.reindex(b_i, fill_value=0))
     l = normed(load.reindex(b_i, fill_value=0))
@@ -178,62 +203,106 @@ def weighting_for_country(n, x):
     return (w * (100.0 / w.max())).clip(lower=1.0).astype(int)
 
 
-def distribute_clusters(n, n_clusters, focus_weights=None, solver_name=None):
-    """Determine the number of clusters per country"""
+def allocate_clusters(distribution_factor, N, n_clusters):
+    """
+    Distribute an integer number of clusters among countries.
+
+    Solves the integer problem min sum_c (n_c - f_c * n_clusters)^2 subject to
+    sum_c n_c = n_clusters and 1 <= n_c <= N_c. The objective is separable and
+    convex, so adding the clusters one by one to the country with the smallest
+    increase of the objective yields the optimal allocation.
+
+    Parameters
+    ----------
+    distribution_factor : pd.Series
+        Share f_c of the clusters of each country, summing up to one; countries
+        without buses are ignored and missing countries have a share of zero
+    N : pd.Series
+        Number of buses N_c of each country, the upper bound of its clusters
+    n_clusters : int
+        Total number of clusters
+
+    Returns
+    -------
+    n_clusters_c : pd.Series
+        Number of clusters of each country of N
+    """
+    if not len(N) <= n_clusters <= N.sum():
+        raise ValueError(
+            f"Number of clusters must be {len(N)} <= n_clusters <= {N.sum()} "
+            f"for this selection of countries. Is {n_clusters}."
+        )
 
-    distribution_cluster = snakemake.config["cluster_options"]["distribute_cluster"]
-    country_list = snakemake.config["countries"]
-    year = snakemake.config["build_shape_options"]["year"]
-    update = snakemake.config["build_shape_options"]["update_file"]
-    out_logging = snakemake.config["build_shape_options"]["out_logging"]
-    nprocesses = snakemake.config["build_shape_options"]["nprocesses"]
+    target = distribution_factor.reindex(N.index, fill_value=0.0).values * n_clusters
+    upper = N.values
+    allocation = np.ones(len(N), dtype=int)
 
-    if solver_name is None:
-        solver_name = snakemake.config["solving"]["solver"]["name"]
+    # increase of the objective when adding a cluster to a country with k
+    # clusters is 2 * (k - target) + 1, growing by 2 with every cluster
+    heap = [(2 * (1 - t) + 1, i) for i, t in enumerate(target) if upper[i] > 1]
+    heapq.heapify(heap)
+    for _ in range(n_clusters - allocation.sum()):
+        cost, i = heapq.heappop(heap)
+        allocation[i] += 1
+        if allocation[i] < upper[i]:
+            heapq.heappush(heap, (cost + 2, i))
 
-    if distribution_cluster == ["load"]:
-        L = (
-            n.loads_t.p_set.mean()
-            .groupby(n.loads.bus)
-            .sum()
-            .groupby([n.buses.country])
-            .sum()
-            .pipe(normed)
+    assert (
+        allocation.sum() == n_clusters
+    ), f"Allocated {allocation.sum()} clusters instead of {n_clusters}."
+
+    return pd.Series(allocation, index=N.index)
+
+
+def distribute_clusters(
+    n,
+    n_clusters,
+    focus_weights=None,
+    solver_name=None,
+    load=None,
+    distribution_cluster=["load"],
+    gadm_shapes=None,
+):
+    """Determine the number of clusters per country
+
+    ``solver_name`` is no longer used, the clusters are allocated in-process
+    by ``allocate_clusters``. ``gadm_shapes`` is the path of the GADM shapes,
+    required when ``distribution_cluster`` is ["pop"] or ["gdp"].
+    """
+
+    if distribution_cluster in (["pop"], ["gdp"]) and gadm_shapes is None:
+        raise ValueError(
+            f"`gadm_shapes` is required to distribute the clusters by {distribution_cluster}"
         )
+
+    # TODO: 1. Check if sub_networks can be added here i.e. ["country", "sub_networks"]
+    N = n.buses.groupby(["country"]).size()
+
+    if distribution_cluster == ["load"]:
+        if load is None:
+            load = n.loads_t.p_set.mean().groupby(n.loads.bus).sum()
+        L = load.groupby([n.buses.country]).sum().pipe(normed)
         assert len(L.index) == len(n.buses.country.unique()), (
             "The following countries have no load: "
             f"{list(set(L.index).symmetric_difference(set(n.buses.country.unique())))}"
         )
         distribution_factor = L
 
-    if distribution_cluster == ["pop"]:
-        df_pop_c = gpd.read_file(snakemake.input.country_shapes).rename(
-            columns={"name": "country"}
-        )
-        add_population_data(
-            df_pop_c, country_list, year, update, out_logging, nprocesses=nprocesses
+    if distribution_cluster in (["pop"], ["gdp"]):
+        # population and gdp are already computed per GADM shape by build_shapes
+        attr = distribution_cluster[0]
+        df_gadm = read_geojson(gadm_shapes)
+        assert attr in df_gadm.columns, (
+            f"Column `{attr}` is missing in {gadm_shapes}, "
+            f"check the {attr} method in build_shape_options."
         )
-        P = df_pop_c.loc[:, ("country", "pop")]
-        P = P.groupby(P["country"]).sum().pipe(normed).squeeze()
-        distribution_factor = P
-
-    if distribution_cluster == ["gdp"]:
-        df_gdp_c = gpd.read_file(snakemake.input.country_shapes).rename(
-            columns={"name": "country"}
-        )
-        add_gdp_data(
-            df_gdp_c,
-            year,
-            update,
-            out_logging,
-            name_file_nc="GDP_PPP_1990_2015_5arcmin_v2.nc",
+        # shares of the countries with buses only
+        distribution_factor = (
+            df_gadm.groupby("country")[attr]
+            .sum()
+            .reindex(N.index, fill_value=0)
+            .pipe(normed)
         )
-        G = df_gdp_c.loc[:, ("country", "gdp")]
-        G = G.groupby(df_gdp_c["country"]).sum().pipe(normed).squeeze()
-        distribution_factor = G
-
-    # TODO: 1. Check if sub_networks can be added here i.e. ["country", "sub_networks"]
-    N = n.buses.groupby(["country"]).size()
 
     assert (
         n_clusters >= len(N) and n_clusters <= N.sum()
@@ -264,141 +333,311 @@ def distribute_clusters(n, n_clusters, focus_weights=None, solver_name=None):
         distribution_factor.sum(), 1.0, rtol=1e-3
     ), f"Country weights L must sum up to 1.0 when distributing clusters. Is {distribution_factor.sum()}."
 
-    m = po.ConcreteModel()
-
-    def n_bounds(model, n_id):
-        """
-        Create a function that makes a bound pair for pyomo
-
-        Use n_bounds(model, n_id) if N is Single-Index
-        Use n_bounds(model, *n_id) if N is Multi-Index
-        Example: https://pyomo.readthedocs.io/en/stable/pyomo_modeling_components/Variables.html
-
-        Returns
-        -------
-        bounds = A function (or Python object) that gives a (lower,upper) bound pair i.e.(1,10) for the variable
-        """
-        return (1, N[n_id])
-
-    m.n = po.Var(list(distribution_factor.index), bounds=n_bounds, domain=po.Integers)
-    m.tot = po.Constraint(expr=(po.summation(m.n) == n_clusters))
-    m.objective = po.Objective(
-        expr=sum(
-            (m.n[i] - distribution_factor.loc[i] * n_clusters) ** 2
-            for i in distribution_factor.index
-        ),
-        sense=po.minimize,
+    return allocate_clusters(distribution_factor, N, n_clusters)
+
+
+def busmap_for_gadm_clusters(n, gadm_level, gadm_shapes):
+    """
+    Map each bus to the GADM shape it lies in.
+
+    Buses are located with a single spatial join against the GADM shapes of
+    their own country; buses that fall outside (or on the border of) these
+    shapes are assigned to the nearest shape of their country.
+
+    Parameters
+    ----------
+    n : pypsa.Network
+        Network whose buses are mapped
+    gadm_level : int
+        GADM layer of the shapes, used to name the ``gadm_{level}`` bus column
+    gadm_shapes : str or GeoDataFrame
+        Path to the ``gadm_shapes.geojson`` output of build_shapes, or the
+        loaded GeoDataFrame with the GADM_ID and country columns
+
+    Returns
+    -------
+    busmap : pd.Series
+        GADM_ID of the shape of each bus, indexed by bus
+    """
+    if not isinstance(gadm_shapes, gpd.GeoDataFrame):
+        gadm_shapes = gpd.read_file(gadm_shapes)
+    gdf = gadm_shapes.reset_index()[["GADM_ID", "country", "geometry"]]
+
+    buses = n.buses
+    bus_points = gpd.GeoDataFrame(
+        {
+            "bus": buses.index,
+            "country": buses["country"].values,
+        },
+        geometry=gpd.points_from_xy(buses["x"], buses["y"]),
+        crs=gdf.crs,
     )
 
-    opt = po.SolverFactory(solver_name)
-    if not opt.has_capability("quadratic_objective"):
-        logger.warning(
-            f"The configured solver `{solver_name}` does not support quadratic objectives. Falling back to `ipopt`."
+    # buses lying within exactly one shape of their own country
+    joined = gpd.sjoin(bus_points, gdf, how="inner", predicate="within")
+    joined = joined[joined["country_left"] == joined["country_right"]]
+    joined = joined[~joined["bus"].duplicated(keep=False)]
+    busmap = pd.Series(joined["GADM_ID"].values, index=joined["bus"].values)
+
+    # the remaining buses are assigned to the closest shape of their country
+    missing = bus_points[~bus_points["bus"].isin(busmap.index)]
+    for country, points in missing.groupby("country"):
+        with warnings.catch_warnings():
+            warnings.filterwarnings("ignore", message="Geometry is in a geographic CRS")
+            nearest = gpd.sjoin_nearest(
+                points[["bus", "geometry"]],
+                gdf.loc[gdf["country"] == country, ["GADM_ID", "geometry"]],
+                how="left",
+            )
+        nearest = nearest[~nearest["bus"].duplicated()]
+        busmap = pd.concat(
+            [busmap, pd.Series(nearest["GADM_ID"].values, index=nearest["bus"].values)]
         )
-        opt = po.SolverFactory("ipopt")
 
-    results = opt.solve(m)
-    assert (
-        results["Solver"][0]["Status"] == "ok"
-    ), f"Solver returned non-optimally: {results}"
+    busmap = busmap.reindex(buses.index).rename("gadm_{}".format(gadm_level))
+    buses["gadm_{}".format(gadm_level)] = busmap
 
-    return (
-        pd.Series(m.n.get_values(), index=distribution_factor.index).round().astype(int)
-    )
+    return busmap
 
 
-def busmap_for_gadm_clusters(n, gadm_level, geo_crs, country_list):
+def kmeans_for_points(coords, weights, n_clusters, algorithm="kmeans", **kwargs):
+    """
+    Cluster points weighted by integer weights with k-means.
+
+    The points are repeated according to their weights, as in
+    ``pypsa.networkclustering.busmap_by_kmeans``.
+
+    Parameters
+    ----------
+    coords : np.array
+        Coordinates of the points, of shape (n, 2)
+    weights : np.array
+        Integer weight of each point
+    n_clusters : int
+        Number of clusters
+    algorithm : str
+        "kmeans" for the full k-means or "minibatch_kmeans" for the faster
+        mini-batch variant, which stops early when the inertia does not improve
+    **kwargs
+        Passed to ``sklearn.cluster.KMeans`` or ``MiniBatchKMeans``
+
+    Returns
+    -------
+    labels : np.array
+        Cluster label of each point
+    """
+    from sklearn.cluster import KMeans, MiniBatchKMeans
+
+    points = coords.repeat(weights.astype(int), axis=0)
 
-    gdf = get_GADM_layer(country_list, gadm_level, geo_crs)
+    if algorithm == "kmeans":
+        kmeans = KMeans(init="k-means++", n_clusters=n_clusters, **kwargs)
+    elif algorithm == "minibatch_kmeans":
+        kmeans = MiniBatchKMeans(init="k-means++", n_clusters=n_clusters, **kwargs)
+    else:
+        raise ValueError(
+            f"`algorithm` must be one of 'kmeans' or 'minibatch_kmeans'. Is {algorithm}."
+        )
+    kmeans.fit(points)
 
-    def locate_bus(coords, co):
+    return kmeans.predict(coords)
 
-        gdf_co = gdf[
-            gdf["GID_{}".format(gadm_level)].str.contains(
-                two_2_three_digits_country(co)
-            )
-        ]
-        point = Point(coords["x"], coords["y"])
 
-        try:
-            return gdf_co[gdf_co.contains(point)]["GID_{}".format(gadm_level)].item()
+def hierarchical_for_points(coords, n_clusters, linkage_method="ward"):
+    """
+    Cluster points by cutting their hierarchical clustering tree.
 
-        except ValueError:
-            return gdf_co[
-                gdf_co.geometry == min(gdf_co.geometry, key=(point.distance))
-            ]["GID_{}".format(gadm_level)].item()
+    The tree only depends on the points, so several numbers of clusters can
+    be cut from the same tree in one pass.
 
-    buses = n.buses
-    buses["gadm_{}".format(gadm_level)] = buses[["x", "y", "country"]].apply(
-        lambda bus: locate_bus(bus[["x", "y"]], bus["country"]), axis=1
-    )
-    busmap = buses["gadm_{}".format(gadm_level)]
+    Parameters
+    ----------
+    coords : np.array
+        Coordinates of the points, of shape (n, 2)
+    n_clusters : int or list
+        Number of clusters, or list of numbers of clusters
+    linkage_method : str
+        Linkage method of ``scipy.cluster.hierarchy.linkage``
+
+    Returns
+    -------
+    labels : np.array
+        Cluster label of each point, of shape (n, len(n_clusters)) when
+        n_clusters is a list
+    """
+    Z = linkage(coords, method=linkage_method)
+    labels = cut_tree(Z, n_clusters=n_clusters)
+
+    return labels if np.ndim(n_clusters) else labels.ravel()
 
-    return busmap
+
+def _init_process_clustering(algorithm_, algorithm_kwds_):
+    global algorithm, algorithm_kwds
+    algorithm, algorithm_kwds = algorithm_, algorithm_kwds_
+
+
+def _process_func_clustering(task):
+    coords, weights, n_clusters = task
+    if algorithm == "hierarchical":
+        return hierarchical_for_points(coords, n_clusters, **algorithm_kwds)
+    return kmeans_for_points(coords, weights, n_clusters, algorithm, **algorithm_kwds)
 
 
 def busmap_for_n_clusters(
-    n, n_clusters, solver_name, focus_weights=None, algorithm="kmeans", **algorithm_kwds
+    n,
+    n_clusters,
+    solver_name,
+    focus_weights=None,
+    algorithm="kmeans",
+    nprocesses=None,
+    distribution_cluster=["load"],
+    gadm_shapes=None,
+    **algorithm_kwds,
 ):
+    """
+    Cluster the buses of each country and sub network.
+
+    The runs of the countries are independent and are distributed over a
+    process pool when ``nprocesses`` > 1. Every k-means run uses the same
+    ``random_state``, so the busmap does not depend on the number of
+    processes. The "hierarchical" algorithm cuts a Ward tree of the bus
+    coordinates instead, which ignores the bus weights. As the tree does not
+    depend on the number of clusters, a list of numbers of clusters can be
+    given for this algorithm to cut all busmaps from one tree per country.
+
+    Parameters
+    ----------
+    n : pypsa.Network
+    n_clusters : int or list
+        Total number of clusters, a list is only supported by the
+        "hierarchical" algorithm
+    solver_name : str
+        Unused, see ``distribute_clusters``
+    focus_weights : dict
+        Share of the clusters assigned to selected countries
+    algorithm : str
+        "kmeans", "minibatch_kmeans" or "hierarchical"
+    nprocesses : int
+        Number of processes of the pool, serial execution if None or 1
+    distribution_cluster, gadm_shapes
+        Passed to ``distribute_clusters``
+    **algorithm_kwds
+        Passed to ``kmeans_for_points`` or ``hierarchical_for_points``
+
+    Returns
+    -------
+    busmap : pd.Series or pd.DataFrame
+        Mapping of the buses to the clusters, with one column per number of
+        clusters when n_clusters is a list
+    """
     if algorithm == "kmeans":
         algorithm_kwds.setdefault("n_init", 1000)
         algorithm_kwds.setdefault("max_iter", 30000)
         algorithm_kwds.setdefault("tol", 1e-6)
         algorithm_kwds.setdefault("random_state", 0)
+    elif algorithm == "minibatch_kmeans":
+        algorithm_kwds.setdefault("n_init", 10)
+        algorithm_kwds.setdefault("max_no_improvement", 10)
+        algorithm_kwds.setdefault("random_state", 0)
+    elif algorithm == "hierarchical":
+        algorithm_kwds.setdefault("linkage_method", "ward")
+    else:
+        raise ValueError(
+            "`algorithm` must be one of 'kmeans', 'minibatch_kmeans' or "
+            f"'hierarchical'. Is {algorithm}."
+        )
+
+    multiple = np.ndim(n_clusters) > 0
+    if multiple and algorithm != "hierarchical":
+        raise ValueError(
+            "A list of numbers of clusters is only supported by the "
+            f"'hierarchical' algorithm. Is {algorithm}."
+        )
+    n_clusters_list = list(n_clusters) if multiple else [n_clusters]
 
     n.determine_network_topology()
     # n.lines.loc[:, "sub_network"] = "0"  # current fix
 
-    if n.buses.country.nunique() > 1:
-        n_clusters = distribute_clusters(
-            n, n_clusters, focus_weights=focus_weights, solver_name=solver_name
-        )
+    # the bus weights are shared by all country groups, the hierarchical
+    # algorithm does not use them
+    if algorithm == "hierarchical":
+        gen = load = None
+    else:
+        gen, load = conventional_capacity_and_load(n)
 
-    def reduce_network(n, buses):
-        nr = pypsa.Network()
-        nr.import_components_from_dataframe(buses, "Bus")
-        nr.import_components_from_dataframe(
-            n.lines.loc[
-                n.lines.bus0.isin(buses.index) & n.lines.bus1.isin(buses.index)
-            ],
-            "Line",
-        )
-        return nr
+    if n.buses.country.nunique() > 1:
+        n_clusters_list = [
+            distribute_clusters(
+                n,
+                n_clusters_,
+                focus_weights=focus_weights,
+                solver_name=solver_name,
+                load=load,
+                distribution_cluster=distribution_cluster,
+                gadm_shapes=gadm_shapes,
+            )
+            for n_clusters_ in n_clusters_list
+        ]
 
-    def busmap_for_country(x):
+    groups = []
+    tasks = []
+    # TODO: 2. Add sub_networks (see previous TODO)
+    for (country, sub_network), x in n.buses.groupby(["country", "sub_network"]):
 
         # A number of the countries in the clustering can be > 1
-        if isinstance(n_clusters, pd.Series):
-            n_cluster_c = n_clusters[x.name[0]]
-        else:
-            n_cluster_c = n_clusters
+        n_cluster_c = [
+            n_clusters_[country] if isinstance(n_clusters_, pd.Series) else n_clusters_
+            for n_clusters_ in n_clusters_list
+        ]
 
-        prefix = x.name[0] + x.name[1] + " "
-        logger.debug(f"Determining busmap for country {prefix[:-1]}")
+        prefix = country + sub_network + " "
         if len(x) == 1:
-            return pd.Series(prefix + "0", index=x.index)
-        weight = weighting_for_country(n, x)
+            groups.append((prefix, x.index, None))
+            continue
 
-        if algorithm == "kmeans":
-            return prefix + busmap_by_kmeans(
-                n, weight, n_cluster_c, buses_i=x.index, **algorithm_kwds
-            )
+        groups.append((prefix, x.index, len(tasks)))
+        if algorithm == "hierarchical":
+            tasks.append((x[["x", "y"]].values, None, n_cluster_c))
+        else:
+            weight = weighting_for_country(n, x, gen, load)
+            tasks.append((x[["x", "y"]].values, weight.values, n_cluster_c[0]))
+
+    logger.info(f"Clustering {len(tasks)} country groups with {algorithm}")
+    if nprocesses is None or nprocesses == 1:
+        _init_process_clustering(algorithm, algorithm_kwds)
+        labels = list(map(_process_func_clustering, tasks))
+    else:
+        kwargs = {
+            "initializer": _init_process_clustering,
+            "initargs": (algorithm, algorithm_kwds),
+            "processes": nprocesses,
+        }
+        with mp.get_context("spawn").Pool(**kwargs) as pool:
+            labels = pool.map(_process_func_clustering, tasks, chunksize=1)
 
+    busmaps = []
+    for prefix, buses_i, task_id in groups:
+        logger.debug(f"Determining busmap for country {prefix[:-1]}")
+        if task_id is None:
+            busmaps.append(
+                pd.DataFrame(
+                    prefix + "0", index=buses_i, columns=range(len(n_clusters_list))
+                )
+            )
         else:
-            raise ValueError(
-                f"`algorithm` must be one of 'kmeans' or 'louvain'. Is {algorithm}."
+            busmaps.append(
+                prefix
+                + pd.DataFrame(
+                    np.asarray(labels[task_id]).reshape(len(buses_i), -1),
+                    index=buses_i,
+                ).astype(str)
             )
+    busmap = pd.concat(busmaps)
 
-    return (
-        n.buses.groupby(
-            ["country", "sub_network"],  # TODO: 2. Add sub_networks (see previous TODO)
-            # ["country"],
-            group_keys=False,
-        )
-        .apply(busmap_for_country)
-        .squeeze()
-        .rename("busmap")
-    )
+    if multiple:
+        busmap.columns = list(n_clusters)
+        return busmap
+    return busmap.iloc[:, 0].rename("busmap")
 
 
 def clustering_for_n_clusters(
@@ -406,8 +645,7 @@ def clustering_for_n_clusters(
     n_clusters,
     alternative_clustering,
     gadm_layer_id,
-    geo_crs,
-    country_list,
+    gadm_shapes,
     custom_busmap=False,
     aggregate_carriers=None,
     line_length_factor=1.25,
@@ -416,6 +654,9 @@ def clustering_for_n_clusters(
     algorithm="kmeans",
     extended_link_costs=0,
     focus_weights=None,
+    nprocesses=None,
+    algorithm_kwds=dict(),
+    distribution_cluster=["load"],
 ):
 
     bus_strategies, generator_strategies = get_aggregation_strategies(
@@ -424,10 +665,18 @@ def clustering_for_n_clusters(
 
     if not isinstance(custom_busmap, pd.Series):
         if alternative_clustering:
-            busmap = busmap_for_gadm_clusters(n, gadm_layer_id, geo_crs, country_list)
+            busmap = busmap_for_gadm_clusters(n, gadm_layer_id, gadm_shapes)
         else:
             busmap = busmap_for_n_clusters(
-                n, n_clusters, solver_name, focus_weights, algorithm
+                n,
+                n_clusters,
+                solver_name,
+                focus_weights,
+                algorithm,
+                nprocesses,
+                distribution_cluster=distribution_cluster,
+                gadm_shapes=gadm_shapes,
+                **algorithm_kwds,
             )
     else:
         busmap = custom_busmap
@@ -501,8 +750,6 @@ if __name__ == "__main__":
     ]
     gadm_layer_id = snakemake.config["build_shape_options"]["gadm_layer_id"]
     focus_weights = snakemake.config.get("focus_weights", None)
-    country_list = snakemake.config["countries"]
-    geo_crs = snakemake.config["crs"]["geo_crs"]
 
     if alternative_clustering:  # TODO load all techs in both cases
         renewable_carriers = pd.Index(
@@ -568,23 +815,37 @@ if __name__ == "__main__":
             )
             busmap.index = busmap.index.astype(str)
             logger.info(f"Imported custom busmap from {snakemake.input.custom_busmap}")
-        cluster_config = snakemake.config.get("cluster_options", {}).get(
-            "cluster_network", {}
-        )
+        cluster_options = snakemake.config.get("cluster_options", {})
+        algorithm = cluster_options.get("algorithm", "kmeans")
+        if (
+            algorithm == "hierarchical"
+            and cluster_options.get("hierarchy_cache", False)
+            and not alternative_clustering
+            and not custom_busmap
+        ):
+            # busmaps of the configured resolutions, cut by build_cluster_hierarchy
+            busmaps = pd.read_csv(
+                snakemake.input.cluster_hierarchy, index_col=0, dtype=str
+            )
+            if str(n_clusters) in busmaps.columns:
+                custom_busmap = busmaps[str(n_clusters)].rename("busmap")
+                logger.info(f"Imported busmap from {snakemake.input.cluster_hierarchy}")
         clustering = clustering_for_n_clusters(
             n,
             n_clusters,
             alternative_clustering,
             gadm_layer_id,
-            geo_crs,
-            country_list,
+            snakemake.input.gadm_shapes,
             custom_busmap,
             aggregate_carriers,
             line_length_factor,
             aggregation_strategies,
             solver_name=snakemake.config["solving"]["solver"]["name"],
+            algorithm=algorithm,
             extended_link_costs=hvac_overhead_cost,
             focus_weights=focus_weights,
+            nprocesses=cluster_options.get("nprocesses"),
+            distribution_cluster=cluster_options["distribute_cluster"],
         )
 
     update_p_nom_max(clustering.network)
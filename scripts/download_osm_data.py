@@ -21,10 +21,12 @@ import shutil
 import sys
 
 import geopandas as gpd
+import numpy as np
 import pandas as pd
 import requests
+import shapely
 import urllib3
-from _helpers import configure_logging, sets_path_to_root, to_csv_nafix
+from _helpers import configure_logging, save_geodata, sets_path_to_root, to_csv_nafix
 from config_osm_data import (
     continent_regions,
     continents,
@@ -34,6 +36,7 @@ from config_osm_data import (
     world_geofk,
     world_iso,
 )
+from esy.osm.pbf import iter_blocks, osmformat_pb2, read_blob
 from esy.osmfilter import Node, Relation, Way
 from esy.osmfilter import osm_info as osm_info
 from esy.osmfilter import osm_pickle as osm_pickle
@@ -299,6 +302,298 @@ def download_and_filter(feature, country_code, update=False, verify=False):
     return feature_data
 
 
+def _iter_pbf_data_blocks(PBF_inputfile):
+    """Iterate over the decoded data blocks (PrimitiveBlock) of a pbf file"""
+    with open(PBF_inputfile, "rb") as f:
+        for offset, header in iter_blocks(f):
+            if header.type != "OSMData":
+                continue
+            block = osmformat_pb2.PrimitiveBlock()
+            block.ParseFromString(read_blob(f, offset, header.datasize))
+            yield block
+
+
+def _decode_tags(strmap, keys, vals):
+    """Decode the tags of an OSM element from the indices of the string table"""
+    return dict(zip(map(strmap.__getitem__, keys), map(strmap.__getitem__, vals)))
+
+
+def _compact_coords(block, lon, lat):
+    """
+    Store the coordinates of the nodes of a block compactly: in units of 1e-7
+    degrees (the precision of OSM) as int32 when exact, as float64 degrees
+    otherwise
+
+    Parameters
+    ----------
+    lon, lat : np.array
+        Delta-decoded coordinates of the nodes, in units of the granularity
+    """
+    granularity = block.granularity or 100
+    nano = np.column_stack(
+        [block.lon_offset + granularity * lon, block.lat_offset + granularity * lat]
+    )
+    if np.all(nano % 100 == 0):
+        return (nano // 100).astype(np.int32)
+    return 0.000000001 * nano
+
+
+def _coords_to_lonlat(coords):
+    """Convert the compact coordinates of _compact_coords into degrees"""
+    if coords.dtype == np.int32:
+        return 0.000000001 * (coords.astype(np.int64) * 100)
+    return coords
+
+
+def _extract_dense_nodes(block, dense, strmap, power_key, feature_ids):
+    """
+    Decode the dense nodes of a block: the compact coordinates of all nodes
+    and the power nodes among them
+
+    Returns
+    -------
+    ids : np.array
+        Identifiers of the nodes
+    coords : np.array
+        Compact coordinates of the nodes, see _compact_coords
+    power_nodes : list
+        List of (feature, id, tags, lonlat) of the nodes with the requested power tag
+    """
+    ids = np.cumsum(np.asarray(dense.id, dtype=np.int64))
+    coords = _compact_coords(
+        block,
+        np.cumsum(np.asarray(dense.lon, dtype=np.int64)),
+        np.cumsum(np.asarray(dense.lat, dtype=np.int64)),
+    )
+
+    power_nodes = []
+    keys_vals = np.asarray(dense.keys_vals, dtype=np.int64)
+    if power_key is None or keys_vals.size == 0:
+        return ids, coords, power_nodes
+
+    # keys_vals stores the pairs (key, value) of each node, terminated by a 0
+    is_sep = keys_vals == 0
+    sep_pos = np.flatnonzero(is_sep)
+    starts = np.concatenate([[0], sep_pos[:-1] + 1])
+    node_of = np.cumsum(is_sep) - is_sep
+    offset = np.arange(keys_vals.size) - starts[node_of]
+
+    # positions of the power keys having a requested value
+    key_pos = np.flatnonzero(~is_sep & (offset % 2 == 0) & (keys_vals == power_key))
+    key_pos = key_pos[np.isin(keys_vals[key_pos + 1], list(feature_ids))]
+
+    for pos in key_pos:
+        node = node_of[pos]
+        node_kv = keys_vals[starts[node] : sep_pos[node]]
+        tags = _decode_tags(strmap, node_kv[0::2], node_kv[1::2])
+        power_nodes.append(
+            (
+                feature_ids[keys_vals[pos + 1]],
+                ids[node],
+                tags,
+                _coords_to_lonlat(coords[node]).tolist(),
+            )
+        )
+
+    return ids, coords, power_nodes
+
+
+def _extract_plain_nodes(block, nodes, strmap, power_key, feature_ids):
+    """
+    Decode the (non-dense) nodes of a block: the compact coordinates of all
+    nodes and the power nodes among them, see _extract_dense_nodes
+    """
+    ids = np.fromiter((node.id for node in nodes), dtype=np.int64, count=len(nodes))
+    coords = _compact_coords(
+        block,
+        np.fromiter((node.lon for node in nodes), dtype=np.int64, count=len(nodes)),
+        np.fromiter((node.lat for node in nodes), dtype=np.int64, count=len(nodes)),
+    )
+
+    power_nodes = []
+    if power_key is None:
+        return ids, coords, power_nodes
+
+    for i, node in enumerate(nodes):
+        if power_key not in node.keys:
+            continue
+        tags = _decode_tags(strmap, node.keys, node.vals)
+        if tags.get("power") in feature_ids.values():
+            power_nodes.append(
+                (tags["power"], ids[i], tags, _coords_to_lonlat(coords[i]).tolist())
+            )
+
+    return ids, coords, power_nodes
+
+
+def extract_pbf_features(PBF_inputfile, feature_list):
+    """
+    Extract all the requested power features of a pbf file.
+
+    Differently from esy.osmfilter, no intermediate Data.pickle is created and
+    the file is read and decoded once. As the nodes precede the ways in the
+    file, the identifiers and compact coordinates of all nodes (16 bytes per
+    node) are kept during the pass, together with the power nodes and ways.
+    After the pass, only the nodes referenced by the power ways are kept in a
+    sorted id -> lonlat array index, which resolves the node references of
+    the ways by a vectorized lookup.
+
+    Parameters
+    ----------
+    PBF_inputfile : str
+        Path of the pbf file
+    feature_list : list
+        List of the power features to extract, e.g. ["substation", "line"]
+
+    Returns
+    -------
+    features_data : dict
+        Dictionary feature -> (df_node, df_way) with the dataframes of the
+        nodes and ways of each feature; the ways contain the resolved "lonlat"
+        coordinates
+    """
+    features = set(feature_list)
+
+    nodes = {feature: [] for feature in feature_list}
+    ways = {feature: [] for feature in feature_list}
+    node_blocks = []
+
+    for block in _iter_pbf_data_blocks(PBF_inputfile):
+        strmap = tuple(s.decode("utf8") for s in block.stringtable.s)
+
+        # string ids of the power key and of the requested values, if any
+        power_key = strmap.index("power") if "power" in strmap else None
+        feature_ids = {i: s for i, s in enumerate(strmap) if s in features}
+
+        for group in block.primitivegroup:
+            extracted = []
+            if len(group.dense.id) > 0:
+                extracted.append(
+                    _extract_dense_nodes(
+                        block, group.dense, strmap, power_key, feature_ids
+                    )
+                )
+            if len(group.nodes) > 0:
+                extracted.append(
+                    _extract_plain_nodes(
+                        block, group.nodes, strmap, power_key, feature_ids
+                    )
+                )
+
+            for ids, coords, power_nodes in extracted:
+                node_blocks.append((ids, coords))
+                for feature, id, tags, lonlat in power_nodes:
+                    nodes[feature].append({"id": id, "tags": tags, "lonlat": lonlat})
+
+            if power_key is None:
+                continue
+            for way in group.ways:
+                if power_key not in way.keys:
+                    continue
+                tags = _decode_tags(strmap, way.keys, way.vals)
+                if tags.get("power") in features:
+                    ways[tags["power"]].append(
+                        {
+                            "id": way.id,
+                            "tags": tags,
+                            "refs": np.cumsum(np.asarray(way.refs, dtype=np.int64)),
+                        }
+                    )
+
+    all_refs = [way["refs"] for feature in feature_list for way in ways[feature]]
+    ref_ids = np.unique(np.concatenate(all_refs)) if all_refs else np.empty(0, int)
+
+    # id -> lonlat index of the referenced nodes; the blocks of all nodes are
+    # released as they are filtered
+    node_ids, node_lonlat = [], []
+    node_blocks.reverse()
+    while node_blocks:
+        ids, coords = node_blocks.pop()
+        is_ref = np.isin(ids, ref_ids, assume_unique=True)
+        node_ids.append(ids[is_ref])
+        node_lonlat.append(_coords_to_lonlat(coords[is_ref]).reshape(-1, 2))
+    node_ids = np.concatenate(node_ids) if node_ids else np.empty(0, dtype=np.int64)
+    node_lonlat = np.concatenate(node_lonlat) if node_lonlat else np.empty((0, 2))
+    if np.any(np.diff(node_ids) < 0):
+        order = np.argsort(node_ids, kind="stable")
+        node_ids, node_lonlat = node_ids[order], node_lonlat[order]
+
+    features_data = {}
+    for feature in feature_list:
+        df_node = pd.json_normalize(nodes[feature])
+        df_way = pd.json_normalize(ways[feature])
+
+        if not df_way.empty:
+            df_way["lonlat"] = _lonlat_index_lookup(
+                df_way["refs"], node_ids, node_lonlat
+            )
+            df_way["refs"] = df_way["refs"].map(list)
+
+            # drop ways whose nodes are all missing
+            is_missing = df_way["lonlat"].map(len) == 0
+            if is_missing.any():
+                _logger.warning(
+                    f"Dropped {is_missing.sum()} {feature} ways with no node coordinates in {PBF_inputfile}"
+                )
+                df_way = df_way[~is_missing].reset_index(drop=True)
+
+        features_data[feature] = df_node, df_way
+
+    return features_data
+
+
+def _lonlat_index_lookup(refs, node_ids, node_lonlat):
+    """Resolve the node references of the ways by the sorted array index of the nodes"""
+    lengths = refs.map(len).values
+    all_refs = np.concatenate(refs.values) if len(refs) > 0 else np.empty(0)
+
+    pos = np.searchsorted(node_ids, all_refs)
+    pos[pos >= len(node_ids)] = 0
+    if len(node_ids) > 0:
+        found = node_ids[pos] == all_refs
+    else:
+        found = np.zeros(len(pos), dtype=bool)
+    if not found.all():
+        _logger.warning(f"{(~found).sum()} node references not found in the pbf file")
+
+    # split the coordinates of the found nodes by way
+    way_of = np.repeat(np.arange(len(refs)), lengths)[found]
+    counts = np.bincount(way_of, minlength=len(refs))
+    coords = np.split(node_lonlat[pos[found]], np.cumsum(counts)[:-1])
+
+    lonlat_list = [list(map(tuple, c.tolist())) for c in coords]
+
+    return lonlat_list
+
+
+def download_and_extract(country_code, feature_list, update=False, verify=False):
+    """
+    Download the OpenStreetMap raw file of a country and extract all the
+    requested power features in a single pass over the file.
+
+    Parameters
+    ----------
+    country_code : str
+        Geofabrik country code of the downloaded file
+    feature_list : list
+        List of the power features to extract
+    update : bool
+        Update = true, forces re-download of files
+    verify : bool
+        Verify = true, checks the md5 of the downloaded file
+
+    Returns
+    -------
+    features_data : dict
+        Dictionary feature -> (df_node, df_way), see extract_pbf_features
+    """
+    PBF_inputfile = download_pbf(country_code, update, verify)
+
+    _logger.info(f"Extracting {', '.join(feature_list)} from {PBF_inputfile}")
+
+    return extract_pbf_features(PBF_inputfile, feature_list)
+
+
 def convert_filtered_data_to_dfs(country_code, feature_data, feature):
     """Convert Filtered Data, Elements to Pandas Dataframes"""
     Data, Elements = feature_data
@@ -323,72 +618,147 @@ def lonlat_lookup(df_way, Data):
     return lonlat_list
 
 
+def _flatten_lonlat(lonlat_list):
+    """Flatten a list of coordinate lists into a coordinate array and the list lengths"""
+    lengths = np.fromiter(map(len, lonlat_list), dtype=np.int64, count=len(lonlat_list))
+    coords = np.array(
+        [lonlat for lonlats in lonlat_list for lonlat in lonlats], dtype=float
+    ).reshape(-1, 2)
+    return coords, lengths
+
+
+def _geometries_from_coords(coords, lengths, geom_type):
+    """
+    Build the LineString or Polygon geometries from the flat array of their
+    coordinates; the first lengths[i] coordinates belong to the first geometry,
+    and so on.
+    Shapely >= 2.0 vectorized constructors are used when available.
+    """
+    if hasattr(shapely, "linestrings"):  # shapely >= 2.0
+        indices = np.repeat(np.arange(len(lengths)), lengths)
+        if geom_type == "LineString":
+            return shapely.linestrings(coords, indices=indices)
+        return shapely.polygons(shapely.linearrings(coords, indices=indices))
+
+    constructor = LineString if geom_type == "LineString" else Polygon
+    return np.array(
+        [constructor(c) for c in np.split(coords, np.cumsum(lengths)[:-1])],
+        dtype=object,
+    )
+
+
+def build_lines_from_lonlat(lonlat_list, crs=OSM_CRS):
+    """
+    Build the LineStrings of the ways from their list of coordinates.
+    The ways with less than two coordinates have no geometry.
+    """
+    coords, lengths = _flatten_lonlat(lonlat_list)
+    geometries = np.full(len(lengths), None, dtype=object)
+
+    is_line = lengths >= 2
+    coords_line = coords[np.repeat(is_line, lengths)]
+    geometries[is_line] = _geometries_from_coords(
+        coords_line, lengths[is_line], "LineString"
+    )
+
+    return gpd.GeoSeries(geometries, index=lonlat_list.index, crs=crs)
+
+
 def convert_ways_points(df_way, Data, geo_crs, distance_crs):
     """Convert Ways to Point Coordinates"""
-    lonlat_list = lonlat_lookup(df_way, Data)
-    way_polygon = list(
-        map(
-            lambda lonlat: Polygon(lonlat) if len(lonlat) >= 3 else Point(lonlat[0]),
-            lonlat_list,
-        )
+    if "lonlat" in df_way.columns:
+        lonlat_list = df_way.pop("lonlat")
+    else:
+        lonlat_list = lonlat_lookup(df_way, Data)
+
+    coords, lengths = _flatten_lonlat(lonlat_list)
+    first_pos = np.cumsum(lengths) - lengths
+
+    # ways with at least 3 points are polygons, the others are represented by their first point
+    is_polygon = lengths >= 3
+    way_polygon = np.array(
+        gpd.points_from_xy(coords[first_pos, 0], coords[first_pos, 1]), dtype=object
     )
-    area_column = list(
-        map(
-            int,
-            round(
-                gpd.GeoSeries(way_polygon).set_crs(geo_crs).to_crs(distance_crs).area,
-                -1,
-            ),
-        )
+    coords_polygon = coords[np.repeat(is_polygon, lengths)]
+    way_polygon[is_polygon] = _geometries_from_coords(
+        coords_polygon, lengths[is_polygon], "Polygon"
+    )
+    way_polygon = gpd.GeoSeries(way_polygon, index=df_way.index)
+
+    area_column = (
+        way_polygon.set_crs(geo_crs)
+        .to_crs(distance_crs)
+        .area.round(-1)
+        .astype(int)
+        .tolist()
     )
 
-    def find_center_point(p):
-        if p.geom_type == "Polygon":
-            center_point = p.centroid
-        else:
-            center_point = p
-        return list((center_point.x, center_point.y))
-
-    lonlat_column = list(map(find_center_point, way_polygon))
+    # the centroid of the points is the point itself
+    center_point = way_polygon.centroid
+    lonlat_column = np.column_stack([center_point.x, center_point.y]).tolist()
 
     df_way.insert(0, "Area", area_column)
     df_way.insert(0, "lonlat", lonlat_column)
 
 
 def convert_ways_lines(df_way, Data, geo_crs, distance_crs):
-    """Convert Ways to Line Coordinates"""
-    lonlat_list = lonlat_lookup(df_way, Data)
+    """
+    Convert Ways to Line Coordinates
+
+    The LineString geometries are stored in the "geometry" column to be
+    reused by convert_pd_to_gdf_lines
+    """
+    if "lonlat" in df_way.columns:
+        lonlat_list = df_way.pop("lonlat")
+    else:
+        lonlat_list = lonlat_lookup(df_way, Data)
     lonlat_column = lonlat_list
     df_way.insert(0, "lonlat", lonlat_column)
 
-    way_linestring = map(lambda lonlats: LineString(lonlats), lonlat_list)
-    length_column = (
-        gpd.GeoSeries(way_linestring).set_crs(geo_crs).to_crs(distance_crs).length
-    )
+    way_linestring = build_lines_from_lonlat(lonlat_list, crs=geo_crs)
+    length_column = way_linestring.to_crs(distance_crs).length
 
     df_way.insert(0, "Length", length_column)
+    df_way["geometry"] = way_linestring.values
 
 
 def convert_pd_to_gdf_nodes(df_way, geo_crs):
     """Convert Points Pandas Dataframe to GeoPandas Dataframe"""
+    lonlat = np.array(df_way["lonlat"].tolist(), dtype=float).reshape(-1, 2)
     gdf = gpd.GeoDataFrame(
-        df_way, geometry=[Point(x, y) for x, y in df_way.lonlat], crs=OSM_CRS
-    ).to_crs(geo_crs)
+        df_way,
+        geometry=gpd.points_from_xy(lonlat[:, 0], lonlat[:, 1]),
+        crs=OSM_CRS,
+    )
+    if gdf.crs != geo_crs:
+        gdf = gdf.to_crs(geo_crs)
     gdf.drop(columns=["lonlat"], inplace=True)
     return gdf
 
 
 def convert_pd_to_gdf_lines(df_way, geo_crs, simplified=False):
-    """Convert Lines Pandas Dataframe to GeoPandas Dataframe"""
-    if simplified is True:
-        df_way["geometry"] = df_way["geometry"].apply(
-            lambda x: x.simplify(0.005, preserve_topology=False)
-        )
+    """
+    Convert Lines Pandas Dataframe to GeoPandas Dataframe
+
+    The geometries built by convert_ways_lines are reused when available
+    """
+    if "geometry" in df_way.columns and df_way["geometry"].notnull().all():
+        geometry = gpd.GeoSeries(df_way["geometry"].values, index=df_way.index)
+    else:
+        geometry = build_lines_from_lonlat(df_way["lonlat"])
 
     gdf = gpd.GeoDataFrame(
-        df_way, geometry=[LineString(x) for x in df_way.lonlat], crs=OSM_CRS
-    ).to_crs(geo_crs)
-    gdf.drop(columns=["lonlat"], inplace=True)
+        df_way.drop(columns="geometry", errors="ignore"),
+        geometry=geometry.values,
+        crs=OSM_CRS,
+    )
+    if gdf.crs != geo_crs:
+        gdf = gdf.to_crs(geo_crs)
+
+    if simplified is True:
+        gdf["geometry"] = gdf["geometry"].simplify(0.005, preserve_topology=False)
+
+    gdf.drop(columns=["lonlat"], inplace=True, errors="ignore")
 
     return gdf
 
@@ -421,18 +791,32 @@ def convert_iso_to_geofk(iso_code, iso_coding=True, convert_dict=iso_to_geofk_di
         return iso_code
 
 
-def output_csv_geojson(output_files, df_all_feature, columns_feature, feature, geo_crs):
-    """Function to save the feature as csv and geojson"""
+def output_csv_geojson(
+    output_files,
+    df_all_feature,
+    columns_feature,
+    feature,
+    geo_crs,
+    export_geojson=False,
+):
+    """
+    Function to save the feature as csv and as geodata file, whose format,
+    GeoParquet or GeoJSON, is given by the extension of the output file.
+    When export_geojson is True, a GeoJSON copy of the parquet file is saved too.
+    """
 
-    # get path from snakemake; expected geojson
-    path_file_geojson = output_files[feature + "s"]
-    if not path_file_geojson.endswith(".geojson"):
-        _logger.error(f"Output file feature {feature} is not a geojson file")
-    path_file_csv = path_file_geojson.replace(".geojson", ".csv")  # get csv file
+    # get path from snakemake; expected parquet or geojson
+    path_file_geo = output_files[feature + "s"]
+    path_root, path_ext = os.path.splitext(path_file_geo)
+    if path_ext not in [".parquet", ".geojson"]:
+        _logger.error(
+            f"Output file feature {feature} is neither a parquet nor a geojson file"
+        )
+    path_file_csv = path_root + ".csv"  # get csv file
 
-    if not os.path.exists(path_file_geojson):
+    if not os.path.exists(path_file_geo):
         os.makedirs(
-            os.path.dirname(path_file_geojson), exist_ok=True
+            os.path.dirname(path_file_geo), exist_ok=True
         )  # create raw directory
 
     # check dataframe structure to avoid KeyErrors
@@ -441,14 +825,13 @@ def output_csv_geojson(output_files, df_all_feature, columns_feature, feature, g
             _logger.warning(f"Store empty Dataframe for {feature} as geometry missed.")
             gdf_feature = []
             # create empty file to avoid issues with snakemake
-            with open(path_file_geojson, "w") as fp:
-                pass
+            save_geodata(pd.DataFrame(), path_file_geo, export_geojson)
             return None
         # TODO: is it possible to have "geometry" without "lonlat"?
         else:
             # TODO: is it possible that nodes dataframe will also be empty?
             gdf_feature = convert_pd_to_gdf_lines(df_all_feature, geo_crs)
-            gdf_feature.to_file(path_file_geojson, driver="GeoJSON")  # Generate GeoJson
+            save_geodata(gdf_feature, path_file_geo, export_geojson)
             return None
 
     # remove non-line elements
@@ -459,21 +842,23 @@ def output_csv_geojson(output_files, df_all_feature, columns_feature, feature, g
         )
         df_all_feature = df_all_feature[is_linestring]
 
+    # keep the geometries already built, if any
     df_all_feature = df_all_feature[
-        df_all_feature.columns.intersection(set(columns_feature))
+        df_all_feature.columns.intersection(set(columns_feature + ["geometry"]))
     ]
     df_all_feature.reset_index(drop=True, inplace=True)
 
     # Generate Files
-    to_csv_nafix(df_all_feature, path_file_csv)  # Generate CSV
+    to_csv_nafix(
+        df_all_feature.drop(columns="geometry", errors="ignore"), path_file_csv
+    )  # Generate CSV
 
     if df_all_feature.empty:
         _logger.warning(f"Store empty Dataframe for {feature}.")
         gdf_feature = []
 
         # create empty file to avoid issues with snakemake
-        with open(path_file_geojson, "w") as fp:
-            pass
+        save_geodata(df_all_feature, path_file_geo, export_geojson)
 
         return None
 
@@ -482,8 +867,8 @@ def output_csv_geojson(output_files, df_all_feature, columns_feature, feature, g
     else:
         gdf_feature = convert_pd_to_gdf_nodes(df_all_feature, geo_crs)
 
-    _logger.info("Writing GeoJSON file")
-    gdf_feature.to_file(path_file_geojson, driver="GeoJSON")  # Generate GeoJson
+    _logger.info(f"Writing {path_ext[1:]} file")
+    save_geodata(gdf_feature, path_file_geo, export_geojson)
 
 
 # Auxiliary function to initialize the parallel data download
@@ -532,73 +917,203 @@ def parallel_download_pbf(country_list, nprocesses, update=False, verify=False):
             pass
 
 
-def process_data(
-    feature_list,
-    country_list,
-    output_files,
-    geo_crs,
-    distance_crs,
-    iso_coding=True,
-    update=False,
-    verify=False,
-    nprocesses=1,
+def process_country(
+    country_code, feature_list, distance_crs, update=False, verify=False, streaming=True
 ):
     """
-    Download the features in feature_list for each country of the country_list
-    """
-
-    # parallel download of data if parallel download is enabled
-    if nprocesses > 1:
-        _logger.info(
-            f"Parallel raw osm data (pbf files) download with {nprocesses} threads"
-        )
-        parallel_download_pbf(country_list, nprocesses, update, verify)
-
-    # loop the request for each feature
+    Download and process all the features in feature_list for a single country
 
-    for feature in feature_list:  # feature dataframe
+    Parameters
+    ----------
+    country_code : str
+        Geofabrik country code
+    feature_list : list
+        List of the power features to process
+    distance_crs : str
+        Metric crs used to calculate lengths and areas
+    update : bool
+        Update = true, forces re-download of files
+    verify : bool
+        Verify = true, checks the md5 of the downloaded file
+    streaming : bool
+        When true, all the features are extracted together from the pbf file
+        (see extract_pbf_features); otherwise, esy.osmfilter is run for every
+        feature
 
-        df_list = []
+    Returns
+    -------
+    df_features : dict
+        Dictionary feature -> DataFrame of the nodes and ways of the feature
+    """
+    if streaming:
+        features_data = download_and_extract(country_code, feature_list, update, verify)
 
-        for country_code_isogeofk in country_list:
+    df_features = {}
 
-            country_code = convert_iso_to_geofk(country_code_isogeofk, iso_coding)
+    for feature in feature_list:
 
+        if streaming:
+            df_node, df_way = features_data.pop(feature)
+            Data = None
+        else:
             feature_data = download_and_filter(feature, country_code, update, verify)
 
             df_node, df_way, Data = convert_filtered_data_to_dfs(
                 country_code, feature_data, feature
             )
 
-            if feature_category[feature] == "way":
-                convert_ways_lines(
-                    df_way, Data, OSM_CRS, distance_crs
-                ) if not df_way.empty else _logger.warning(
-                    f"Empty Way Dataframe for {feature} in {country_code}"
+        if feature_category[feature] == "way":
+            convert_ways_lines(
+                df_way, Data, OSM_CRS, distance_crs
+            ) if not df_way.empty else _logger.warning(
+                f"Empty Way Dataframe for {feature} in {country_code}"
+            )
+            if not df_node.empty:
+                _logger.warning(
+                    f"Node dataframe not empty for {feature} in {country_code}"
                 )
-                if not df_node.empty:
-                    _logger.warning(
-                        f"Node dataframe not empty for {feature} in {country_code}"
-                    )
 
-            if feature_category[feature] == "node":
-                convert_ways_points(
-                    df_way, Data, OSM_CRS, distance_crs
-                ) if not df_way.empty else None
+        if feature_category[feature] == "node":
+            convert_ways_points(
+                df_way, Data, OSM_CRS, distance_crs
+            ) if not df_way.empty else None
+
+        # Add Type Column
+        df_node["Type"] = "Node"
+        df_way["Type"] = "Way"
+
+        # Concat. Nodes and Ways
+        df_feature = pd.concat([df_node, df_way], axis=0)
+
+        # Add Country Column with GeoFabrik coding
+        df_feature["Country"] = country_code
+
+        df_features[feature] = df_feature
+
+    return df_features
 
-            # Add Type Column
-            df_node["Type"] = "Node"
-            df_way["Type"] = "Way"
 
-            # Concat. Nodes and Ways
-            df_feature = pd.concat([df_node, df_way], axis=0)
+# Auxiliary function to initialize the parallel data processing
+def _init_process_country(feature_list_, distance_crs_, update_, verify_):
+    global feature_list, distance_crs, update, verify
+    feature_list, distance_crs, update, verify = (
+        feature_list_,
+        distance_crs_,
+        update_,
+        verify_,
+    )
+
+
+# Auxiliary function to process the data of a country
+def _process_func_country(c_code):
+    return process_country(
+        c_code, feature_list, distance_crs, update, verify, streaming=True
+    )
+
+
+def parallel_process_countries(
+    country_list, feature_list, distance_crs, nprocesses, update=False, verify=False
+):
+    """
+    Function to download and process the data of the countries in parallel,
+    one country per process
+
+    Parameters
+    ----------
+    country_list : list
+        List of geofabrik country codes to process
+    feature_list : list
+        List of the power features to process
+    distance_crs : str
+        Metric crs used to calculate lengths and areas
+    nprocesses : int
+        Number of parallel processes
+    update : bool
+        If true, existing pbf files are updated. Default: False
+    verify : bool
+        If true, checks the md5 of the file. Default: False
+
+    Returns
+    -------
+    country_features : list
+        List of dictionaries feature -> DataFrame, one per country
+    """
+
+    # argument for the parallel processing
+    kwargs = {
+        "initializer": _init_process_country,
+        "initargs": (feature_list, distance_crs, update, verify),
+        "processes": nprocesses,
+    }
+
+    # execute the parallel processing with tqdm progressbar
+    with mp.get_context("spawn").Pool(**kwargs) as pool:
+        country_features = list(
+            tqdm(
+                pool.imap(_process_func_country, country_list),
+                ascii=False,
+                unit=" countries",
+                total=len(country_list),
+                desc="Process pbf ",
+            )
+        )
+
+    return country_features
+
+
+def process_data(
+    feature_list,
+    country_list,
+    output_files,
+    geo_crs,
+    distance_crs,
+    iso_coding=True,
+    update=False,
+    verify=False,
+    nprocesses=1,
+    streaming=True,
+    export_geojson=False,
+):
+    """
+    Download the features in feature_list for each country of the country_list
+
+    Every country is processed once for all the features by process_country.
+    When streaming is True, all the features are extracted together from
+    each pbf file in a single pass (see extract_pbf_features) and the
+    countries are processed in parallel when nprocesses > 1;
+    otherwise, esy.osmfilter is run for every feature and country, serially,
+    as it relies on a Data.pickle file shared among the countries.
+    The features are saved in the format of the output files, see output_csv_geojson.
+    """
+
+    country_list = [convert_iso_to_geofk(c_code, iso_coding) for c_code in country_list]
 
-            # Add Country Column with GeoFabrik coding
-            df_feature["Country"] = country_code
+    if streaming and nprocesses > 1:
+        _logger.info(f"Parallel processing of the osm data with {nprocesses} processes")
+        country_features = parallel_process_countries(
+            country_list, feature_list, distance_crs, nprocesses, update, verify
+        )
+    else:
+        # parallel download of data if parallel download is enabled
+        if nprocesses > 1:
+            _logger.info(
+                f"Parallel raw osm data (pbf files) download with {nprocesses} threads"
+            )
+            parallel_download_pbf(country_list, nprocesses, update, verify)
 
-            df_list.append(df_feature)
+        country_features = [
+            process_country(
+                country_code, feature_list, distance_crs, update, verify, streaming
+            )
+            for country_code in country_list
+        ]
 
-        df_all_feature = pd.concat(df_list, ignore_index=True)
+    for feature in feature_list:  # feature dataframe
+
+        df_all_feature = pd.concat(
+            [df_features.pop(feature) for df_features in country_features],
+            ignore_index=True,
+        )
 
         output_csv_geojson(
             output_files,
@@ -606,6 +1121,7 @@ def process_data(
             feature_columns[feature],
             feature,
             geo_crs=geo_crs,
+            export_geojson=export_geojson,
         )
 
 
@@ -731,6 +1247,12 @@ if __name__ == "__main__":
     nprocesses = snakemake.config.get(
         "download_osm_data_nprocesses", 1
     )  # number of threads
+    streaming = snakemake.config.get(
+        "download_osm_data_streaming", True
+    )  # single-pass extraction of the pbf files
+    export_geojson = snakemake.config.get(
+        "osm_data_geojson_export", False
+    )  # GeoJSON copy of the parquet files
 
     # get the default and metric crs of the workflow
     geo_crs = snakemake.config["crs"]["geo_crs"]
@@ -747,4 +1269,6 @@ if __name__ == "__main__":
         update=False,
         verify=False,
         nprocesses=nprocesses,
+        streaming=streaming,
+        export_geojson=export_geojson,
     )
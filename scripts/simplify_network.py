@@ -172,8 +172,44 @@ def _prepare_connection_costs_per_link(n, costs, config):
     return connection_costs_per_link
 
 
+def _connection_costs_adjacency(n, connection_costs_per_link):
+    """
+    Build the adjacency matrices weighted by the connection costs of each
+    technology.
+
+    Parameters
+    ----------
+    n : pypsa.Network
+    connection_costs_per_link : dict
+        Connection costs of the links per technology
+
+    Returns
+    -------
+    adjacency : dict
+        Sparse adjacency matrix per technology
+    """
+    adjacency = {}
+    for tech in connection_costs_per_link:
+        weights = pd.concat(
+            dict(
+                Link=connection_costs_per_link[tech].reindex(n.links.index),
+                Line=pd.Series(0.0, n.lines.index),
+            )
+        )
+        adjacency[tech] = n.adjacency_matrix(weights=weights)
+
+    return adjacency
+
+
 def _compute_connection_costs_to_bus(
-    n, busmap, costs, config, connection_costs_per_link=None, buses=None
+    n,
+    busmap,
+    costs,
+    config,
+    connection_costs_per_link=None,
+    buses=None,
+    adjacency=None,
+    max_dense_size=5e7,
 ):
     if connection_costs_per_link is None:
         connection_costs_per_link = _prepare_connection_costs_per_link(n, costs, config)
@@ -181,23 +217,28 @@ def _compute_connection_costs_to_bus(
     if buses is None:
         buses = busmap.index[busmap.index != busmap.values]
 
+    if adjacency is None:
+        adjacency = _connection_costs_adjacency(n, connection_costs_per_link)
+
     connection_costs_to_bus = pd.DataFrame(index=buses)
 
+    # all buses are searched from in one dijkstra call, split in chunks to
+    # bound the size of the dense distance matrix
+    sources = n.buses.index.get_indexer(buses)
+    targets = n.buses.index.get_indexer(busmap.loc[buses])
+    chunk_size = max(1, int(max_dense_size // max(len(n.buses), 1)))
+
     for tech in connection_costs_per_link:
-        adj = n.adjacency_matrix(
-            weights=pd.concat(
-                dict(
-                    Link=connection_costs_per_link[tech].reindex(n.links.index),
-                    Line=pd.Series(0.0, n.lines.index),
-                )
+        costs_to_bus = np.zeros(len(buses))
+        for i in range(0, len(buses), chunk_size):
+            s = slice(i, i + chunk_size)
+            costs_between_buses = dijkstra(
+                adjacency[tech], directed=False, indices=sources[s]
             )
-        )
-        costs_between_buses = dijkstra(
-            adj, directed=False, indices=n.buses.index.get_indexer(buses)
-        )
-        connection_costs_to_bus[tech] = costs_between_buses[
-            np.arange(len(buses)), n.buses.index.get_indexer(busmap.loc[buses])
-        ]
+            costs_to_bus[s] = costs_between_buses[
+                np.arange(len(sources[s])), targets[s]
+            ]
+        connection_costs_to_bus[tech] = costs_to_bus
     return connection_costs_to_bus
 
 
@@ -313,6 +354,12 @@ def simplify_links(n, costs, config, output, aggregation_strategies=dict()):
     connection_costs_to_bus = pd.DataFrame(
         0.0, index=n.buses.index, columns=list(connection_costs_per_link)
     )
+    # the costs are computed on the links before they are joined
+    adjacency = _connection_costs_adjacency(n, connection_costs_per_link)
+    moved_buses = []
+    removed_links = []
+    new_links = {}
+    p_max_pu = snakemake.config["links"].get("p_max_pu", 1.0)
 
     for lbl in labels.value_counts().loc[lambda s: s > 2].index:
 
@@ -327,16 +374,13 @@ def simplify_links(n, costs, config, output, aggregation_strategies=dict()):
                 n.buses.loc[b, ["x", "y"]], n.buses.loc[buses[1:-1], ["x", "y"]]
             )
             busmap.loc[buses] = b[np.r_[0, m.argmin(axis=0), 1]]
-            connection_costs_to_bus.loc[buses] += _compute_connection_costs_to_bus(
-                n, busmap, costs, config, connection_costs_per_link, buses
-            )
+            moved_buses.extend(buses)
 
             all_links = [i for _, i in sum(links, [])]
 
-            p_max_pu = snakemake.config["links"].get("p_max_pu", 1.0)
             lengths = n.links.loc[all_links, "length"]
             name = lengths.idxmax() + "+{}".format(len(links) - 1)
-            params = dict(
+            new_links[name] = dict(
                 carrier="DC",
                 bus0=b[0],
                 bus1=b[1],
@@ -355,18 +399,35 @@ def simplify_links(n, costs, config, output, aggregation_strategies=dict()):
                 under_construction=False,
             )
 
-            logger.info(
+            logger.debug(
                 "Joining the links {} connecting the buses {} to simple link {}".format(
                     ", ".join(all_links), ", ".join(buses), name
                 )
             )
+            removed_links.extend(all_links)
 
-            n.mremove("Link", all_links)
-
-            static_attrs = n.components["Link"]["attrs"].loc[lambda df: df.static]
-            for attr, default in static_attrs.default.iteritems():
-                params.setdefault(attr, default)
-            n.links.loc[name] = pd.Series(params)
+    if new_links:
+        logger.info(
+            "Joining {} links into {} simple links".format(
+                len(removed_links), len(new_links)
+            )
+        )
+        # apply all joins at once, static defaults are filled in by madd
+        new_links = pd.DataFrame.from_dict(new_links, orient="index")
+        n.mremove("Link", removed_links)
+        n.madd("Link", new_links.index, **new_links)
+
+    if moved_buses:
+        moved_buses = pd.Index(moved_buses).unique()
+        connection_costs_to_bus.loc[moved_buses] = _compute_connection_costs_to_bus(
+            n,
+            busmap,
+            costs,
+            config,
+            connection_costs_per_link,
+            moved_buses,
+            adjacency=adjacency,
+        )
 
     logger.debug("Collecting all components using the busmap")
 
@@ -384,6 +445,12 @@ def busmap_by_stubs(network, matching_attrs=None):
     """Create a busmap by reducing stubs and stubby trees
     (i.e. sequentially reducing dead-ends).
 
+    Dead-ends are peeled off in rounds: every round removes the buses that
+    are dead-ends at its start (in bus order) and merges them into their
+    neighbour, mirroring the repeated sweeps over the graph. Merged buses are
+    tracked by a union-find structure with path compression, so the runtime
+    grows linearly with the size of the network.
+
     Parameters
     ----------
     network : pypsa.Network
@@ -397,33 +464,57 @@ def busmap_by_stubs(network, matching_attrs=None):
         Mapping of network.buses to k-means clusters (indexed by
         non-negative integers).
     """
-    busmap = pd.Series(network.buses.index, network.buses.index)
+    buses_i = network.buses.index
+    pos = dict(zip(buses_i, range(len(buses_i))))
 
     G = network.graph()
+    adj = [set() for _ in range(len(buses_i))]
+    for u, v in G.edges():
+        adj[pos[u]].add(pos[v])
+        adj[pos[v]].add(pos[u])
+
+    if matching_attrs is None:
+        group = np.zeros(len(buses_i), dtype=int)
+    else:
+        # buses with missing attributes never match any other bus
+        group = network.buses.groupby(matching_attrs, sort=False).ngroup().values.copy()
+        group[group < 0] = -np.arange(1, (group < 0).sum() + 1)
+
+    def is_stub(u):
+        if len(adj[u]) != 1:
+            return False
+        (v,) = adj[u]
+        return group[u] == group[v]
+
+    parent = np.arange(len(buses_i))
+
+    def find(u):
+        root = u
+        while parent[root] != root:
+            root = parent[root]
+        while parent[u] != root:
+            parent[u], u = root, parent[u]
+        return root
+
+    stubs = [u for u in range(len(buses_i)) if is_stub(u)]
+    while stubs:
+        removed = set(stubs)
+        neighbours = [next(iter(adj[u])) for u in stubs]
+        for u, v in zip(stubs, neighbours):
+            if v == u:
+                continue
+            parent[u] = v
+            if v in removed and parent[v] == u:
+                # isolated pair of stubs: both are merged into the first one
+                parent[v] = v
+        touched = set()
+        for u, v in zip(stubs, neighbours):
+            adj[v].discard(u)
+            touched.add(v)
+            adj[u].clear()
+        stubs = sorted(v for v in touched - removed if is_stub(v))
 
-    def attrs_match(u, v):
-        return matching_attrs is None or (
-            all(
-                [
-                    network.buses.loc[u, matching_attrs]
-                    == network.buses.loc[v, matching_attrs]
-                ]
-            )
-        )
-
-    while True:
-        stubs = []
-        for u in G.nodes:
-            neighbours = list(G.adj[u].keys())
-            if len(neighbours) == 1:
-                (v,) = neighbours
-                if attrs_match(u, v):
-                    busmap[busmap == u] = v
-                    stubs.append(u)
-        G.remove_nodes_from(stubs)
-        if len(stubs) == 0:
-            break
-    return busmap
+    return pd.Series(buses_i[[find(u) for u in range(len(buses_i))]], buses_i)
 
 
 def remove_stubs(n, costs, config, output, aggregation_strategies=dict()):
@@ -444,50 +535,24 @@ def remove_stubs(n, costs, config, output, aggregation_strategies=dict()):
     return n, busmap
 
 
-def cluster(n, n_clusters, config):
+def cluster(n, n_clusters, config, aggregation_strategies=dict(), gadm_shapes=None):
     logger.info(f"Clustering to {n_clusters} buses")
 
     focus_weights = config.get("focus_weights", None)
     alternative_clustering = config["cluster_options"]["alternative_clustering"]
     gadm_layer_id = config["build_shape_options"]["gadm_layer_id"]
-    geo_crs = config["crs"]["geo_crs"]
-    country_list = config["countries"]
-
-    renewable_carriers = pd.Index(
-        [
-            tech
-            for tech in n.generators.carrier.unique()
-            if tech.split("-", 2)[0] in config["renewable"]
-        ]
-    )
 
-    def consense(x):
-        v = x.iat[0]
-        assert (
-            x == v
-        ).all() or x.isnull().all(), "The `potential` configuration option must agree for all renewable carriers, for now!"
-        return v
-
-    potential_mode = (
-        consense(
-            pd.Series(
-                [config["renewable"][tech]["potential"] for tech in renewable_carriers]
-            )
-        )
-        if len(renewable_carriers) > 0
-        else "conservative"
-    )
     clustering = clustering_for_n_clusters(
         n,
         n_clusters,
         alternative_clustering,
         gadm_layer_id,
-        geo_crs,
-        country_list,
+        gadm_shapes,
         custom_busmap=False,
-        potential_mode=potential_mode,
+        aggregation_strategies=aggregation_strategies,
         solver_name=config["solving"]["solver"]["name"],
         focus_weights=focus_weights,
+        distribution_cluster=config["cluster_options"]["distribute_cluster"],
     )
 
     return clustering.network, clustering.busmap
@@ -537,7 +602,11 @@ if __name__ == "__main__":
 
     if snakemake.wildcards.simpl:
         n, cluster_map = cluster(
-            n, int(snakemake.wildcards.simpl), snakemake.config, aggregation_strategies
+            n,
+            int(snakemake.wildcards.simpl),
+            snakemake.config,
+            aggregation_strategies,
+            gadm_shapes=snakemake.input.gadm_shapes,
         )
         busmaps.append(cluster_map)
 
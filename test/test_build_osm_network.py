@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+# SPDX-FileCopyrightText: : 2021 PyPSA-Africa Authors
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""
+Tests of the grouping of the buses into substations and of the splitting of
+the lines overpassing buses.
+"""
+import os
+import sys
+
+import geopandas as gpd
+import numpy as np
+import pytest
+from shapely.geometry import LineString, Point
+from shapely.ops import split
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "scripts"))
+
+from build_osm_network import (  # noqa: E402
+    _split_linestrings_by_points,
+    fix_overpassing_lines,
+    set_substations_ids,
+)
+
+DISTANCE_CRS = "EPSG:3857"
+
+
+def legacy_set_substations_ids(buses, distance_crs, tol=2000):
+    """Former bus-by-bus implementation of set_substations_ids"""
+    buses["station_id"] = -1
+
+    temp_bus_geom = buses.geometry.to_crs(distance_crs)
+
+    station_id = 0
+    for i, row in buses.iterrows():
+        if buses.loc[i, "station_id"] >= 0:
+            continue
+
+        close_nodes = np.flatnonzero(
+            temp_bus_geom.distance(temp_bus_geom.loc[i]) <= tol
+        )
+
+        if len(close_nodes) == 1:
+            buses.loc[buses.index[i], "station_id"] = station_id
+            station_id += 1
+        else:
+            subset_substation_ids = buses.loc[buses.index[close_nodes], "station_id"]
+            all_neg = subset_substation_ids.max() < 0
+            some_neg = subset_substation_ids.min() < 0
+
+            if all_neg:
+                buses.loc[buses.index[close_nodes], "station_id"] = station_id
+                station_id += 1
+            elif some_neg:
+                sub_id = -1
+                for substation_id in subset_substation_ids:
+                    if substation_id >= 0:
+                        sub_id = substation_id
+                        break
+                buses.loc[buses.index[close_nodes], "station_id"] = sub_id
+
+
+def make_buses(x, y):
+    """Buses at the coordinates (x, y) in m of DISTANCE_CRS"""
+    return gpd.GeoDataFrame(geometry=gpd.points_from_xy(x, y), crs=DISTANCE_CRS).to_crs(
+        "EPSG:4326"
+    )
+
+
+def assert_same_station_ids(buses, tol=2000):
+    expected = buses.copy()
+    legacy_set_substations_ids(expected, DISTANCE_CRS, tol=tol)
+    set_substations_ids(buses, DISTANCE_CRS, tol=tol)
+    np.testing.assert_array_equal(
+        buses["station_id"].values, expected["station_id"].values
+    )
+
+
+def test_set_substations_ids_grid():
+    # regular grid with pairs of buses closer than the tolerance
+    x, y = np.meshgrid(np.arange(0, 30000, 2500.0), np.arange(0, 20000, 2500.0))
+    x = np.concatenate([x.ravel(), x.ravel() + 500.0])
+    y = np.concatenate([y.ravel(), y.ravel() + 500.0])
+    assert_same_station_ids(make_buses(x, y))
+
+
+@pytest.mark.parametrize("spread", [20000, 100000])
+def test_set_substations_ids_random_layouts(spread):
+    rng = np.random.default_rng(spread)
+    for _ in range(10):
+        x, y = rng.uniform(0, spread, (2, 200))
+        assert_same_station_ids(make_buses(x, y))
+
+
+def test_set_substations_ids_empty():
+    buses = make_buses([], [])
+    set_substations_ids(buses, DISTANCE_CRS)
+    assert len(buses["station_id"]) == 0
+
+
+def legacy_split_linestring_by_point(linestring, points):
+    """Former point-by-point splitting of a linestring"""
+    list_linestrings = [linestring]
+    for p in points:
+        temp_list = [split(l, p) for l in list_linestrings]
+        list_linestrings = [lstring for tval in temp_list for lstring in tval.geoms]
+    return list_linestrings
+
+
+def test_split_linestrings_by_points_matches_legacy():
+    rng = np.random.default_rng(0)
+    linestrings, points, line_pos = [], [], []
+    for i in range(200):
+        xy = np.cumsum(rng.normal(size=(rng.integers(2, 8), 2)), axis=0)
+        linestrings.append(LineString(xy))
+        for _ in range(rng.integers(0, 5)):
+            r = rng.random()
+            if r < 0.3:
+                # vertex of the line
+                points.append(Point(xy[rng.integers(len(xy))]))
+            elif r < 0.5:
+                # point off the line
+                points.append(Point(rng.normal(size=2)))
+            else:
+                points.append(
+                    linestrings[-1].interpolate(rng.random(), normalized=True)
+                )
+            line_pos.append(i)
+        if line_pos and line_pos[-1] == i and rng.random() < 0.2:
+            # duplicated point
+            points.append(points[-1])
+            line_pos.append(i)
+
+    geometries, n_geoms = _split_linestrings_by_points(linestrings, points, line_pos)
+
+    assert n_geoms.sum() == len(geometries)
+    assert (n_geoms > 1).any()
+    line_pos = np.asarray(line_pos)
+    offsets = np.cumsum(n_geoms) - n_geoms
+    for i, linestring in enumerate(linestrings):
+        expected = legacy_split_linestring_by_point(
+            linestring, [points[j] for j in np.flatnonzero(line_pos == i)]
+        )
+        result = geometries[offsets[i] : offsets[i] + n_geoms[i]]
+        assert len(result) == len(expected)
+        assert all(r.equals_exact(e, 0) for r, e in zip(result, expected))
+
+
+def test_fix_overpassing_lines():
+    lines = gpd.GeoDataFrame(
+        {"line_id": ["L0", "L1"]},
+        geometry=[
+            LineString([(0, 0), (10000, 0)]),
+            LineString([(0, 5000), (10000, 5000)]),
+        ],
+        crs=DISTANCE_CRS,
+    )
+    # buses overpassed by L0 and away from L1
+    buses = gpd.GeoDataFrame(
+        geometry=gpd.points_from_xy([6000, 2000, 5000], [0, 0, 8000]),
+        crs=DISTANCE_CRS,
+    )
+
+    lines, _ = fix_overpassing_lines(lines, buses, DISTANCE_CRS)
+
+    assert lines["line_id"].tolist() == ["L1", "L0_0", "L0_1", "L0_2"]
+    np.testing.assert_allclose(lines["length"].iloc[1:], [2000, 4000, 4000])
+    np.testing.assert_allclose(lines["bus1_lon"].iloc[1:], [2000, 6000, 10000])
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+# SPDX-FileCopyrightText: : 2021 PyPSA-Africa Authors
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""
+Tests of the cache of the availability matrices and of the average distances
+of the cells.
+"""
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+from scipy.sparse import csr_matrix
+from shapely.geometry import box
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "scripts"))
+
+pytest.importorskip("atlite")
+pytest.importorskip("pypsa")
+
+from build_renewable_profiles import (  # noqa: E402
+    calculate_availability,
+    calculate_availability_cache_key,
+    calculate_average_distance,
+    calculate_bus_hydrobasins,
+    calculate_underwater_fraction,
+)
+
+AREA_CRS = "ESRI:54009"
+
+ONWIND = {
+    "cutout": "africa-2013-era5",
+    "resource": {"method": "wind", "turbine": "Vestas_V112_3MW"},
+    "capacity_per_sqkm": 3,
+    "copernicus": {"grid_codes": [20, 30], "distance": 1000},
+    "natura": True,
+    "potential": "simple",
+}
+SOLAR = {
+    "cutout": "africa-2013-sarah",
+    "resource": {"method": "pv", "panel": "CSi"},
+    "capacity_per_sqkm": 4.6,
+    "copernicus": {"grid_codes": [20, 30], "distance": 1000},
+    "natura": True,
+    "potential": "conservative",
+}
+
+
+class FakeCutout:
+    """Grid of a cutout, counting the availability calculations"""
+
+    crs = "EPSG:4326"
+
+    def __init__(self):
+        self.data = xr.Dataset(
+            coords={"x": np.arange(10.0, 14.0), "y": np.arange(0.0, 3.0)}
+        )
+        self.coords = self.data.coords
+        self.shape = (3, 4)
+        self.n_calls = 0
+
+    def availabilitymatrix(self, regions, excluder, **kwargs):
+        self.n_calls += 1
+        values = np.zeros((len(regions),) + self.shape)
+        for i in range(len(regions)):
+            values[i].flat[i] = 0.5
+        return xr.DataArray(
+            values, dims=["bus", "y", "x"], coords={"bus": regions.index.values}
+        )
+
+
+@pytest.fixture
+def inputs(tmp_path):
+    files = {}
+    for name in ["regions", "natura", "copernicus"]:
+        files[name] = str(tmp_path / name)
+        with open(files[name], "w") as f:
+            f.write(name)
+    return files
+
+
+def cache_key(config, inputs, cutout):
+    return calculate_availability_cache_key(
+        config,
+        [inputs["natura"], inputs["copernicus"]],
+        inputs["regions"],
+        False,
+        AREA_CRS,
+        100,
+        cutout,
+    )
+
+
+def test_availability_cache_key_same_exclusions(inputs):
+    cutout = FakeCutout()
+    assert cache_key(ONWIND, inputs, cutout) == cache_key(SOLAR, inputs, cutout)
+
+    other = dict(ONWIND, copernicus={"grid_codes": [20, 30], "distance": 2000})
+    assert cache_key(other, inputs, cutout) != cache_key(ONWIND, inputs, cutout)
+
+
+def test_availability_cache_shared_by_technologies(inputs, tmp_path):
+    cutout = FakeCutout()
+    regions = pd.DataFrame(index=pd.Index(["B0", "B1", "B2"], name="name"))
+    cache_dir = tmp_path / "availability_cache"
+
+    availabilities = []
+    for config in [ONWIND, SOLAR]:
+        fn_cache = str(
+            cache_dir / f"availability_{cache_key(config, inputs, cutout)}.npz"
+        )
+        availabilities.append(
+            calculate_availability(cutout, regions, None, fn_cache=fn_cache)
+        )
+
+    assert cutout.n_calls == 1
+    assert len(os.listdir(cache_dir)) == 1
+    np.testing.assert_array_equal(
+        availabilities[0].toarray(), availabilities[1].toarray()
+    )
+
+
+def test_average_distance_of_buses_without_cells():
+    cell_coords = np.array([[10.0, 0.0], [10.0, 1.0], [11.0, 0.0]])
+    bus_coords = np.array([[10.0, 0.5], [3.0, 5.0]])
+    # the second bus has no available cell
+    weights = csr_matrix(np.array([[1.0, 1.0, 0.0], [0.0, 0.0, 0.0]]))
+
+    average_distance, centre_of_mass = calculate_average_distance(
+        weights, cell_coords, bus_coords
+    )
+
+    assert np.isfinite(average_distance[0]) and average_distance[0] > 0
+    np.testing.assert_allclose(centre_of_mass[0], [10.0, 0.5])
+    assert np.isnan(average_distance[1])
+    assert np.isnan(centre_of_mass[1]).all()
+
+    # no connection line is drawn for the bus without cells
+    underwater_fraction = calculate_underwater_fraction(
+        centre_of_mass, bus_coords, box(-5.0, -5.0, 5.0, 5.0)
+    )
+    assert underwater_fraction[0] == 0.0
+    assert np.isnan(underwater_fraction[1])
+
+
+def test_bus_hydrobasins_cache(tmp_path):
+    gpd = pytest.importorskip("geopandas")
+
+    bus_points = gpd.GeoDataFrame(
+        geometry=gpd.points_from_xy([0.5, 1.5, 5.0], [0.5, 0.5, 5.0], crs=4326),
+        index=["B0", "B1", "B2"],
+    )
+    hydrobasins = gpd.GeoDataFrame(
+        {"HYBAS_ID": [101, 102]},
+        geometry=[box(0.0, 0.0, 1.0, 1.0), box(1.0, 0.0, 2.0, 1.0)],
+        crs=4326,
+    )
+    fn_cache = str(tmp_path / "bus_hydrobasins.csv")
+
+    bus_basins = calculate_bus_hydrobasins(bus_points, hydrobasins, fn_cache)
+    assert bus_basins.loc["B0"] == 101
+    assert bus_basins.loc["B1"] == 102
+    assert np.isnan(bus_basins.loc["B2"])
+
+    # e.g. a further weather year: the mapping is read without a spatial join
+    cached = calculate_bus_hydrobasins(bus_points, hydrobasins.iloc[:0], fn_cache)
+    pd.testing.assert_series_equal(cached, bus_basins, check_dtype=False)
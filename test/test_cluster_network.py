@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+# SPDX-FileCopyrightText: : 2021 PyPSA-Africa Authors
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""
+Tests of the distribution of the clusters among the countries and of the
+clustering of the buses.
+"""
+import itertools
+import os
+import sys
+from types import SimpleNamespace
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "scripts"))
+
+pytest.importorskip("pypsa")
+
+from cluster_network import (  # noqa: E402
+    allocate_clusters,
+    busmap_for_n_clusters,
+    distribute_clusters,
+    hierarchical_for_points,
+)
+
+
+def random_instance(rng, n_countries, max_buses=8):
+    index = pd.Index([f"C{i}" for i in range(n_countries)], name="country")
+    N = pd.Series(rng.integers(1, max_buses, n_countries), index=index)
+    distribution_factor = pd.Series(rng.random(n_countries), index=index)
+    distribution_factor /= distribution_factor.sum()
+    n_clusters = int(rng.integers(len(N), N.sum() + 1))
+    return distribution_factor, N, n_clusters
+
+
+def objective(allocation, distribution_factor, n_clusters):
+    return ((allocation - distribution_factor * n_clusters) ** 2).sum()
+
+
+def pyomo_allocation(distribution_factor, N, n_clusters, solver_name):
+    """Former MIQP formulation of distribute_clusters"""
+    po = pytest.importorskip("pyomo.environ")
+
+    m = po.ConcreteModel()
+
+    def n_bounds(model, n_id):
+        return (1, N[n_id])
+
+    m.n = po.Var(list(distribution_factor.index), bounds=n_bounds, domain=po.Integers)
+    m.tot = po.Constraint(expr=(po.summation(m.n) == n_clusters))
+    m.objective = po.Objective(
+        expr=sum(
+            (m.n[i] - distribution_factor.loc[i] * n_clusters) ** 2
+            for i in distribution_factor.index
+        ),
+        sense=po.minimize,
+    )
+    po.SolverFactory(solver_name).solve(m)
+
+    return (
+        pd.Series(m.n.get_values(), index=distribution_factor.index).round().astype(int)
+    )
+
+
+def miqp_solver():
+    po = pytest.importorskip("pyomo.environ")
+    for solver_name in ["gurobi_direct", "gurobi", "cplex", "scip"]:
+        try:
+            if po.SolverFactory(solver_name).available(exception_flag=False):
+                return solver_name
+        except Exception:
+            continue
+    pytest.skip("no solver for mixed-integer quadratic problems available")
+
+
+def test_allocate_clusters_matches_pyomo():
+    solver_name = miqp_solver()
+    rng = np.random.default_rng(0)
+    for _ in range(20):
+        distribution_factor, N, n_clusters = random_instance(rng, rng.integers(1, 6))
+        expected = pyomo_allocation(distribution_factor, N, n_clusters, solver_name)
+        allocation = allocate_clusters(distribution_factor, N, n_clusters)
+        pd.testing.assert_series_equal(allocation, expected, check_names=False)
+
+
+def test_allocate_clusters_is_optimal():
+    rng = np.random.default_rng(1)
+    for _ in range(200):
+        distribution_factor, N, n_clusters = random_instance(rng, rng.integers(1, 5))
+        allocation = allocate_clusters(distribution_factor, N, n_clusters)
+
+        assert allocation.sum() == n_clusters
+        assert ((allocation >= 1) & (allocation <= N)).all()
+
+        best = min(
+            objective(np.array(a), distribution_factor.values, n_clusters)
+            for a in itertools.product(*[range(1, u + 1) for u in N])
+            if sum(a) == n_clusters
+        )
+        assert np.isclose(
+            objective(allocation.values, distribution_factor.values, n_clusters), best
+        )
+
+
+def test_allocate_clusters_countries_of_buses():
+    N = pd.Series([3, 4], index=pd.Index(["AA", "BB"], name="country"))
+    # CC has no buses, BB is missing in the shares
+    distribution_factor = pd.Series([0.5, 0.5], index=["AA", "CC"])
+
+    allocation = allocate_clusters(distribution_factor, N, 5)
+
+    assert allocation.index.tolist() == ["AA", "BB"]
+    assert allocation.tolist() == [3, 2]
+
+
+def test_allocate_clusters_invalid_number():
+    N = pd.Series([3, 4], index=["AA", "BB"])
+    distribution_factor = pd.Series([0.5, 0.5], index=["AA", "BB"])
+
+    with pytest.raises(ValueError):
+        allocate_clusters(distribution_factor, N, 1)
+    with pytest.raises(ValueError):
+        allocate_clusters(distribution_factor, N, 8)
+
+
+class FakeNetwork:
+    """Buses and loads of a network, as used by busmap_for_n_clusters"""
+
+    def __init__(self, buses, load):
+        self.buses = buses
+        self.loads = pd.DataFrame({"bus": buses.index}, index=buses.index)
+        self.loads_t = SimpleNamespace(p_set=pd.DataFrame([load], columns=buses.index))
+
+    def determine_network_topology(self):
+        pass
+
+
+def random_network(rng, n_buses=60):
+    index = pd.Index([f"B{i}" for i in range(n_buses)], name="Bus")
+    buses = pd.DataFrame(
+        {
+            "x": rng.uniform(0, 10, n_buses),
+            "y": rng.uniform(0, 10, n_buses),
+            "country": rng.choice(["AA", "BB", "CC"], n_buses),
+            "sub_network": "0",
+        },
+        index=index,
+    )
+    # a country with a single bus
+    buses.loc["B0", "country"] = "DD"
+    return FakeNetwork(buses, rng.uniform(1, 10, n_buses))
+
+
+def test_hierarchical_for_points_several_cuts():
+    coords = np.random.default_rng(2).uniform(0, 10, (40, 2))
+    labels = hierarchical_for_points(coords, [5, 12, 30])
+
+    assert labels.shape == (40, 3)
+    for i, n_clusters in enumerate([5, 12, 30]):
+        single = hierarchical_for_points(coords, n_clusters)
+        np.testing.assert_array_equal(labels[:, i], single)
+        assert len(np.unique(single)) == n_clusters
+
+
+def test_busmap_for_n_clusters_hierarchical_sweep():
+    n = random_network(np.random.default_rng(3))
+    resolutions = [8, 20, 45]
+
+    busmaps = busmap_for_n_clusters(
+        n, resolutions, None, algorithm="hierarchical", distribution_cluster=["load"]
+    )
+
+    assert busmaps.columns.tolist() == resolutions
+    for n_clusters in resolutions:
+        busmap = busmap_for_n_clusters(
+            n, n_clusters, None, algorithm="hierarchical", distribution_cluster=["load"]
+        )
+        pd.testing.assert_series_equal(busmaps[n_clusters], busmap, check_names=False)
+        assert busmap.nunique() == n_clusters
+
+
+def test_busmap_for_n_clusters_list_requires_hierarchical():
+    n = random_network(np.random.default_rng(4))
+    with pytest.raises(ValueError):
+        busmap_for_n_clusters(n, [8, 20], None, distribution_cluster=["load"])
+
+
+def test_distribute_clusters_by_pop(tmp_path):
+    n = random_network(np.random.default_rng(5))
+    fn = str(tmp_path / "gadm_shapes.geojson")
+    gpd.GeoDataFrame(
+        {"country": ["AA", "AA", "BB", "CC", "EE"], "pop": [10, 20, 10, 30, 50]},
+        geometry=gpd.points_from_xy(range(5), range(5)),
+        crs="EPSG:4326",
+    ).to_file(fn, driver="GeoJSON")
+
+    allocation = distribute_clusters(
+        n, 10, distribution_cluster=["pop"], gadm_shapes=fn
+    )
+
+    # EE has no buses, DD has no population
+    assert allocation.index.tolist() == ["AA", "BB", "CC", "DD"]
+    assert allocation.tolist() == [4, 1, 4, 1]
+
+    with pytest.raises(ValueError):
+        distribute_clusters(n, 10, distribution_cluster=["pop"])
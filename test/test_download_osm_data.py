@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+# SPDX-FileCopyrightText: : 2021 PyPSA-Africa Authors
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""
+Tests of the streaming extraction of the power features of a pbf file.
+"""
+import os
+import struct
+import sys
+import zlib
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "scripts"))
+
+esy_pbf = pytest.importorskip("esy.osm.pbf")
+
+from download_osm_data import (  # noqa: E402
+    _coords_to_lonlat,
+    _extract_dense_nodes,
+    _iter_pbf_data_blocks,
+    extract_pbf_features,
+)
+from esy.osm.pbf import fileformat_pb2, osmformat_pb2  # noqa: E402
+
+GRANULARITY = 100
+
+
+def _write_blob(f, blob_type, message):
+    data = message.SerializeToString()
+    blob = fileformat_pb2.Blob(raw_size=len(data), zlib_data=zlib.compress(data))
+    blob_data = blob.SerializeToString()
+    header = fileformat_pb2.BlobHeader(type=blob_type, datasize=len(blob_data))
+    header_data = header.SerializeToString()
+    f.write(struct.pack(">I", len(header_data)))
+    f.write(header_data)
+    f.write(blob_data)
+
+
+def _encode(lonlat):
+    return int(round(lonlat / (1e-9 * GRANULARITY)))
+
+
+def _delta(values):
+    return np.diff(np.asarray(values), prepend=0).tolist()
+
+
+def write_pbf(fn, dense_nodes, ways, plain_nodes=()):
+    """
+    Write a pbf file with a block of dense nodes, a block of plain nodes and
+    a block of ways; nodes are (id, lon, lat, tags), ways are (id, refs, tags)
+    """
+    strings = [""]
+
+    def sid(s):
+        if s not in strings:
+            strings.append(s)
+        return strings.index(s)
+
+    def block(fill):
+        b = osmformat_pb2.PrimitiveBlock(granularity=GRANULARITY)
+        fill(b.primitivegroup.add())
+        b.stringtable.s.extend([s.encode("utf8") for s in strings])
+        return b
+
+    def fill_dense(group):
+        ids, lons, lats = zip(
+            *[(i, _encode(x), _encode(y)) for i, x, y, _ in dense_nodes]
+        )
+        group.dense.id.extend(_delta(ids))
+        group.dense.lon.extend(_delta(lons))
+        group.dense.lat.extend(_delta(lats))
+        for _, _, _, tags in dense_nodes:
+            for k, v in tags.items():
+                group.dense.keys_vals.extend([sid(k), sid(v)])
+            group.dense.keys_vals.append(0)
+
+    def fill_plain(group):
+        for i, x, y, tags in plain_nodes:
+            node = group.nodes.add(id=i, lon=_encode(x), lat=_encode(y))
+            node.keys.extend([sid(k) for k in tags])
+            node.vals.extend([sid(v) for v in tags.values()])
+
+    def fill_ways(group):
+        for i, refs, tags in ways:
+            way = group.ways.add(id=i)
+            way.refs.extend(_delta(refs))
+            way.keys.extend([sid(k) for k in tags])
+            way.vals.extend([sid(v) for v in tags.values()])
+
+    with open(fn, "wb") as f:
+        _write_blob(f, "OSMHeader", osmformat_pb2.HeaderBlock())
+        _write_blob(f, "OSMData", block(fill_dense))
+        if plain_nodes:
+            _write_blob(f, "OSMData", block(fill_plain))
+        _write_blob(f, "OSMData", block(fill_ways))
+
+
+DENSE_NODES = [
+    (1, 10.0, 1.0, {}),
+    (2, 10.1, 1.1, {}),
+    (3, 10.2, 1.0, {"name": "a"}),
+    (4, 11.0, 2.0, {}),
+    (5, 11.1, 2.0, {"power": "substation", "voltage": "220000"}),
+    (6, 11.1, 2.1, {}),
+    (7, 12.5, 3.5, {"power": "generator"}),
+    (100, 20.0, 5.0, {"highway": "bus_stop"}),
+]
+WAYS = [
+    (10, [1, 2, 3], {"power": "line", "voltage": "220000"}),
+    (11, [4, 5, 6, 4], {"power": "substation"}),
+    (12, [100, 1], {"highway": "primary"}),
+    (13, [3, 4], {"power": "minor_line"}),
+]
+FEATURES = ["line", "substation", "generator"]
+
+
+def reference_features(fn):
+    """Extract the features by the element iterator of esy.osm.pbf, as esy.osmfilter"""
+    nodes, ways = {}, {}
+    for entry in esy_pbf.File(fn):
+        if isinstance(entry, esy_pbf.Node):
+            nodes[entry.id] = entry
+        elif isinstance(entry, esy_pbf.Way):
+            ways[entry.id] = entry
+
+    features = {feature: ([], []) for feature in FEATURES}
+    for node in nodes.values():
+        if node.tags.get("power") in features:
+            features[node.tags["power"]][0].append(node)
+    for way in ways.values():
+        if way.tags.get("power") in features:
+            lonlat = [nodes[r].lonlat for r in way.refs]
+            features[way.tags["power"]][1].append((way, lonlat))
+    return features
+
+
+def test_extract_pbf_features_matches_reference(tmp_path):
+    fn = str(tmp_path / "test.osm.pbf")
+    write_pbf(fn, DENSE_NODES, WAYS)
+
+    features_data = extract_pbf_features(fn, FEATURES)
+    reference = reference_features(fn)
+
+    for feature in FEATURES:
+        df_node, df_way = features_data[feature]
+        ref_nodes, ref_ways = reference[feature]
+
+        assert sorted(df_node.get("id", [])) == sorted(n.id for n in ref_nodes)
+        for node in ref_nodes:
+            row = df_node.set_index("id").loc[node.id]
+            np.testing.assert_allclose(row["lonlat"], node.lonlat)
+            assert row["tags.power"] == node.tags["power"]
+
+        assert sorted(df_way.get("id", [])) == sorted(w.id for w, _ in ref_ways)
+        for way, lonlat in ref_ways:
+            row = df_way.set_index("id").loc[way.id]
+            assert list(row["refs"]) == list(way.refs)
+            np.testing.assert_allclose(row["lonlat"], lonlat)
+
+
+def test_extract_dense_nodes(tmp_path):
+    fn = str(tmp_path / "test.osm.pbf")
+    write_pbf(fn, DENSE_NODES, WAYS)
+
+    block = next(_iter_pbf_data_blocks(fn))
+    strmap = tuple(s.decode("utf8") for s in block.stringtable.s)
+    feature_ids = {i: s for i, s in enumerate(strmap) if s in FEATURES}
+
+    ids, coords, power_nodes = _extract_dense_nodes(
+        block,
+        block.primitivegroup[0].dense,
+        strmap,
+        strmap.index("power"),
+        feature_ids,
+    )
+
+    # the coordinates of all the nodes are stored compactly
+    assert ids.tolist() == [i for i, _, _, _ in DENSE_NODES]
+    assert coords.dtype == np.int32
+    np.testing.assert_allclose(
+        _coords_to_lonlat(coords), [(x, y) for _, x, y, _ in DENSE_NODES]
+    )
+    assert sorted((f, i) for f, i, _, _ in power_nodes) == [
+        ("generator", 7),
+        ("substation", 5),
+    ]
+
+
+def test_extract_pbf_features_unreferenced_nodes(tmp_path):
+    fn = str(tmp_path / "test.osm.pbf")
+    write_pbf(fn, DENSE_NODES, WAYS)
+
+    features_data = extract_pbf_features(fn, FEATURES)
+
+    # the node 100 is only referenced by a highway and the power node 7 by
+    # no way: neither leaks into the ways, the power node is kept
+    _, df_way = features_data["line"]
+    assert df_way["id"].tolist() == [10]
+    df_node, _ = features_data["generator"]
+    assert df_node["id"].tolist() == [7]
+
+
+def test_extract_pbf_features_plain_nodes(tmp_path):
+    fn = str(tmp_path / "test.osm.pbf")
+    plain_nodes = [
+        (200, 30.0, -1.0, {"power": "generator", "name": "b"}),
+        (201, 30.5, -1.5, {}),
+    ]
+    ways = WAYS + [(14, [201, 1], {"power": "line"})]
+    write_pbf(fn, DENSE_NODES, ways, plain_nodes=plain_nodes)
+
+    features_data = extract_pbf_features(fn, FEATURES)
+
+    df_node, _ = features_data["generator"]
+    assert sorted(df_node["id"]) == [7, 200]
+    np.testing.assert_allclose(df_node.set_index("id").loc[200, "lonlat"], [30.0, -1.0])
+
+    _, df_way = features_data["line"]
+    np.testing.assert_allclose(
+        df_way.set_index("id").loc[14, "lonlat"], [(30.5, -1.5), (10.0, 1.0)]
+    )
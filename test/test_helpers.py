@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+# SPDX-FileCopyrightText: : 2021 PyPSA-Africa Authors
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""
+Tests of the storage of the geodata in GeoParquet and GeoJSON files.
+"""
+import logging
+import os
+import sys
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+from shapely.geometry import LineString
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "scripts"))
+
+pytest.importorskip("pyarrow")
+
+from _helpers import read_geodata, save_geodata  # noqa: E402
+
+
+def osm_lines():
+    """Lines with the structure of the raw OSM data, e.g. mixed tag types"""
+    return gpd.GeoDataFrame(
+        {
+            "id": [1, 2, 3],
+            "tags.power": ["line", "cable", "line"],
+            "tags.voltage": ["220000", 132000, None],
+            "tags.circuits": ["1", "2", "1;2"],
+            "Length": [1200.5, 30.0, 0.0],
+            "Country": ["NG", "BJ", "NG"],
+        },
+        geometry=[
+            LineString([(3.0, 6.0), (3.1, 6.2)]),
+            LineString([(2.0, 7.0), (2.0, 7.1), (2.2, 7.3)]),
+            LineString([(4.0, 8.0), (4.5, 8.5)]),
+        ],
+        crs="EPSG:4326",
+    )
+
+
+def test_save_read_geodata_parquet_round_trip(tmp_path, caplog):
+    df = osm_lines()
+    fn = str(tmp_path / "lines.parquet")
+
+    with caplog.at_level(logging.INFO):
+        save_geodata(df, fn)
+    assert "tags.voltage" in caplog.text
+
+    read = read_geodata(fn)
+
+    assert read.crs == df.crs
+    assert read.columns.tolist() == df.columns.tolist()
+    assert read.geometry.geom_equals(df.geometry).all()
+    pd.testing.assert_frame_equal(
+        pd.DataFrame(read.drop(columns="geometry")),
+        pd.DataFrame(df.drop(columns="geometry")).assign(
+            **{"tags.voltage": ["220000", "132000", None]}
+        ),
+        check_dtype=False,
+    )
+
+
+def test_read_geodata_parquet_matches_geojson(tmp_path):
+    # GeoJSON was the former format of the OSM data
+    df = osm_lines().drop(columns="tags.voltage")
+    fn_parquet = str(tmp_path / "lines.parquet")
+    fn_geojson = str(tmp_path / "lines.geojson")
+
+    save_geodata(df, fn_parquet, export_geojson=True)
+    assert os.path.exists(fn_geojson)
+
+    read_parquet = read_geodata(fn_parquet)
+    read_json = read_geodata(fn_geojson)
+
+    assert read_parquet.columns.tolist() == read_json.columns.tolist()
+    assert read_parquet.geometry.geom_equals_exact(read_json.geometry, 1e-9).all()
+    for col in df.columns.drop("geometry"):
+        np.testing.assert_array_equal(read_parquet[col].values, read_json[col].values)
+
+
+@pytest.mark.parametrize("ext", [".parquet", ".geojson"])
+def test_read_geodata_columns(tmp_path, ext):
+    fn = str(tmp_path / f"lines{ext}")
+    save_geodata(osm_lines(), fn)
+
+    read = read_geodata(fn, columns=["id", "Country", "tags.cables"])
+
+    # the geometry is always read, missing columns are ignored
+    assert sorted(read.columns) == ["Country", "geometry", "id"]
+    assert read["id"].tolist() == [1, 2, 3]
+
+
+def test_save_read_geodata_empty(tmp_path):
+    fn = str(tmp_path / "empty.parquet")
+    save_geodata(pd.DataFrame(), fn)
+
+    assert os.path.getsize(fn) == 0
+    assert read_geodata(fn, columns=["id"]).empty
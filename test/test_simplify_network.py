@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+# SPDX-FileCopyrightText: : 2021 PyPSA-Africa Authors
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""
+Tests of the reduction of the stubs and of the connection costs.
+"""
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+import scipy.sparse as sps
+from scipy.sparse.csgraph import dijkstra
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "scripts"))
+
+nx = pytest.importorskip("networkx")
+pytest.importorskip("pypsa")
+
+from simplify_network import (  # noqa: E402
+    _compute_connection_costs_to_bus,
+    busmap_by_stubs,
+)
+
+
+class FakeNetwork:
+    """Buses and branches of a network, with the graph methods of pypsa"""
+
+    def __init__(self, buses, links, lines):
+        self.buses = buses
+        self.links = links
+        self.lines = lines
+
+    def branches(self):
+        return pd.concat([self.links, self.lines])
+
+    def graph(self):
+        G = nx.MultiGraph()
+        G.add_nodes_from(self.buses.index)
+        G.add_edges_from(zip(self.branches().bus0, self.branches().bus1))
+        return G
+
+    def adjacency_matrix(self, weights):
+        branches = self.branches()
+        return sps.coo_matrix(
+            (
+                weights.values,
+                (
+                    self.buses.index.get_indexer(branches.bus0),
+                    self.buses.index.get_indexer(branches.bus1),
+                ),
+            ),
+            shape=(len(self.buses),) * 2,
+        ).tocsr()
+
+
+def random_network(rng, n_buses, n_links, n_lines, tree=False):
+    index = pd.Index([f"B{i}" for i in rng.permutation(n_buses)], name="Bus")
+    buses = pd.DataFrame(
+        {"country": rng.choice(["AA", "BB"], n_buses, p=[0.8, 0.2]), "carrier": "AC"},
+        index=index,
+    )
+
+    def branches(k, prefix, tree=False):
+        if tree:
+            # random forest with a few extra branches, rich in stubs
+            bus0 = [i for i in range(1, n_buses) if rng.random() < 0.9]
+            bus1 = [rng.integers(0, i) for i in bus0]
+            extra = rng.integers(0, n_buses, (2, k))
+            bus0 = np.r_[bus0, extra[0]].astype(int)
+            bus1 = np.r_[bus1, extra[1]].astype(int)
+        else:
+            bus0, bus1 = rng.integers(0, n_buses, (2, k))
+        return pd.DataFrame(
+            {"bus0": index[bus0], "bus1": index[bus1]},
+            index=[f"{prefix}{i}" for i in range(len(bus0))],
+        )
+
+    return FakeNetwork(buses, branches(n_links, "L", tree=tree), branches(n_lines, "l"))
+
+
+def legacy_busmap_by_stubs(network, matching_attrs=None):
+    """
+    Former implementation of busmap_by_stubs, with the comparison of the bus
+    attributes reduced to a boolean
+    """
+    busmap = pd.Series(network.buses.index, network.buses.index)
+
+    G = network.graph()
+
+    def attrs_match(u, v):
+        return matching_attrs is None or (
+            (
+                network.buses.loc[u, matching_attrs]
+                == network.buses.loc[v, matching_attrs]
+            ).all()
+        )
+
+    while True:
+        stubs = []
+        for u in G.nodes:
+            neighbours = list(G.adj[u].keys())
+            if len(neighbours) == 1:
+                (v,) = neighbours
+                if attrs_match(u, v):
+                    busmap[busmap == u] = v
+                    stubs.append(u)
+        G.remove_nodes_from(stubs)
+        if len(stubs) == 0:
+            break
+    return busmap
+
+
+def legacy_compute_connection_costs_to_bus(n, busmap, connection_costs_per_link, buses):
+    """Former implementation of _compute_connection_costs_to_bus"""
+    connection_costs_to_bus = pd.DataFrame(index=buses)
+
+    for tech in connection_costs_per_link:
+        adj = n.adjacency_matrix(
+            weights=pd.concat(
+                dict(
+                    Link=connection_costs_per_link[tech].reindex(n.links.index),
+                    Line=pd.Series(0.0, n.lines.index),
+                )
+            )
+        )
+        costs_between_buses = dijkstra(
+            adj, directed=False, indices=n.buses.index.get_indexer(buses)
+        )
+        connection_costs_to_bus[tech] = costs_between_buses[
+            np.arange(len(buses)), n.buses.index.get_indexer(busmap.loc[buses])
+        ]
+    return connection_costs_to_bus
+
+
+@pytest.mark.parametrize("matching_attrs", [None, ["country"]])
+def test_busmap_by_stubs_matches_legacy(matching_attrs):
+    rng = np.random.default_rng(0)
+    for _ in range(100):
+        n_buses = int(rng.integers(2, 50))
+        n = random_network(rng, n_buses, int(rng.integers(0, 4)), 0, tree=True)
+
+        busmap = busmap_by_stubs(n, matching_attrs)
+        expected = legacy_busmap_by_stubs(n, matching_attrs)
+
+        pd.testing.assert_series_equal(busmap, expected, check_names=False)
+
+
+def test_busmap_by_stubs_isolated_pair():
+    n = random_network(np.random.default_rng(1), 2, 0, 0)
+    n.links = pd.DataFrame({"bus0": [n.buses.index[1]], "bus1": [n.buses.index[0]]})
+
+    pd.testing.assert_series_equal(
+        busmap_by_stubs(n), legacy_busmap_by_stubs(n), check_names=False
+    )
+
+
+@pytest.mark.parametrize("max_dense_size", [5e7, 1000])
+def test_connection_costs_to_bus_matches_legacy(max_dense_size):
+    rng = np.random.default_rng(2)
+    n = random_network(rng, 300, 400, 200)
+    connection_costs_per_link = {
+        "offwind-ac": pd.Series(rng.random(400) * 10, n.links.index),
+        "offwind-dc": pd.Series(rng.random(400), n.links.index),
+    }
+
+    # chains of buses moved to one of their ends, as in simplify_links
+    busmap = n.buses.index.to_series()
+    chains = np.split(rng.permutation(n.buses.index)[:60], 6)
+    expected = pd.DataFrame(
+        0.0, index=n.buses.index, columns=list(connection_costs_per_link)
+    )
+    for chain in chains:
+        busmap.loc[chain] = rng.choice(chain[[0, -1]], len(chain))
+        expected.loc[chain] += legacy_compute_connection_costs_to_bus(
+            n, busmap, connection_costs_per_link, chain
+        )
+
+    moved_buses = pd.Index(np.concatenate(chains))
+    connection_costs_to_bus = _compute_connection_costs_to_bus(
+        n,
+        busmap,
+        None,
+        None,
+        connection_costs_per_link,
+        moved_buses,
+        max_dense_size=max_dense_size,
+    )
+
+    pd.testing.assert_frame_equal(
+        connection_costs_to_bus, expected.loc[moved_buses], check_names=False
+    )